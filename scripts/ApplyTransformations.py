@@ -2,69 +2,280 @@ import os
 import sys
 import argparse
 import logging
-import slicer
-from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
-from SlicerDevelopmentToolboxUtils.constants import FileExtension
-from SliceTrackerUtils.sessionData import *
+import json
+import subprocess
+import tempfile
+import shutil
+import multiprocessing
+from CaseIndex import CaseIndex
+from SceneUtils import caseScene
+from SlicerScheduler import splitShards, getSlicerExecutable, caseSortKey
+
+try:
+  import slicer
+  from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
+  from SliceTrackerUtils.sessionData import *
+except ImportError:
+  slicer = None
+
+ENGINE_SLICER = "slicer"
+ENGINE_NATIVE = "native"
+FCSV_EXTENSION = ".fcsv"
 
 # usage:  Slicer --no-main-window --python-script ApplyTransformations.py -ld {LandmarksDirectory}
 
 # Slicer --no-main-window --python-script ApplyTransformations.py -ld ~/Dropbox\ \(Partners\ HealthCare\)/SliceTracker_Evaluation/Landmarks/ -tt Manual
 
+# without Slicer: python ApplyTransformations.py -ld {LandmarksDirectory} -st Manual -tt bSpline -ft Targets -e native
+
+# parallel: Slicer --no-main-window --python-script ApplyTransformations.py -ld {LandmarksDirectory} -st Manual -tt bSpline -ft Targets -w 8
+
+# whole evaluation matrix in one pass: python ApplyTransformations.py -ld {LandmarksDirectory} -st Manual Automatic -tt bSpline -ft Targets Landmarks -e native
+
+# bSpline transforms from cached displacement fields (1 mm): python ApplyTransformations.py -ld {LandmarksDirectory} -st Manual -tt bSpline -ft Targets -e native -df 1
+
+STATUS_TRANSFORMED = "transformed"
+STATUS_FALLBACK = "fallback"
+STATUS_MISSING = "missing"
+
+
 def main(argv):
 
   try:
     parser = argparse.ArgumentParser(description="Slicetracker Transform Applicator")
     parser.add_argument("-ld", "--landmark-root-directory", dest="landmarkRootDir", metavar="PATH", default="-",
                         required=True, help="Root directory that lists all cases holding information for landmarks")
-    parser.add_argument("-st", "--segmentation-type", dest="segmentationType", metavar="NAME", default="-",
+    parser.add_argument("-st", "--segmentation-type", dest="segmentationTypes", metavar="NAME", nargs="+",
                         choices=['Manual', 'Automatic'], required=True, help="Expected transform name will be "
                                                  "{casenumber}-TRANSFORM-{transformType}-{segmentationType}.h5")
-    parser.add_argument("-tt", "--transform-type", dest="transformType", metavar="NAME", default="-",
+    parser.add_argument("-tt", "--transform-type", dest="transformTypes", metavar="NAME", nargs="+",
                         choices=['rigid', 'affine', 'bSpline'], required=True,
-                        help="%(choices). expected transform name: {casenumber}-TRANSFORM-{transformType}-{segmentationType}.h5")
-    parser.add_argument("-ft", "--fiducial-type", dest="fiducialType", metavar="NAME", default="-", choices = ['Targets', 'Landmarks'],
-                        required=True, help='list servers, storage, or both (default: %(default)s)')
+                        help="%(choices)s. expected transform name: {casenumber}-TRANSFORM-{transformType}-{segmentationType}.h5")
+    parser.add_argument("-ft", "--fiducial-type", dest="fiducialTypes", metavar="NAME", nargs="+",
+                        choices = ['Targets', 'Landmarks'], required=True,
+                        help="%(choices)s. Every combination of the given fiducial, transform and segmentation types is "
+                             "written, loading each fiducial list and transform of a case only once")
+    parser.add_argument("-e", "--engine", dest="engine", metavar="NAME", choices=[ENGINE_SLICER, ENGINE_NATIVE],
+                        default=ENGINE_SLICER if slicer else ENGINE_NATIVE,
+                        help="%(choices)s. native reads the .h5 transforms with h5py and transforms the fiducials "
+                             "with numpy without Slicer (default: %(default)s)")
+    parser.add_argument("-df", "--displacement-field", dest="fieldResolution", metavar="MM", type=float, default=None,
+                        help="native engine only: evaluate bSpline transforms from a dense displacement field with this "
+                             "sample distance, which is rasterized once per transform file and cached on disk")
+    parser.add_argument("-dc", "--displacement-field-cache", dest="fieldCacheDir", metavar="PATH", default=None,
+                        help="Directory holding the cached displacement fields (default: ~/.cache/...)")
+    parser.add_argument("-c", "--cases", dest="cases", metavar="CASE", nargs="+", default=None,
+                        help="Only process the listed case numbers")
+    parser.add_argument("-w", "--workers", dest="workers", metavar="N", type=int, default=1,
+                        help="Number of processes the cases are split across (default: %(default)s)")
+    parser.add_argument("-se", "--slicer-executable", dest="slicerExecutable", metavar="PATH", default=None,
+                        help="Slicer executable used for starting workers (default: the running Slicer)")
+    parser.add_argument("-s", "--summary-file", dest="summaryFile", metavar="PATH", default=None,
+                        help="Write the per case summary as json to this file")
 
     args = parser.parse_args(argv)
 
-    segmentationType = args.segmentationType
-    transformType = args.transformType
-    fiducialType = args.fiducialType
+    if args.engine == ENGINE_SLICER and not slicer:
+      raise ValueError("Engine %s needs to be run from within Slicer" % ENGINE_SLICER)
+    if args.fieldResolution and args.engine != ENGINE_NATIVE:
+      raise ValueError("Displacement fields are only supported by engine %s" % ENGINE_NATIVE)
+    fieldOptions = {"resolution": args.fieldResolution, "cacheDir": args.fieldCacheDir} if args.fieldResolution else None
+
+    index = CaseIndex.load(args.landmarkRootDir, save=False)
+    cases = getCases(index, args.cases)
 
-    for root, dirs, _ in os.walk(args.landmarkRootDir):
-      for case in dirs:
-        landmarks = os.path.join(root, case, "{}-Preop{}.fcsv".format(case, fiducialType))
-        transform = os.path.join(root, case, "{}-TRANSFORM-{}-{}.h5".format(case, transformType, segmentationType))
+    if args.workers > 1 and len(cases) > 1:
+      summary = runWorkers(args, cases) if args.engine == ENGINE_SLICER else runNativeWorkers(args, index, cases,
+                                                                                            fieldOptions)
+    else:
+      summary = []
+      for case in cases:
+        summary += transformCase(index, case, args.segmentationTypes, args.transformTypes, args.fiducialTypes,
+                                 args.engine, fieldOptions)
+
+    summary = sortSummary(summary)
+    printSummary(summary)
+    if args.summaryFile:
+      writeSummary(summary, args.summaryFile)
+
+  except Exception, e:
+    print e
+  sys.exit(0)
+
+
+def getCases(index, cases=None):
+  available = index.cases()
+  if cases is None:
+    return available
+  return [case for case in available if case in cases]
+
+
+def getCombinations(index, case, segmentationTypes, transformTypes, fiducialTypes):
+  """ Returns [(fiducialType, transformType, segmentationType, fiducialFile, transformFile, status)]
+  """
+  combinations = []
+  for fiducialType in fiducialTypes:
+    landmarks = index.path(case, "Preop{}".format(fiducialType), ".fcsv")
+    for transformType in transformTypes:
+      for segmentationType in segmentationTypes:
+        transform = index.path(case, "TRANSFORM-{}-{}".format(transformType, segmentationType), ".h5")
+        status = STATUS_TRANSFORMED
 
         # check if exists and if is identity
-        volume = os.path.join(root, case, "{}-VOLUME-{}-{}.nrrd".format(case, transformType, segmentationType))
-        if not os.path.exists(volume):
+        if not index.has(case, "VOLUME-{}-{}".format(transformType, segmentationType)):
           logging.info("Case {}: No valid {} transform found.Falling back to affine".format(case, transformType))
-          # volume = os.path.join(root, case, "{}-VOLUME-affine-{}.nrrd".format(case, segmentationType))
-          transform = os.path.join(root, case, "{}-TRANSFORM-affine-{}.h5".format(case, segmentationType))
+          transform = index.path(case, "TRANSFORM-affine-{}".format(segmentationType), ".h5")
+          status = STATUS_FALLBACK
 
-        if all(os.path.exists(f) for f in [landmarks, transform]):
-          success, landmarksNode = slicer.util.loadMarkupsFiducialList(landmarks, returnNode=True)
-          success, transformNode = slicer.util.loadTransform(transform, returnNode=True)
-          ModuleLogicMixin.applyTransform(transformNode, landmarksNode)
+        if not (landmarks and transform):
+          logging.warn("Did not find {} fiducials or {} {} transform for case {}".format(fiducialType, transformType,
+                                                                                     segmentationType, case))
+          status = STATUS_MISSING
+        combinations.append((fiducialType, transformType, segmentationType, landmarks, transform, status))
+  return combinations
 
-          fileName = "{}-Preop{}-transformed-{}-{}".format(case, fiducialType, transformType, segmentationType)
 
-          print "saving to : {}/{}{}".format(os.path.dirname(landmarks), fileName, FileExtension.FCSV)
+def transformCase(index, case, segmentationTypes, transformTypes, fiducialTypes, engine=ENGINE_SLICER,
+                  fieldOptions=None):
+  """ Writes {case}-Preop{fiducialType}-transformed-{transformType}-{segmentationType}.fcsv for every combination of
+  the given types. Each fiducial list and each transform file of the case is loaded once.
 
-          ModuleLogicMixin.saveNodeData(landmarksNode, os.path.dirname(landmarks), FileExtension.FCSV, name=fileName)
-        else:
-          logging.warn("Did not find landmarks/transforms for case %s" % case)
+  fieldOptions ({"resolution", "cacheDir"}) makes the native engine evaluate bSpline transforms from cached
+  displacement fields.
+  """
+  combinations = getCombinations(index, case, segmentationTypes, transformTypes, fiducialTypes)
+  summary = []
+  for fiducialType, transformType, segmentationType, landmarks, transform, status in combinations:
+    entry = {"case": case, "fiducialType": fiducialType, "transformType": transformType,
+             "segmentationType": segmentationType, "status": status, "output": None}
+    if status != STATUS_MISSING:
+      fileName = "{}-Preop{}-transformed-{}-{}".format(case, fiducialType, transformType, segmentationType)
+      entry["output"] = os.path.join(index.caseDirectory(case), fileName + FCSV_EXTENSION)
+    summary.append(entry)
 
+  jobs = [(landmarks, transform, entry["output"]) for (_, _, _, landmarks, transform, _), entry
+          in zip(combinations, summary) if entry["output"]]
+  if not jobs:
+    return summary
 
+  if engine == ENGINE_NATIVE:
+    applyNativeTransforms(jobs, fieldOptions)
+  else:
+    with caseScene(case):
+      applySlicerTransforms(jobs)
+  return summary
 
-  except Exception, e:
-    print e
-  sys.exit(0)
 
+def applyNativeTransforms(jobs, fieldOptions=None):
+  """ jobs: [(fiducialFile, transformFile, outputFile)]
+  """
+  from FiducialIO import writeFCSV
+  from TransformIO import applyTransformToPoints
+  from LoaderCache import readFCSV, readTransform
+
+  if fieldOptions:
+    from DisplacementField import readTransformWithDisplacementFields, DEFAULT_CACHE_DIR
+    readTransform = lambda path: readTransformWithDisplacementFields(path, fieldOptions["resolution"],
+                                                                     fieldOptions["cacheDir"] or DEFAULT_CACHE_DIR)
+
+  results = {}
+  for fiducialFile, transformFile, outputFile in jobs:
+    print "saving to : {}".format(outputFile)
+    points, labels = readFCSV(fiducialFile)
+    if (fiducialFile, transformFile) not in results:
+      results[(fiducialFile, transformFile)] = applyTransformToPoints(readTransform(transformFile), points)
+    writeFCSV(outputFile, results[(fiducialFile, transformFile)], labels)
+
+
+def applySlicerTransforms(jobs):
+  """ jobs: [(fiducialFile, transformFile, outputFile)]. Every job transforms its own copy of the loaded fiducials.
+  """
+  from LoaderCache import loadTransform
+
+  fiducialNodes = {}
+  for fiducialFile, transformFile, outputFile in jobs:
+    print "saving to : {}".format(outputFile)
+    if fiducialFile not in fiducialNodes:
+      success, fiducialNodes[fiducialFile] = slicer.util.loadMarkupsFiducialList(fiducialFile, returnNode=True)
+    landmarksNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+    landmarksNode.Copy(fiducialNodes[fiducialFile])
+    ModuleLogicMixin.applyTransform(loadTransform(transformFile), landmarksNode)
+    ModuleLogicMixin.saveNodeData(landmarksNode, os.path.dirname(outputFile), FCSV_EXTENSION,
+                                  name=os.path.basename(outputFile)[:-len(FCSV_EXTENSION)])
+    slicer.mrmlScene.RemoveNode(landmarksNode)
+
+
+def runWorkers(args, cases):
+  """ Splits cases round robin into shards and runs each shard in its own headless Slicer process.
+
+  Slicer cannot fork its embedded interpreter, so every worker is a separate Slicer instance running this script
+  on its shard. Each worker writes its transformed fiducials and a shard summary which get merged afterwards.
+  """
+  executable = args.slicerExecutable or getSlicerExecutable()
+  shards = splitShards(cases, args.workers)
+  tempDir = tempfile.mkdtemp(prefix="ApplyTransformations-")
+  try:
+    processes = []
+    for index, shard in enumerate(shards):
+      shardSummary = os.path.join(tempDir, "shard{}.json".format(index))
+      command = [executable, "--no-main-window", "--python-script", os.path.abspath(__file__),
+                 "-e", ENGINE_SLICER, "-ld", args.landmarkRootDir, "-st"] + args.segmentationTypes + \
+                ["-tt"] + args.transformTypes + ["-ft"] + args.fiducialTypes + ["-s", shardSummary, "-c"] + shard
+      logging.info("Starting worker %d for cases %s" % (index, ", ".join(shard)))
+      processes.append((shard, shardSummary, subprocess.Popen(command)))
+
+    summary = []
+    for shard, shardSummary, process in processes:
+      process.wait()
+      if os.path.exists(shardSummary):
+        summary += readSummary(shardSummary)
+      else:
+        logging.warn("Worker for cases %s did not write a summary (exit code %s)" % (", ".join(shard),
+                                                                                   process.returncode))
+        summary += [{"case": case, "status": "failed", "output": None} for case in shard]
+    return summary
+  finally:
+    shutil.rmtree(tempDir, ignore_errors=True)
+
+
+def runNativeWorkers(args, index, cases, fieldOptions=None):
+  pool = multiprocessing.Pool(min(args.workers, len(cases)))
+  try:
+    results = pool.map(_transformCaseNative, [(index, case, args.segmentationTypes, args.transformTypes,
+                                               args.fiducialTypes, ENGINE_NATIVE, fieldOptions) for case in cases])
+    return [entry for caseSummary in results for entry in caseSummary]
+  finally:
+    pool.close()
+    pool.join()
+
+
+def _transformCaseNative(caseArgs):
+  return transformCase(*caseArgs)
+
+
+def sortSummary(summary):
+  return sorted(summary, key=lambda entry: caseSortKey(entry["case"]))
+
+
+def printSummary(summary):
+  counts = {}
+  for entry in summary:
+    counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    if entry["status"] != STATUS_TRANSFORMED:
+      print "Case {}: {} {} {}: {}".format(entry["case"], entry.get("fiducialType", ""), entry.get("transformType", ""),
+                                          entry.get("segmentationType", ""), entry["status"])
+  print "Summary: " + ", ".join("{} {}".format(counts[status], status) for status in sorted(counts))
+
+
+def writeSummary(summary, path):
+  with open(path, "w") as f:
+    json.dump(summary, f, indent=2, sort_keys=True)
+
+
+def readSummary(path):
+  with open(path) as f:
+    return json.load(f)
 
 
 if __name__ == "__main__":
   main(sys.argv[1:])
-
@@ -0,0 +1,73 @@
+import os
+import json
+import logging
+
+from HashUtils import DigestCache, digestOf
+
+# Completion records of generated artifacts, stored per case directory. A record names the input files (with their
+# digests), the parameters and the output files of a unit of work, e.g. the registration of one segmentation type.
+# Work is complete if none of its inputs or parameters changed and all of its outputs still exist unmodified, so an
+# interrupted batch resumes where it stopped.
+
+CHECKPOINT_FILENAME = ".checkpoints.json"
+CHECKPOINT_VERSION = 1
+
+
+class ArtifactCheckpoints(object):
+
+  def __init__(self, directory, fileName=CHECKPOINT_FILENAME):
+    self.path = os.path.join(directory, fileName)
+    self.records = {}
+    self.digests = DigestCache()
+    self._load()
+
+  def _load(self):
+    if not os.path.exists(self.path):
+      return
+    try:
+      with open(self.path) as f:
+        stored = json.load(f)
+      if stored.get("version") == CHECKPOINT_VERSION:
+        self.records = stored.get("records", {})
+        self.digests = DigestCache(stored.get("digests", {}))
+    except (ValueError, IOError):
+      logging.warn("Ignoring unreadable checkpoint file %s" % self.path)
+
+  def _save(self):
+    data = {"version": CHECKPOINT_VERSION, "records": self.records, "digests": self.digests.entries}
+    temp = "{}.{}.tmp".format(self.path, os.getpid())
+    with open(temp, "w") as f:
+      json.dump(data, f, indent=1, sort_keys=True)
+    if os.name == "nt" and os.path.exists(self.path):
+      os.remove(self.path)
+    os.rename(temp, self.path)
+
+  def signature(self, inputs, parameters=None):
+    return digestOf(parameters, [(os.path.basename(path), self.digests.digest(path)) for path in sorted(inputs)])
+
+  def isComplete(self, name, inputs, parameters=None):
+    """ True if name was recorded with the same input digests and parameters and all outputs are unchanged
+    """
+    record = self.records.get(name)
+    if not record or record["signature"] != self.signature(inputs, parameters):
+      return False
+    return all(self.digests.digest(os.path.join(os.path.dirname(self.path), output)) == digest
+               for output, digest in record["outputs"].items())
+
+  def has(self, name):
+    return name in self.records
+
+  def record(self, name, inputs, outputs, parameters=None):
+    """ Records the completion of name. Records written by other processes in the meantime are kept.
+    """
+    self._load()
+    directory = os.path.dirname(self.path)
+    self.records[name] = {
+      "signature": self.signature(inputs, parameters),
+      "outputs": {os.path.relpath(output, directory): self.digests.digest(output) for output in outputs}
+    }
+    self._save()
+
+  def invalidate(self, name):
+    if self.records.pop(name, None) is not None:
+      self._save()
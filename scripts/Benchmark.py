@@ -0,0 +1,286 @@
+import os
+import sys
+import csv
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from collections import OrderedDict
+
+from SceneUtils import MemorySampler, formatMemory
+from SyntheticCohort import generateCohort, DEFAULT_SIZE, TRANSFORM_TYPE
+
+# Benchmarks of the core functions of the evaluation scripts on synthetic cohorts of increasing size (see
+# SyntheticCohort.py). Every benchmark gets timed and reports its throughput (items per second) and the peak memory
+# it added to the process. Benchmarks that need modules which are not available (e.g. Slicer) are skipped.
+#
+# Loader caches are cleared before every benchmark, so the numbers are those of a cold run.
+
+# usage: python Benchmark.py -n 10 50 200 -o {OutputCsvFile}
+
+# python Benchmark.py -n 20 -b calculateLRE getDice
+
+DEFAULT_COHORT_SIZES = [10, 50]
+COLUMNS = ["Benchmark", "Cases", "Items", "Seconds", "ItemsPerSecond", "PeakMemoryMB", "Comment"]
+
+
+def main(argv):
+
+  try:
+    parser = argparse.ArgumentParser(description="Slicetracker evaluation benchmarks")
+    parser.add_argument("-n", "--cases", dest="cohortSizes", metavar="N", type=int, nargs="+",
+                        default=DEFAULT_COHORT_SIZES, help="Cohort sizes to benchmark (default: %(default)s)")
+    parser.add_argument("-b", "--benchmarks", dest="benchmarks", metavar="NAME", nargs="+", default=None,
+                        choices=BENCHMARKS.keys(), help="Only run these benchmarks (%(choices)s)")
+    parser.add_argument("-sz", "--size", dest="size", metavar="N", type=int, nargs=3, default=DEFAULT_SIZE,
+                        help="Image size in voxels (default: %(default)s)")
+    parser.add_argument("-g", "--guidance-series", dest="guidanceSeries", metavar="N", type=int, default=3,
+                        help="Number of needle guidance series per case (default: %(default)s)")
+    parser.add_argument("-d", "--directory", dest="directory", metavar="PATH", default=None,
+                        help="Directory for the cohorts, which are kept and reused (default: temporary directory)")
+    parser.add_argument("-o", "--output-file", dest="outputFile", metavar="PATH", default=None,
+                        help="Output csv file")
+    args = parser.parse_args(argv)
+
+    rows = []
+    for cases in args.cohortSizes:
+      cohort = prepareCohort(args, cases)
+      try:
+        rows += runBenchmarks(cohort, args.benchmarks or BENCHMARKS.keys())
+      finally:
+        if not args.directory:
+          shutil.rmtree(cohort["root"], ignore_errors=True)
+
+    printTable(rows)
+    if args.outputFile:
+      csv_writer([COLUMNS] + rows, args.outputFile)
+    success = True
+
+  except Exception, e:
+    print e
+    success = False
+  sys.exit(0 if success else 1)
+
+
+def prepareCohort(args, cases):
+  if not args.directory:
+    root = tempfile.mkdtemp(prefix="slicetracker-benchmark-")
+  else:
+    root = os.path.join(args.directory, "cohort-{}-{}".format(cases, "x".join(str(v) for v in args.size)))
+    if os.path.exists(root):
+      return {"root": root, "cases": sorted(os.listdir(os.path.join(root, "landmarks")))}
+  print "Generating cohort of %d cases in %s" % (cases, root)
+  return generateCohort(root, cases, args.size, args.guidanceSeries)
+
+
+def clearCaches():
+  from LoaderCache import CACHE
+  CACHE.clear()
+
+
+def runBenchmarks(cohort, names):
+  rows = []
+  for name in names:
+    prepare, benchmark = BENCHMARKS[name]
+    try:
+      if prepare:
+        prepare(cohort)
+      items, seconds, peak = measure(benchmark, cohort)
+    except ImportError, e:
+      rows.append([name, len(cohort["cases"]), "", "", "", "", "skipped: %s" % e])
+      continue
+    rows.append([name, len(cohort["cases"]), items, round(seconds, 4), round(items / max(seconds, 1e-9), 1),
+                 "" if peak is None else round(peak / (1024.0 * 1024.0), 1), ""])
+    logging.info("%s: %d items in %.3fs, peak %s" % (name, items, seconds, formatMemory(peak)))
+  return rows
+
+
+def measure(benchmark, cohort):
+  """ Runs benchmark on cohort with empty loader caches and returns (items, seconds, peak memory increase in bytes)
+  """
+  clearCaches()
+  sampler = MemorySampler(interval=0.01)
+  sampler.start()
+  start = time.time()
+  try:
+    items = benchmark(cohort)
+  finally:
+    seconds = time.time() - start
+    sampler.stop()
+  peak = None if sampler.peak is None or sampler.startMemory is None else sampler.peak - sampler.startMemory
+  return items, seconds, peak
+
+
+def landmarkFile(cohort, case, name):
+  return os.path.join(cohort["root"], "landmarks", case, "{}-{}".format(case, name))
+
+
+def benchmarkLRE(cohort):
+  from FiducialIO import calculateCohortLREs
+  cases = [(case, landmarkFile(cohort, case, "IntraopLandmarks.fcsv"),
+            landmarkFile(cohort, case, "PreopLandmarks-transformed-{}-Manual.fcsv".format(TRANSFORM_TYPE)))
+           for case in cohort["cases"]]
+  return len(calculateCohortLREs(cases))
+
+
+def benchmarkApplyTransforms(cohort):
+  from FiducialIO import readFCSV
+  from TransformIO import readTransform, applyTransformToPoints
+  count = 0
+  for case in cohort["cases"]:
+    points, _ = readFCSV(landmarkFile(cohort, case, "PreopLandmarks.fcsv"))
+    for segmentationType in ["Manual", "Automatic"]:
+      transform = readTransform(landmarkFile(cohort, case, "TRANSFORM-{}-{}.h5".format(TRANSFORM_TYPE,
+                                                                                       segmentationType)))
+      count += len(applyTransformToPoints(transform, points))
+  return count
+
+
+def benchmarkDice(cohort):
+  from DiceComputation import getDiceForFiles
+  pairs = [(landmarkFile(cohort, case, "{}Manual-label.nrrd".format(imageType)),
+            landmarkFile(cohort, case, "{}Automatic-label.nrrd".format(imageType)))
+           for case in cohort["cases"] for imageType in ["Preop", "Intraop"]]
+  return len(getDiceForFiles(pairs))
+
+
+def benchmarkVolumes(cohort):
+  from CalculateProstateVolumes import processSegmentationsDirectory, calculateVolumesFromLabelFiles
+  data = processSegmentationsDirectory(os.path.join(cohort["root"], "segmentations"))
+  calculateVolumesFromLabelFiles(data)
+  return sum(1 for caseData in data.values() for stageData in caseData.values()
+             for segData in stageData.values() if isinstance(segData, dict) and "statistics" in segData)
+
+
+def needleLabels(cohort):
+  labels = []
+  for case in cohort["cases"]:
+    directory = os.path.join(cohort["root"], "tre", case)
+    labels += [(case, os.path.join(directory, f)) for f in sorted(os.listdir(directory))
+               if f.endswith("-needle-label.nrrd")]
+  return labels
+
+
+def benchmarkCenterLine(cohort):
+  from Prospective.NeedleCenterline import CenterLinePoints
+  for _, label in needleLabels(cohort):
+    centerLine = CenterLinePoints(label)
+    centerLine.convert_points_ijk_to_ras(centerLine.get_needle_points_ijk())
+  return len(needleLabels(cohort))
+
+
+def benchmarkNeedleDistances(cohort):
+  from FiducialIO import readFCSV
+  from Prospective.NeedleCenterline import CenterLinePoints
+  from Prospective.NeedleDistance import distancesToCurves
+  curves, targets, indices = [], [], []
+  for _, label in needleLabels(cohort):
+    centerLine = CenterLinePoints(label)
+    positions, _ = readFCSV(label.replace("-needle-label.nrrd", "-targets.fcsv"))
+    targets += list(positions)
+    indices += [len(curves)] * len(positions)
+    curves.append(centerLine.convert_points_ijk_to_ras(centerLine.get_needle_points_ijk()))
+  return len(distancesToCurves(curves, targets, indices)[0])
+
+
+def archive(cohort):
+  return os.path.join(cohort["root"], "archive")
+
+
+def scanCacheFile(cohort):
+  return os.path.join(cohort["root"], "archive-scan.json")
+
+
+def removeScanCache(cohort):
+  if os.path.exists(scanCacheFile(cohort)):
+    os.remove(scanCacheFile(cohort))
+
+
+def benchmarkScan(cohort):
+  from Prospective.ArchiveScanner import ArchiveScanner
+  return len(ArchiveScanner(scanCacheFile(cohort)).scan(archive(cohort)))
+
+
+def storeFile(cohort):
+  return os.path.join(cohort["root"], "metafiles.sqlite")
+
+
+def openStore(cohort):
+  from Prospective.MetafileStore import MetafileStore
+  store = MetafileStore(storeFile(cohort))
+  store.refresh(archive(cohort), scanCacheFile=scanCacheFile(cohort))
+  return store
+
+
+def removeStore(cohort):
+  if os.path.exists(storeFile(cohort)):
+    os.remove(storeFile(cohort))
+
+
+def prepareStore(cohort):
+  openStore(cohort).close()
+
+
+def benchmarkStore(cohort):
+  store = openStore(cohort)
+  try:
+    return len(store.metafiles())
+  finally:
+    store.close()
+
+
+def benchmarkCollectResults(cohort):
+  from Prospective.CollectProspectiveData import collect_results, collect_general_case_information
+  store = openStore(cohort)
+  try:
+    return len(collect_results(store)) + len(collect_general_case_information(store)) - 2
+  finally:
+    store.close()
+
+
+def benchmarkLatencies(cohort):
+  from Prospective.WorkflowLatency import caseLatencies, seriesLatencies
+  store = openStore(cohort)
+  try:
+    return len(caseLatencies(store)[0]) + len(seriesLatencies(store)[0])
+  finally:
+    store.close()
+
+
+# name: (untimed preparation or None, benchmark returning the number of processed items)
+BENCHMARKS = OrderedDict([
+  ("calculateLRE", (None, benchmarkLRE)),
+  ("applyTransformToPoints", (None, benchmarkApplyTransforms)),
+  ("getDice", (None, benchmarkDice)),
+  ("calculateVolumes", (None, benchmarkVolumes)),
+  ("CenterLinePoints", (None, benchmarkCenterLine)),
+  ("needleDistances", (None, benchmarkNeedleDistances)),
+  ("scanArchive-cold", (removeScanCache, benchmarkScan)),
+  ("scanArchive-warm", (benchmarkScan, benchmarkScan)),
+  ("metafileStore-cold", (removeStore, benchmarkStore)),
+  ("metafileStore-warm", (prepareStore, benchmarkStore)),
+  ("collect_results", (prepareStore, benchmarkCollectResults)),
+  ("workflowLatencies", (prepareStore, benchmarkLatencies)),
+])
+
+
+def printTable(rows):
+  table = [COLUMNS] + [[str(value) for value in row] for row in rows]
+  widths = [max(len(row[i]) for row in table) for i in range(len(COLUMNS))]
+  for row in table:
+    print "  ".join(value.ljust(width) for value, width in zip(row, widths))
+
+
+def csv_writer(data, path):
+  """
+  Write data to a CSV file path
+  """
+  with open(path, "wb") as csv_file:
+    writer = csv.writer(csv_file, delimiter=',')
+    for line in data:
+      writer.writerow(line)
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
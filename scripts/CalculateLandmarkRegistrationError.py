@@ -1,14 +1,22 @@
 import os
 import sys
 import argparse
-import slicer
 import logging
 import csv
-from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
-from SliceTrackerUtils.sessionData import *
+from FiducialIO import calculateCohortLREs
+from CaseIndex import CaseIndex
+
+try:
+  import slicer
+except ImportError:
+  slicer = None
 
 # usage: Slicer.exe --no-main-window --python-script CalculateLandmarkRegistrationError.py -ld {LandmarksDirectory}
 
+# without Slicer: python CalculateLandmarkRegistrationError.py -ld {LandmarksDirectory} -o {OutputFile}
+
+# parallel: python SlicerScheduler.py -s CalculateLandmarkRegistrationError.py -cd {LandmarksDirectory} -w 8 -o {OutputFile} -- -ld {LandmarksDirectory} -o {OutputFile}
+
 
 
 validSegmentationEvaluationCases = [278,281,285,295,303,304,306,310,331,333,348,357,358,363,366,370,393,395,398,410,415,
@@ -33,10 +41,12 @@ def main(argv):
                         help="flag for calculating for all cases manual LRE, otherwise automatic LRE")
     parser.add_argument("-tt", "--transform-type", dest="transformType", metavar="PATH", default="bSpline",
                         required=False, help="rigid|affine|bSpline")
+    parser.add_argument("-c", "--cases", dest="cases", metavar="CASE", nargs="+", default=None,
+                        help="Only process the listed case numbers")
     parser.add_argument("-d", "--debug", action='store_true')
     args = parser.parse_args(argv)
 
-    if args.debug:
+    if args.debug and slicer:
       slicer.app.layoutManager().selectModule("PyDevRemoteDebug")
       w = slicer.modules.PyDevRemoteDebugWidget
       w.connectButton.click()
@@ -64,53 +74,24 @@ def getLandmarksLREs(args):
 
   transformType = args.transformType
 
-  data = []
-  for root, dirs, _ in os.walk(args.landmarkRootDir):
-    for case in dirs:
-      if int(case) not in validCases:
-        logging.info("Skipping case %s that is not in list of valid cases" % case)
-        continue
-
-      intraopLandmarks = os.path.join(root, case, '{}-IntraopLandmarks.fcsv'.format(case))
-      transformedLandmarks = os.path.join(root, case,
-                                          "{}-PreopLandmarks-transformed-{}-{}.fcsv".format(case, transformType,
-                                                                                            segmentationType))
-
-      if all(os.path.exists(f) for f in [intraopLandmarks, transformedLandmarks]):
-        data += calculateLRE(case, intraopLandmarks, transformedLandmarks)
-      else:
-        print "Data was not found for case %s" % case
-  return data
-
-
-def calculateLRE(case, landmark, transformed):
-  success, landmarksNode = slicer.util.loadMarkupsFiducialList(landmark, returnNode=True)
-  success, transformedNode = slicer.util.loadMarkupsFiducialList(transformed, returnNode=True)
-
-  caseData = []
-  for i in range(landmarksNode.GetNumberOfFiducials()):
-    landmarkData = [case]
-
-    landmarkPos = ModuleLogicMixin.getTargetPosition(landmarksNode, i)
-    transformedPos = ModuleLogicMixin.getTargetPosition(transformedNode, i)
-    landmarkTRE = ModuleLogicMixin.get3DEuclideanDistance(landmarkPos, transformedPos)
-
-    landmarkData.append(landmarksNode.GetNthFiducialLabel(i))
-    landmarkData.append(str(landmarkPos))
-    landmarkData.append(transformedNode.GetNthFiducialLabel(i))
-    landmarkData.append(str(transformedPos))
-    landmarkData.append(landmarkTRE)
-
-    caseData.append(landmarkData)
-
-  return caseData
-
-
-def getFiducialIndexByLabel(node, labelEnd):
-  for index in range(node.GetNumberOfFiducials()):
-    if node.GetNthFiducialLabel(index).endswith(labelEnd):
-      return index
-  return -1
+  index = CaseIndex.load(args.landmarkRootDir, save=False)
+  cases = []
+  for case in index.cases():
+    if args.cases and case not in args.cases:
+      continue
+    if int(case) not in validCases:
+      logging.info("Skipping case %s that is not in list of valid cases" % case)
+      continue
+
+    intraopLandmarks = index.path(case, "IntraopLandmarks", ".fcsv")
+    transformedLandmarks = index.path(case, "PreopLandmarks-transformed-{}-{}".format(transformType, segmentationType),
+                                      ".fcsv")
+
+    if intraopLandmarks and transformedLandmarks:
+      cases.append((case, intraopLandmarks, transformedLandmarks))
+    else:
+      print "Data was not found for case %s" % case
+  return calculateCohortLREs(cases)
 
 
 def csv_writer(data, path):
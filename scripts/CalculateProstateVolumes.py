@@ -1,16 +1,24 @@
 import os
 import sys
 import argparse
-import slicer
-import pandas
 import csv
 
-from LabelStatistics import LabelStatisticsLogic
-from SliceTrackerUtils.sessionData import *
+from NrrdIO import NrrdFile, countLabelVoxels
+from LabelStatisticsEngine import computeLabelStatistics, COLUMNS as STATISTICS_COLUMNS
+from LoaderCache import loadVolume, loadLabelVolume
+
+try:
+  import slicer
+  from LabelStatistics import LabelStatisticsLogic
+  from SliceTrackerUtils.sessionData import *
+except ImportError:
+  slicer = None
 
 
 # usage: Slicer --no-main-window --python-script CalculateProstateVolumes.py -sd ~/Dropbox\ \(Partners\ HealthCare\)/SliceTracker_Evaluation/Segmentations/ -o Volumes.csv
 
+# without Slicer (label headers and voxels only): python CalculateProstateVolumes.py -sd {SegmentationsDirectory} -o Volumes.csv -f
+
 
 def main(argv):
 
@@ -20,11 +28,23 @@ def main(argv):
                         required=True, help="Root directory listing cases holding information manual and automatic label")
     parser.add_argument("-o", "--output-csv-file", dest="outputFile", metavar="PATH", default="-",
                         required=True, help="Output csv file to write information to")
+    parser.add_argument("-f", "--fast", action='store_true', default=slicer is None,
+                        help="Count label voxels directly from the nrrd files without loading volumes into Slicer")
+    parser.add_argument("-as", "--all-statistics-file", dest="allStatisticsFile", metavar="PATH", default=None,
+                        help="Additionally write count, volume, bounding box, centroid and intensity statistics of "
+                             "every label value to this csv file (computed without Slicer)")
     args = parser.parse_args(argv)
 
     data = processSegmentationsDirectory(args.segmentationsDir)
-    calculateVolumes(data)
+    if args.allStatisticsFile:
+      calculateAllStatistics(data)
+    elif args.fast:
+      calculateVolumesFromLabelFiles(data)
+    else:
+      calculateVolumes(data)
     writeData(os.path.join(args.segmentationsDir, args.outputFile), data)
+    if args.allStatisticsFile:
+      writeAllStatistics(os.path.join(args.segmentationsDir, args.allStatisticsFile), data)
 
     # import pprint
     # pprint.pprint(data)
@@ -76,10 +96,10 @@ def calculateVolumes(data):
 
   for case, caseData  in data.iteritems():
     for stage, stageData in caseData.iteritems():
-      success, volume = slicer.util.loadVolume(stageData["volume"], returnNode=True)
+      volume = loadVolume(stageData["volume"])
       for segmentationType, segData in stageData.iteritems():
         if not type(segData) is str:
-          success, label = slicer.util.loadLabelVolume(segData["label"], returnNode=True)
+          label = loadLabelVolume(segData["label"])
           logic = LabelStatisticsLogic(volume, label)
           segData["statistics"] = dict()
           for k in ["Volume mm^3", "Volume cc"]:
@@ -87,6 +107,55 @@ def calculateVolumes(data):
             #             data[case][stage][segmentationType][k] = logic.labelStats[logic.labelStats["Labels"][-1], k]
 
 
+def calculateVolumesFromLabelFiles(data):
+  """ Same statistics as calculateVolumes, computed from the label nrrd header (spacing) and one sequential read of
+  its voxels. The intensity volume is not needed.
+  """
+  for case, caseData in data.iteritems():
+    for stage, stageData in caseData.iteritems():
+      for segmentationType, segData in stageData.iteritems():
+        if not type(segData) is str:
+          segData["statistics"] = getLabelVolumes(segData["label"])
+
+
+def getLabelVolumes(labelFile):
+  counts = countLabelVoxels(labelFile)
+  # LabelStatistics reports the highest label value as the last entry
+  count = counts[max(counts)] if counts else 0
+  volume = count * NrrdFile(labelFile).voxelVolume
+  return {"Volume mm^3": volume, "Volume cc": volume / 1000.0}
+
+
+def calculateAllStatistics(data):
+  """ Computes the statistics of all label values of both labels of a stage with a single read of the stage volume
+  and each label. Also fills in the volume statistics written by writeData.
+  """
+  for case, caseData in data.iteritems():
+    for stage, stageData in caseData.iteritems():
+      segmentationTypes = [t for t, segData in stageData.iteritems() if not type(segData) is str]
+      tables = computeLabelStatistics([stageData[t]["label"] for t in segmentationTypes], stageData.get("volume"))
+      for segmentationType, table in zip(segmentationTypes, tables):
+        segData = stageData[segmentationType]
+        segData["allStatistics"] = table
+        # LabelStatistics reports the highest label value as the last entry
+        segData["statistics"] = {k: table[k][-1] if len(table[k]) else 0 for k in ["Volume mm^3", "Volume cc"]}
+
+
+def writeAllStatistics(outputFile, data):
+  csvData = [['Case', 'Stage', 'Segmentation_Type'] + STATISTICS_COLUMNS]
+  for case, caseData in sorted(data.iteritems()):
+    for stage in ["preop", "intraop"]:
+      for segType in ["manual", "automatic"]:
+        table = caseData[stage][segType]["allStatistics"]
+        for row in range(len(table["Label"])):
+          csvData.append([case, stage, segType] + [table[column][row] for column in STATISTICS_COLUMNS])
+
+  with open(outputFile, "wb") as csv_file:
+    writer = csv.writer(csv_file, delimiter=',')
+    for line in csvData:
+      writer.writerow(line)
+
+
 def writeData(outputFile, data):
 
 
@@ -1,14 +1,20 @@
 import os
 import sys
 import argparse
-import slicer
 import logging
 import csv
-from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
-from SliceTrackerUtils.sessionData import *
+from FiducialIO import calculateCohortLREs
+from CaseIndex import CaseIndex
+
+try:
+  import slicer
+except ImportError:
+  slicer = None
 
 # usage: Slicer.exe --no-main-window --python-script CalculateTargetingSensitivity.py -ld {LandmarksDirectory}
 
+# without Slicer: python CalculateTargetingSensitivity.py -ld {LandmarksDirectory} -o {OutputFile}
+
 
 
 validCases = [278,281,285,295,303,304,306,310,331,333,348,357,358,363,366,370,393,395,398,410,415,416,
@@ -27,7 +33,7 @@ def main(argv):
     parser.add_argument("-d", "--debug", action='store_true')
     args = parser.parse_args(argv)
 
-    if args.debug:
+    if args.debug and slicer:
       slicer.app.layoutManager().selectModule("PyDevRemoteDebug")
       w = slicer.modules.PyDevRemoteDebugWidget
       w.connectButton.click()
@@ -47,51 +53,21 @@ def main(argv):
 def getLandmarksLREs(args):
   transformType = args.transformType
 
-  data = []
-  for root, dirs, _ in os.walk(args.landmarkRootDir):
-    for case in dirs:
-      if int(case) not in validCases:
-        logging.info("Skipping case %s that is not in list of valid cases" % case)
-        continue
-
-      manualTargets = os.path.join(root, case, "{}-PreopTargets-transformed-{}-Manual.fcsv".format(case, transformType))
-      automaticTargets = os.path.join(root, case, "{}-PreopTargets-transformed-{}-Automatic.fcsv".format(case, transformType))
-
-      if all(os.path.exists(f) for f in [manualTargets, automaticTargets]):
-        data += calculateLRE(case, manualTargets, automaticTargets)
-      else:
-        print "Data was not found for case %s" % case
-  return data
-
-
-def calculateLRE(case, landmark, transformed):
-  success, landmarksNode = slicer.util.loadMarkupsFiducialList(landmark, returnNode=True)
-  success, transformedNode = slicer.util.loadMarkupsFiducialList(transformed, returnNode=True)
-
-  caseData = []
-  for i in range(landmarksNode.GetNumberOfFiducials()):
-    landmarkData = [case]
-
-    landmarkPos = ModuleLogicMixin.getTargetPosition(landmarksNode, i)
-    transformedPos = ModuleLogicMixin.getTargetPosition(transformedNode, i)
-    landmarkTRE = ModuleLogicMixin.get3DEuclideanDistance(landmarkPos, transformedPos)
-
-    landmarkData.append(landmarksNode.GetNthFiducialLabel(i))
-    landmarkData.append(str(landmarkPos))
-    landmarkData.append(transformedNode.GetNthFiducialLabel(i))
-    landmarkData.append(str(transformedPos))
-    landmarkData.append(landmarkTRE)
-
-    caseData.append(landmarkData)
-
-  return caseData
-
-
-def getFiducialIndexByLabel(node, labelEnd):
-  for index in range(node.GetNumberOfFiducials()):
-    if node.GetNthFiducialLabel(index).endswith(labelEnd):
-      return index
-  return -1
+  index = CaseIndex.load(args.landmarkRootDir, save=False)
+  cases = []
+  for case in index.cases():
+    if int(case) not in validCases:
+      logging.info("Skipping case %s that is not in list of valid cases" % case)
+      continue
+
+    manualTargets = index.path(case, "PreopTargets-transformed-{}-Manual".format(transformType), ".fcsv")
+    automaticTargets = index.path(case, "PreopTargets-transformed-{}-Automatic".format(transformType), ".fcsv")
+
+    if manualTargets and automaticTargets:
+      cases.append((case, manualTargets, automaticTargets))
+    else:
+      print "Data was not found for case %s" % case
+  return calculateCohortLREs(cases)
 
 
 def csv_writer(data, path):
@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+# Persistent index of the Landmarks directory: case -> artifact kind -> path/size/mtime
+#
+# The artifact kind is the file name without case prefix and extension, e.g. "578-TRANSFORM-bSpline-Manual.h5" is
+# indexed as "TRANSFORM-bSpline-Manual" and "578-IntraopAutomatic-label.nrrd" as "IntraopAutomatic-label".
+# On refresh only case directories whose modification time changed get listed again (all of them with deep=True).
+# Overwriting a file (e.g. saving a transform again) does not change the directory modification time, so an indexed
+# file is stat'ed the first time a script asks for it; a case whose file disappeared gets listed again.
+#
+# Scripts that run as steps of RunPipeline.py or as SlicerScheduler.py workers load the index without saving it, so
+# that concurrent processes do not all rewrite the index file; the driving process saves it.
+
+INDEX_FILENAME = ".caseindex.json"
+INDEX_VERSION = 1
+KNOWN_EXTENSIONS = [".nii.gz", ".nrrd", ".fcsv", ".h5", ".tfm", ".csv", ".json", ".nii", ".mrb"]
+
+
+def splitArtifactName(case, fileName):
+  """ Returns (kind, extension) of a file inside of a case directory
+  """
+  stem, extension = fileName, ""
+  for knownExtension in KNOWN_EXTENSIONS:
+    if fileName.lower().endswith(knownExtension):
+      stem, extension = fileName[:-len(knownExtension)], fileName[-len(knownExtension):]
+      break
+  else:
+    stem, extension = os.path.splitext(fileName)
+  prefix = "{}-".format(case)
+  return (stem[len(prefix):] if stem.startswith(prefix) else stem), extension
+
+
+def toNativeStrings(value):
+  """ json returns unicode on python 2 which e.g. SimpleITK does not accept as file name
+  """
+  if sys.version_info[0] >= 3:
+    return value
+  if isinstance(value, dict):
+    return {toNativeStrings(k): toNativeStrings(v) for k, v in value.items()}
+  if isinstance(value, list):
+    return [toNativeStrings(v) for v in value]
+  if isinstance(value, unicode):
+    return value.encode(sys.getfilesystemencoding() or "utf-8")
+  return value
+
+
+def listDirectory(path):
+  """ Returns [(name, isDirectory, size, mtime)] using a single scandir pass where available
+  """
+  entries = []
+  if scandir:
+    for entry in scandir(path):
+      try:
+        isDir = entry.is_dir()
+        stat = entry.stat()
+      except OSError:
+        continue
+      entries.append((entry.name, isDir, stat.st_size, stat.st_mtime))
+  else:
+    for name in os.listdir(path):
+      try:
+        stat = os.stat(os.path.join(path, name))
+      except OSError:
+        continue
+      entries.append((name, os.path.isdir(os.path.join(path, name)), stat.st_size, stat.st_mtime))
+  return entries
+
+
+class CaseIndex(object):
+
+  def __init__(self, rootDir, indexFile=None):
+    self.rootDir = rootDir
+    self.indexFile = indexFile or os.path.join(rootDir, INDEX_FILENAME)
+    self._cases = {}
+    self._checked = set()
+
+  @classmethod
+  def load(cls, rootDir, indexFile=None, refresh=True, deep=False, workers=8, save=True):
+    """ Loads the index from disk (if existing) and refreshes it incrementally
+    """
+    index = cls(rootDir, indexFile)
+    if os.path.exists(index.indexFile):
+      try:
+        with open(index.indexFile) as f:
+          stored = json.load(f)
+        if stored.get("version") == INDEX_VERSION:
+          index._cases = toNativeStrings(stored["cases"])
+      except (ValueError, KeyError, IOError):
+        logging.warn("Ignoring unreadable case index %s" % index.indexFile)
+    if refresh:
+      index.refresh(deep=deep, workers=workers)
+      if save:
+        index.save()
+    return index
+
+  def refresh(self, deep=False, workers=8):
+    """ Re-lists case directories that changed since the last refresh (all of them if deep is True) in parallel
+    """
+    caseDirs = {name: mtime for name, isDir, _, mtime in listDirectory(self.rootDir) if isDir}
+    for case in set(self._cases) - set(caseDirs):
+      del self._cases[case]
+
+    outdated = sorted(case for case, mtime in caseDirs.items()
+                      if deep or case not in self._cases or self._cases[case]["mtime"] != mtime)
+    if not outdated:
+      return
+
+    def scanCase(case):
+      return case, self._scanCase(case, caseDirs[case])
+
+    pool = ThreadPool(max(1, min(workers, len(outdated))))
+    try:
+      for case, data in pool.map(scanCase, outdated):
+        self._setCase(case, data)
+    finally:
+      pool.close()
+      pool.join()
+
+  def _scanCase(self, case, mtime):
+    files = {}
+    for name, isDir, size, fileMtime in listDirectory(os.path.join(self.rootDir, case)):
+      if isDir:
+        continue
+      kind, extension = splitArtifactName(case, name)
+      files[name] = {"kind": kind, "extension": extension, "size": size, "mtime": fileMtime}
+    return {"mtime": mtime, "files": files}
+
+  def _setCase(self, case, data):
+    self._cases[case] = data
+    self._checked.update((case, name) for name in data["files"])
+
+  def _rescanCase(self, case):
+    try:
+      mtime = os.stat(self.caseDirectory(case)).st_mtime
+      self._setCase(case, self._scanCase(case, mtime))
+    except OSError:
+      self._cases.pop(case, None)
+
+  def _checkedEntry(self, case, name):
+    """ Entry of an indexed file with the current size and mtime, None if the file disappeared
+    """
+    entry = self._cases[case]["files"][name]
+    if (case, name) not in self._checked:
+      try:
+        stat = os.stat(os.path.join(self.rootDir, case, name))
+      except OSError:
+        return None
+      entry.update(size=stat.st_size, mtime=stat.st_mtime)
+      self._checked.add((case, name))
+    return entry
+
+  def save(self):
+    data = {"version": INDEX_VERSION, "cases": self._cases}
+    temp = "{}.{}.tmp".format(self.indexFile, os.getpid())
+    try:
+      with open(temp, "w") as f:
+        json.dump(data, f, sort_keys=True)
+      if os.name == "nt" and os.path.exists(self.indexFile):
+        os.remove(self.indexFile)
+      os.rename(temp, self.indexFile)
+    except (IOError, OSError):
+      logging.warn("Could not write case index %s" % self.indexFile)
+
+  def cases(self):
+    """ Case directory names sorted by case number
+    """
+    return sorted(self._cases, key=lambda c: (0, int(c), c) if c.isdigit() else (1, 0, c))
+
+  def artifacts(self, case):
+    """ Returns {kind: {"path", "size", "mtime", "extension"}} of a case
+    """
+    result = {}
+    for name in list(self._cases.get(case, {}).get("files", {})):
+      entry = self._checkedEntry(case, name)
+      if entry is None:
+        self._rescanCase(case)
+        return self.artifacts(case)
+      result[entry["kind"]] = dict(entry, path=os.path.join(self.rootDir, case, name))
+    return result
+
+  def entry(self, case, kind, extension=None):
+    for name, entry in self._cases.get(case, {}).get("files", {}).items():
+      if entry["kind"] == kind and (extension is None or entry["extension"].lower() == extension.lower()):
+        entry = self._checkedEntry(case, name)
+        if entry is None:
+          self._rescanCase(case)
+          return self.entry(case, kind, extension)
+        return dict(entry, path=os.path.join(self.rootDir, case, name))
+    return None
+
+  def path(self, case, kind, extension=None):
+    """ Absolute path of an artifact or None if the case does not hold it
+    """
+    entry = self.entry(case, kind, extension)
+    return entry["path"] if entry else None
+
+  def has(self, case, *kinds):
+    return all(self.entry(case, kind) is not None for kind in kinds)
+
+  def caseDirectory(self, case):
+    return os.path.join(self.rootDir, case)
@@ -1,22 +1,19 @@
 import os
 import sys
 import argparse
-import shutil
-import json
 import logging
-import re
 import slicer
 from collections import OrderedDict
 
 from SliceTrackerUtils.sessionData import *
 
+from DataStaging import SKIPPED, addStagingArguments, createStager
+from Prospective.MetafileStore import MetafileStore
+
 # usage: Slicer --python-script CopyCaseDataToLandmarks.py -cr {ProstateCasesArchive} -ld {LandmarksOutputDirectory}
 
 # Slicer --python-script CopyCaseDataToLandmarks.py -cr ~/Dropbox\ \(Partners\ HealthCare\)/ProstateBiopsyCasesArchive/ -ld ~/Dropbox\ \(Partners\ HealthCare\)/SliceTracker_Evaluation/Landmarks/
 
-META_FILENAME = 'results.json'
-
-
 def main(argv):
 
   # try:
@@ -26,6 +23,9 @@ def main(argv):
   parser.add_argument("-ld", "--output-landmarks-directory", dest = "outputLandmarksDir", metavar = "PATH", default = "-", 
                       required = True,
                       help="Root directory of output holding sub directories named with case numbers")
+  parser.add_argument("-s", "--store", dest="storeFile", metavar="PATH", default=None,
+                      help="SQLite file caching the parsed metafiles (default: in ~/.cache)")
+  addStagingArguments(parser)
   parser.add_argument("-d", "--debug", action='store_true')
 
   args = parser.parse_args(argv)
@@ -35,18 +35,13 @@ def main(argv):
     w = slicer.modules.PyDevRemoteDebugWidget
     w.connectButton.click()
 
-  metafiles = []
-  for root, dirs, files in os.walk(args.caseRootDir):
-    metafiles = metafiles + [os.path.join(root, f) for f in files if META_FILENAME in f]
+  store = MetafileStore.open(args.caseRootDir, args.storeFile)
 
   data = {}
 
-  for metafile in metafiles:
-    caseNumber = re.search('/Case(.+?)-', metafile).group(1)
-    if not os.path.exists(metafile):
-      raise ValueError("Meta file %s does not exist" % metafile)
+  for caseNumber, metafile in store.metafiles():
     try:
-      data[caseNumber] = getData(metafile)
+      data[caseNumber] = getData(metafile, store.load(metafile))
     except Exception:
       logging.warn("Errors while reading metafile %s" % metafile)
       continue
@@ -54,38 +49,37 @@ def main(argv):
   # import pprint
   # pprint.pprint(data)
 
-  copyData(data, args.outputLandmarksDir)
+  copyData(data, args.outputLandmarksDir, createStager(args, args.outputLandmarksDir))
   sys.exit(0)
 
 
-def getData(metafile):
-
-  with open(metafile) as data_file:
-    data = json.load(data_file)
-    logging.debug("Reading metafile %s" % metafile)
-    path = os.path.dirname(metafile)
-
-    sortedResults = OrderedDict(sorted(data["results"].items(),
-                                       key=lambda t: RegistrationResult.getSeriesNumberFromString(t[0])))
-
-    # IMPORTANT: this code is for the OLD SliceTracker version 1.0!
-    for index, (name, jsonResult) in enumerate(sortedResults.iteritems()):
-      if jsonResult["status"] == RegistrationStatus.APPROVED_STATUS and "COVER PROSTATE" in name:
-        return {
-          # "preopVolume": os.path.join(path, jsonResult["movingVolume"]),
-          "preopLabel": os.path.join(path, jsonResult["movingLabel"]),
-          # "intraopVolume": os.path.join(path, jsonResult["fixedVolume"]),
-          "intraopLabel": os.path.join(path, jsonResult["fixedLabel"]),
-          "intraopTargets": os.path.join(path,
-                                         jsonResult["targets"][jsonResult["approvedRegistrationType"]]),
-          "transform": os.path.join(path,
-                                    jsonResult["transforms"][jsonResult["approvedRegistrationType"]])
-        }
+def getData(metafile, data):
+
+  logging.debug("Reading metafile %s" % metafile)
+  path = os.path.dirname(metafile)
+
+  sortedResults = OrderedDict(sorted(data["results"].items(),
+                                     key=lambda t: RegistrationResult.getSeriesNumberFromString(t[0])))
+
+  # IMPORTANT: this code is for the OLD SliceTracker version 1.0!
+  for index, (name, jsonResult) in enumerate(sortedResults.iteritems()):
+    if jsonResult["status"] == RegistrationStatus.APPROVED_STATUS and "COVER PROSTATE" in name:
+      return {
+        # "preopVolume": os.path.join(path, jsonResult["movingVolume"]),
+        "preopLabel": os.path.join(path, jsonResult["movingLabel"]),
+        # "intraopVolume": os.path.join(path, jsonResult["fixedVolume"]),
+        "intraopLabel": os.path.join(path, jsonResult["fixedLabel"]),
+        "intraopTargets": os.path.join(path,
+                                       jsonResult["targets"][jsonResult["approvedRegistrationType"]]),
+        "transform": os.path.join(path,
+                                  jsonResult["transforms"][jsonResult["approvedRegistrationType"]])
+      }
   return None
 
 
-def copyData(data, outputDir):
+def copyData(data, outputDir, stager):
 
+  files = []
   for case, caseData in data.iteritems():
     if not caseData:
       continue
@@ -95,23 +89,14 @@ def copyData(data, outputDir):
       continue
 
     print "processing data of case %s" %case
-    temp = os.path.join(outputCaseDir, "{}-PreopManual-label.nrrd".format(case))
-    if not os.path.exists(temp):
-      copy(caseData["preopLabel"], temp)
-
-    temp = os.path.join(outputCaseDir, "{}-IntraopManual-label.nrrd".format(case))
-    if not os.path.exists(temp):
-      copy(caseData["intraopLabel"], temp)
-
-    temp = os.path.join(outputCaseDir, "{}-Manual-transform.h5".format(case))
-    if not os.path.exists(temp):
-      copy(caseData["transform"], temp)
-    # shutil.copy(caseData["intraopTargets"], os.path.join(outputCaseDir, "{}-IntraopTargets.fcsv".format(case)))
-
-
-def copy(source, destination):
-  print "Copying from %s to %s" % (source, destination)
-  shutil.copy(source, destination)
+    files.append((caseData["preopLabel"], os.path.join(outputCaseDir, "{}-PreopManual-label.nrrd".format(case))))
+    files.append((caseData["intraopLabel"], os.path.join(outputCaseDir, "{}-IntraopManual-label.nrrd".format(case))))
+    files.append((caseData["transform"], os.path.join(outputCaseDir, "{}-Manual-transform.h5".format(case))))
+    # files.append((caseData["intraopTargets"], os.path.join(outputCaseDir, "{}-IntraopTargets.fcsv".format(case))))
+
+  for destination, result in sorted(stager.stageAll(files).items()):
+    if result != SKIPPED:
+      print "%s %s" % (result.capitalize(), destination)
 
 
 if __name__ == "__main__":
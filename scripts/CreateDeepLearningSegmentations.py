@@ -8,13 +8,31 @@ from SlicerDevelopmentToolboxUtils.constants import FileExtension
 from SliceTrackerUtils.sessionData import *
 from SliceTrackerUtils.algorithms.automaticProstateSegmentation import AutomaticSegmentationLogic
 from SliceTrackerRegistration import SliceTrackerRegistrationLogic
+from CaseIndex import CaseIndex
+from HashUtils import fileDigest, digestOf
+from ArtifactCheckpoints import ArtifactCheckpoints
+from LoaderCache import loadVolume, loadLabelVolume
+from SceneUtils import caseScene
 
 # usage: Slicer --python-script CreateDeepLearningSegmentations.py -ld {LandmarksDirectory}
 
 # Slicer --python-script CreateDeepLearningSegmentations.py -ld ~/Dropbox\ \(Partners\ HealthCare\)/Landmarks/
 
+# segmentation and registration of different cases overlapping: python SegmentationPipeline.py -ld {LandmarksDirectory} -sw 2 -rw 4
+
+# parallel: python SlicerScheduler.py -s CreateDeepLearningSegmentations.py -cd {LandmarksDirectory} -w 4 -- -ld {LandmarksDirectory}
+
 META_FILENAME = 'results.json'
 
+STAGE_ALL = "all"
+STAGE_SEGMENT = "segment"
+STAGE_REGISTER = "register"
+STAGES = [STAGE_ALL, STAGE_SEGMENT, STAGE_REGISTER]
+
+REGISTRATION_TYPES = ['rigid', 'affine', 'bSpline']
+
+N4_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "SliceTracker_Evaluation", "n4")
+
 CasesWithoutERC = [474,494,516,532,537,542,545,551,554,557,559,562,564]
 
 
@@ -24,6 +42,22 @@ def main(argv):
   parser.add_argument("-ld", "--landmark-root-directory", dest="landmarkRootDir", metavar="PATH", default="-",
                       required=True,
                       help="Root directory that lists all cases holding information for landmarks")
+  parser.add_argument("-s", "--stage", dest="stage", metavar="NAME", choices=STAGES, default=STAGE_ALL,
+                      help="%(choices)s. Run only the segmentation or registration of the cases, e.g. when driven "
+                           "by SegmentationPipeline.py (default: %(default)s)")
+  parser.add_argument("-c", "--cases", dest="cases", metavar="CASE", nargs="+", default=None,
+                      help="Only process the listed case numbers")
+  parser.add_argument("-n4i", "--n4-iterations", dest="n4Iterations", metavar="N,N,..", default="500,400,300",
+                      help="N4 bias field correction iterations per resolution level (default: %(default)s)")
+  parser.add_argument("-n4s", "--n4-shrink-factor", dest="n4ShrinkFactor", metavar="N", type=int, default=None,
+                      help="N4 shrink factor (default: module default)")
+  parser.add_argument("-n4c", "--n4-convergence-threshold", dest="n4ConvergenceThreshold", metavar="X", type=float,
+                      default=None, help="N4 convergence threshold (default: module default)")
+  parser.add_argument("-n4d", "--n4-cache-directory", dest="n4CacheDir", metavar="PATH", default=N4_CACHE_DIR,
+                      help="Directory holding N4 results keyed by input volume, mask and parameters "
+                           "(default: %(default)s)")
+  parser.add_argument("-f", "--force", action='store_true',
+                      help="Segment and register again even if the results of a case are up to date")
   parser.add_argument("-d", "--debug", action='store_true')
 
   args = parser.parse_args(argv)
@@ -33,25 +67,57 @@ def main(argv):
     w = slicer.modules.PyDevRemoteDebugWidget
     w.connectButton.click()
 
-  for root, dirs, _ in os.walk(args.landmarkRootDir):
-    for case in dirs:
-      findDataAndCreateSegmentations(int(case), os.path.join(root, case))
+  failed = []
+  try:
+    index = CaseIndex.load(args.landmarkRootDir, save=False)
+    for case in index.cases():
+      if args.cases and case not in args.cases:
+        continue
+      try:
+        with caseScene(case):
+          success = findDataAndCreateSegmentations(index, case, args.stage, getN4Options(args), args.force)
+        # cases without data only fail if they were requested explicitly
+        if not success and (success is not None or args.cases):
+          failed.append(case)
+      except Exception, e:
+        print "Case {} failed: {}".format(case, e)
+        failed.append(case)
+    if args.cases:
+      failed += [case for case in args.cases if case not in index.cases()]
+  except Exception, e:
+    print e
+    failed.append(None)
 
   # import pprint
   # pprint.pprint(data)
 
-  sys.exit(0)
+  if failed:
+    print "Failed cases: " + ", ".join(str(case) for case in failed if case is not None)
+  sys.exit(1 if failed else 0)
+
 
+def getN4Options(args):
+  parameters = {'numberOfIterations': args.n4Iterations}
+  if args.n4ShrinkFactor is not None:
+    parameters['shrinkFactor'] = args.n4ShrinkFactor
+  if args.n4ConvergenceThreshold is not None:
+    parameters['convergenceThreshold'] = args.n4ConvergenceThreshold
+  return {"parameters": parameters, "cacheDir": args.n4CacheDir}
 
-def findDataAndCreateSegmentations(caseNumber, directory):
 
-  preopVolume = os.path.join(directory, "{}-Preop.nrrd".format(caseNumber))
-  preopLabel = os.path.join(directory, "{}-PreopManual-label.nrrd".format(caseNumber))
-  intraopVolume = os.path.join(directory, "{}-Intraop.nrrd".format(caseNumber))
-  intraopLabel = os.path.join(directory, "{}-IntraopManual-label.nrrd".format(caseNumber))
+def findDataAndCreateSegmentations(index, case, stage=STAGE_ALL, n4Options=None, force=False):
+  """ Returns True if all outputs of the stage exist, False if a step failed and None if the case data is missing
+  """
+
+  caseNumber = int(case)
+  directory = index.caseDirectory(case)
+  preopVolume = index.path(case, "Preop", ".nrrd")
+  preopLabel = index.path(case, "PreopManual-label", ".nrrd")
+  intraopVolume = index.path(case, "Intraop", ".nrrd")
+  intraopLabel = index.path(case, "IntraopManual-label", ".nrrd")
   usedERC = caseNumber not in CasesWithoutERC
 
-  if all(os.path.exists(f) for f in [preopVolume, intraopVolume, preopLabel, intraopLabel]):
+  if all([preopVolume, intraopVolume, preopLabel, intraopLabel]):
     data = {
       "caseNumber": caseNumber,
       "Preop": {
@@ -72,76 +138,182 @@ def findDataAndCreateSegmentations(caseNumber, directory):
       }
     }
 
-    createSegmentations(data, directory)
-    slicer.mrmlScene.Clear(0)
-    runRegistrations(data, directory)
+    success = True
+    if stage in [STAGE_ALL, STAGE_SEGMENT]:
+      success = createSegmentations(data, directory, force)
+      slicer.mrmlScene.Clear(0)
+    if success and stage in [STAGE_ALL, STAGE_REGISTER]:
+      success = runRegistrations(data, directory, n4Options, force)
+    return success
   else:
     print "Case data was not found for case %s" % caseNumber
+    return None
 
 
-def createSegmentations(data, outputDir):
+def createSegmentations(data, outputDir, force=False):
+    """ Returns True if the automatic labels of both image types exist
+    """
     caseNumber = data["caseNumber"]
+    checkpoints = ArtifactCheckpoints(outputDir)
+    success = True
 
     for imageType in ["Preop", "Intraop"]:
 
       automaticLabelPath = data[imageType]["labels"]["Automatic"]
-      if not os.path.exists(automaticLabelPath):
+      checkpoint = "segmentation-{}".format(imageType)
+      inputs = [data[imageType]["volume"]]
+      parameters = {"used_endorectal_coil": data[imageType]["used_endorectal_coil"]}
+      # labels created before checkpoints were recorded are kept as long as they exist
+      upToDate = checkpoints.isComplete(checkpoint, inputs, parameters) if checkpoints.has(checkpoint) else \
+        os.path.exists(automaticLabelPath)
+      if force or not upToDate:
         logic = AutomaticSegmentationLogic()
         endorectalCoilUsed = "BWH_WITHOUT_ERC" if data[imageType]["used_endorectal_coil"] is False else "BWH_WITH_ERC"
-        success, volume = slicer.util.loadVolume(data[imageType]["volume"], returnNode=True)
+        volume = loadVolume(data[imageType]["volume"])
+        # a label of a previous run must not pass for the result of this one
+        checkpoints.invalidate(checkpoint)
+        if os.path.exists(automaticLabelPath):
+          os.remove(automaticLabelPath)
         automaticLabel = logic.run(volume, domain=endorectalCoilUsed)
         labelName = "{}-{}Automatic-label".format(caseNumber, imageType)
-        ModuleLogicMixin.saveNodeData(automaticLabel, outputDir, FileExtension.NRRD, name=labelName)
+        if automaticLabel:
+          ModuleLogicMixin.saveNodeData(automaticLabel, outputDir, FileExtension.NRRD, name=labelName)
+        if os.path.exists(automaticLabelPath):
+          checkpoints.record(checkpoint, inputs, [automaticLabelPath], parameters)
+        else:
+          print "{} segmentation of case {} failed".format(imageType, caseNumber)
+          success = False
       else:
         print "Not running {} segmentation for case {} because label already exists".format(imageType, caseNumber)
 
       # if not preopAutomaticLabel:
       #   _, preopAutomaticLabel = slicer.util.loadVolume(preopAutomaticLabelPath, returnNode=True)
 
+    return success
+
 
-def runRegistrations(data, destination):
+def getRegistrationCheckpoint(data, segmentationType, n4Options=None):
+  """ Returns (checkpoint name, input files, parameters) of the registration of one segmentation type
+  """
+  inputs = [data["Intraop"]["volume"], data["Intraop"]["labels"][segmentationType],
+            data["Preop"]["volume"], data["Preop"]["labels"][segmentationType]]
+  parameters = {"used_endorectal_coil": data["Preop"]["used_endorectal_coil"]}
+  if data["Preop"]["used_endorectal_coil"] is True:
+    parameters["n4"] = n4Options["parameters"] if n4Options else None
+  return "registration-{}".format(segmentationType), inputs, parameters
+
+
+def getRegistrationOutputs(caseNumber, destination, segmentationType):
+  """ Transform and volume files every registration of one segmentation type has to produce
+  """
+  return [os.path.join(destination, "{}-{}-{}-{}{}".format(caseNumber, kind, regType, segmentationType, extension))
+          for kind, extension in [("TRANSFORM", FileExtension.H5), ("VOLUME", FileExtension.NRRD)]
+          for regType in REGISTRATION_TYPES]
+
+
+def runRegistrations(data, destination, n4Options=None, force=False):
+  """ Returns True if the registrations of all segmentation types are up to date or succeeded
+  """
   caseNumber = data["caseNumber"]
+  checkpoints = ArtifactCheckpoints(destination)
 
-  success, intraopVolume = slicer.util.loadVolume(data["Intraop"]["volume"], returnNode=True)
+  pending = []
+  for segmentationType in [ "Manual", "Automatic"]:
+    checkpoint, inputs, parameters = getRegistrationCheckpoint(data, segmentationType, n4Options)
+    if not force and checkpoints.isComplete(checkpoint, inputs, parameters):
+      print "Not running {} registration for case {} because its results are up to date".format(segmentationType,
+                                                                                                 caseNumber)
+    else:
+      pending.append(segmentationType)
+  if not pending:
+    return True
+
+  success = True
+  intraopVolume = loadVolume(data["Intraop"]["volume"])
   intraopVolume.SetName("{}: IntraopVolume".format(caseNumber))
 
-  for segmentationType in [ "Manual", "Automatic"]:
+  for segmentationType in pending:
 
-    success, preopVolume = slicer.util.loadVolume(data["Preop"]["volume"], returnNode=True)
+    preopVolume = loadVolume(data["Preop"]["volume"])
     preopVolume.SetName("{}: PreopVolume".format(caseNumber))
 
-    success, preopLabel = slicer.util.loadLabelVolume(data["Preop"]["labels"][segmentationType], returnNode=True)
+    preopLabel = loadLabelVolume(data["Preop"]["labels"][segmentationType])
     preopLabel.SetName("{}: PreopManual-label".format(caseNumber))
 
-    success, intraopLabel = slicer.util.loadLabelVolume(data["Intraop"]["labels"][segmentationType], returnNode=True)
+    intraopLabel = loadLabelVolume(data["Intraop"]["labels"][segmentationType])
     intraopLabel.SetName("{}: IntraopManual-label".format(caseNumber))
 
     if data["Preop"]["used_endorectal_coil"] is True:
-      preopVolume = applyBiasCorrection(preopVolume, preopLabel)
+      preopVolume = applyBiasCorrection(preopVolume, preopLabel, data["Preop"]["volume"],
+                                        data["Preop"]["labels"][segmentationType], n4Options)
 
+    # outputs of a previous run must not pass for the results of this one
+    for output in getRegistrationOutputs(caseNumber, destination, segmentationType):
+      if os.path.exists(output):
+        os.remove(output)
     result = runRegistration(intraopVolume, intraopLabel, preopVolume, preopLabel)
 
+    checkpoint, inputs, parameters = getRegistrationCheckpoint(data, segmentationType, n4Options)
     if result:
       for regType, transform in result.transforms.asDict().iteritems():
-        ModuleLogicMixin.saveNodeData(transform, destination, FileExtension.H5,
-                                      name="{}-TRANSFORM-{}-{}".format(caseNumber, regType, segmentationType))
+        name = "{}-TRANSFORM-{}-{}".format(caseNumber, regType, segmentationType)
+        ModuleLogicMixin.saveNodeData(transform, destination, FileExtension.H5, name=name)
 
       for regType, volume in result.volumes.asDict().iteritems():
-        if not regType in ['rigid', 'affine', 'bSpline']:
+        if not regType in REGISTRATION_TYPES:
           continue
-        ModuleLogicMixin.saveNodeData(volume, destination, FileExtension.NRRD,
-                                      name="{}-VOLUME-{}-{}".format(caseNumber, regType, segmentationType))
+        name = "{}-VOLUME-{}-{}".format(caseNumber, regType, segmentationType)
+        ModuleLogicMixin.saveNodeData(volume, destination, FileExtension.NRRD, name=name)
+
+      outputs = getRegistrationOutputs(caseNumber, destination, segmentationType)
+      missing = [o for o in outputs if not os.path.exists(o)]
+      if not missing:
+        checkpoints.record(checkpoint, inputs, outputs, parameters)
+        continue
+      print "{} registration of case {} is incomplete, missing: {}".format(segmentationType, caseNumber,
+                                                                           ", ".join(missing))
+    else:
+      print "{} registration of case {} failed".format(segmentationType, caseNumber)
+    checkpoints.invalidate(checkpoint)
+    success = False
+  return success
+
+def applyBiasCorrection(volume, label, volumeFile=None, labelFile=None, n4Options=None):
+  """ Runs N4 bias field correction. If the input files are given, the result is cached on disk, keyed by the content
+  of volume and mask and the N4 parameters.
+  """
+  n4Options = n4Options or {"parameters": {'numberOfIterations': '500,400,300'}, "cacheDir": N4_CACHE_DIR}
+  name = '{}-N4'.format(volume.GetName())
+
+  cacheFile = None
+  if volumeFile and labelFile:
+    key = digestOf(fileDigest(volumeFile), fileDigest(labelFile), n4Options["parameters"])
+    cacheFile = os.path.join(n4Options["cacheDir"], "{}.nrrd".format(key))
+    if os.path.exists(cacheFile):
+      print "Using cached N4 result {}".format(cacheFile)
+      success, outputVolume = slicer.util.loadVolume(cacheFile, returnNode=True)
+      if success:
+        outputVolume.SetName(name)
+        return outputVolume
 
-def applyBiasCorrection(volume, label):
   outputVolume = slicer.vtkMRMLScalarVolumeNode()
-  outputVolume.SetName('{}-N4'.format(volume.GetName()))
+  outputVolume.SetName(name)
   slicer.mrmlScene.AddNode(outputVolume)
   params = {'inputImageName': volume.GetID(),
             'maskImageName': label.GetID(),
-            'outputImageName': outputVolume.GetID(),
-            'numberOfIterations': '500,400,300'}
+            'outputImageName': outputVolume.GetID()}
+  params.update(n4Options["parameters"])
 
   slicer.cli.run(slicer.modules.n4itkbiasfieldcorrection, None, params, wait_for_completion=True)
+
+  if cacheFile:
+    if not os.path.exists(n4Options["cacheDir"]):
+      os.makedirs(n4Options["cacheDir"])
+    # written under a temporary name first, so that an interrupted run does not leave a broken cache entry
+    tempName = "{}.{}.tmp".format(os.path.splitext(os.path.basename(cacheFile))[0], os.getpid())
+    ModuleLogicMixin.saveNodeData(outputVolume, n4Options["cacheDir"], FileExtension.NRRD, name=tempName)
+    os.rename(os.path.join(n4Options["cacheDir"], tempName + FileExtension.NRRD), cacheFile)
+    outputVolume.SetName(name)
   return outputVolume
 
 def runRegistration(fixedVolume, fixedLabel, movingVolume, movingLabel):
@@ -0,0 +1,161 @@
+import os
+import json
+import shutil
+import logging
+from multiprocessing.pool import ThreadPool
+
+from HashUtils import DigestCache
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# Staging of case data (e.g. archive -> Landmarks or TRE directory). A file is staged by hardlink, reflink (copy on
+# write clone), symlink or copy; modes that are not supported for a file (other file system, no reflink support)
+# fall back to copying. Files are staged in parallel by a thread pool.
+#
+# A destination is up to date if it is the source itself (hardlink/symlink) or if size and streamed checksum match
+# the source. Checksums are remembered by size and mtime in a manifest next to the staged data, so restaging only
+# reads changed files and only transfers files whose content differs.
+#
+# Hardlinked and symlinked files are the archive files: they must not be modified in the staged tree.
+
+MODES = ["copy", "hardlink", "reflink", "symlink"]
+MANIFEST_FILENAME = ".staging.json"
+MANIFEST_VERSION = 1
+DEFAULT_WORKERS = 4
+# ioctl request cloning a file on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+SKIPPED = "skipped"
+STAGED = "staged"
+FAILED = "failed"
+
+
+def reflink(source, destination):
+  if fcntl is None:
+    raise OSError("reflinks are not supported on this platform")
+  with open(source, "rb") as src, open(destination, "wb") as dst:
+    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def hardlink(source, destination):
+  os.link(source, destination)
+
+
+def symlink(source, destination):
+  os.symlink(os.path.abspath(source), destination)
+
+
+def copy(source, destination):
+  shutil.copy2(source, destination)
+
+
+TRANSFERS = {"copy": copy, "hardlink": hardlink, "reflink": reflink, "symlink": symlink}
+
+
+class DataStager(object):
+
+  def __init__(self, mode="copy", workers=DEFAULT_WORKERS, manifestFile=None):
+    if mode not in MODES:
+      raise ValueError("Unknown staging mode %s (one of %s)" % (mode, ", ".join(MODES)))
+    self.mode = mode
+    self.workers = max(1, workers)
+    self.manifestFile = manifestFile
+    self.digests = DigestCache()
+    self._load()
+
+  def _load(self):
+    if not self.manifestFile or not os.path.exists(self.manifestFile):
+      return
+    try:
+      with open(self.manifestFile) as f:
+        stored = json.load(f)
+      if stored.get("version") == MANIFEST_VERSION:
+        self.digests = DigestCache({str(path): entry for path, entry in stored.get("digests", {}).items()})
+    except (ValueError, IOError):
+      logging.warn("Ignoring unreadable staging manifest %s" % self.manifestFile)
+
+  def save(self):
+    if not self.manifestFile:
+      return
+    temp = "{}.{}.tmp".format(self.manifestFile, os.getpid())
+    with open(temp, "w") as f:
+      json.dump({"version": MANIFEST_VERSION, "digests": self.digests.entries}, f, indent=1, sort_keys=True)
+    if os.name == "nt" and os.path.exists(self.manifestFile):
+      os.remove(self.manifestFile)
+    os.rename(temp, self.manifestFile)
+
+  def isStaged(self, source, destination):
+    """ True if destination holds the content of source
+    """
+    if os.path.islink(destination):
+      return os.path.realpath(destination) == os.path.realpath(source)
+    if not os.path.exists(destination):
+      return False
+    if os.path.samefile(source, destination):
+      return True
+    if os.path.getsize(source) != os.path.getsize(destination):
+      return False
+    return self.digests.digest(source) == self.digests.digest(destination)
+
+  def stage(self, source, destination):
+    """ Stages one file and returns SKIPPED, STAGED or FAILED
+    """
+    try:
+      if self.isStaged(source, destination):
+        return SKIPPED
+      temp = "{}.{}.tmp".format(destination, os.getpid())
+      if os.path.lexists(temp):
+        os.remove(temp)
+      try:
+        TRANSFERS[self.mode](source, temp)
+      except (OSError, IOError), e:
+        if self.mode == "copy":
+          raise
+        logging.debug("Cannot %s %s (%s), copying instead" % (self.mode, source, e))
+        if os.path.lexists(temp):
+          os.remove(temp)
+        copy(source, temp)
+      if os.name == "nt" and os.path.lexists(destination):
+        os.remove(destination)
+      os.rename(temp, destination)
+      if not self.isStaged(source, destination):
+        raise IOError("verification of %s failed" % destination)
+      return STAGED
+    except (OSError, IOError), e:
+      logging.warn("Staging %s to %s failed: %s" % (source, destination, e))
+      return FAILED
+
+  def stageAll(self, pairs):
+    """ Stages [(source, destination)] in parallel and returns {destination: result}
+    """
+    pairs = list(pairs)
+    for directory in set(os.path.dirname(destination) for _, destination in pairs):
+      if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    if self.workers > 1 and len(pairs) > 1:
+      pool = ThreadPool(min(self.workers, len(pairs)))
+      try:
+        results = pool.map(lambda pair: self.stage(*pair), pairs)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      results = [self.stage(source, destination) for source, destination in pairs]
+    self.save()
+    staged = sum(1 for result in results if result == STAGED)
+    logging.info("Staged %d of %d files (%s)" % (staged, len(pairs), self.mode))
+    return {destination: result for (_, destination), result in zip(pairs, results)}
+
+
+def addStagingArguments(parser):
+  parser.add_argument("-sm", "--staging-mode", dest="stagingMode", choices=MODES, default="copy",
+                      help="How case data gets staged; unsupported modes fall back to copying (default: %(default)s)")
+  parser.add_argument("-sw", "--staging-workers", dest="stagingWorkers", metavar="N", type=int,
+                      default=DEFAULT_WORKERS, help="Number of files staged concurrently (default: %(default)s)")
+
+
+def createStager(args, outputDir):
+  return DataStager(args.stagingMode, args.stagingWorkers, os.path.join(outputDir, MANIFEST_FILENAME))
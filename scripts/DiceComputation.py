@@ -1,17 +1,29 @@
 import os
 import sys
 import argparse
-import slicer
 import logging
 import csv
-from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
-from SliceTrackerUtils.sessionData import *
+import multiprocessing
 import SimpleITK as sitk
-import sitkUtils
+from CaseIndex import CaseIndex
+from SceneUtils import caseScene
+from LoaderCache import loadLabelVolume
+
+try:
+  import slicer
+  import sitkUtils
+  from SliceTrackerUtils.sessionData import *
+except ImportError:
+  slicer = None
+
+BACKEND_SITK = "sitk"
+BACKEND_SLICER = "slicer"
 
 
 # usage: Slicer.exe --no-main-window --python-script DiceComputation.py -ld {LandmarksDirectory}
 
+# without Slicer: python DiceComputation.py -ld {LandmarksDirectory} -o {OutputFile} -w 8
+
 
 validForRegistrationAccuracy = [278,281,285,295,303,304,306,310,331,333,348,357,358,363,366,370,393,395,398,410,415,416,
                                 417,423,426,437,438,442,444,445,458,461,463,467,469,471,473,474,483,486,494,510,513,514,
@@ -26,10 +38,18 @@ def main(argv):
                         help="Root directory that lists all cases holding information for landmarks")
     parser.add_argument("-o", "--output-file", dest="outputFile", metavar="PATH", default="-", required=True,
                         help="Output csv file")
+    parser.add_argument("-b", "--backend", dest="backend", metavar="NAME", choices=[BACKEND_SITK, BACKEND_SLICER],
+                        default=BACKEND_SITK, help="%(choices)s. sitk resamples and measures overlap in memory, slicer "
+                                                   "uses the BRAINSResample CLI (default: %(default)s)")
+    parser.add_argument("-w", "--workers", dest="workers", metavar="N", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of processes computing label pairs with the sitk backend (default: %(default)s)")
     parser.add_argument("-d", "--debug", action='store_true')
     args = parser.parse_args(argv)
 
-    if args.debug:
+    if args.backend == BACKEND_SLICER and not slicer:
+      raise ValueError("Backend %s needs to be run from within Slicer" % BACKEND_SLICER)
+
+    if args.debug and slicer:
       slicer.app.layoutManager().selectModule("PyDevRemoteDebug")
       w = slicer.modules.PyDevRemoteDebugWidget
       w.connectButton.click()
@@ -46,47 +66,99 @@ def main(argv):
 
 
 def computeDice(args):
+  index = CaseIndex.load(args.landmarkRootDir, save=False)
   data = []
-  for root, dirs, _ in os.walk(args.landmarkRootDir):
-    for case in dirs:
-      caseData =[case]
-      for imageType in ["Preop", "Intraop"]:
-        logging.info("Processing case %s" %case)
-        if int(case) not in validForRegistrationAccuracy:
-          logging.info("Skipping case %s that is not in list of valid cases" % case)
-          continue
-
-        manualLabel = os.path.join(root, case, "{}-{}Manual-label.nrrd".format(case, imageType))
-        automaticLabel = os.path.join(root, case, "{}-{}Automatic-label.nrrd".format(case, imageType))
-
-        if all(os.path.exists(f) for f in [manualLabel, automaticLabel]):
-
-          success, manualLabelNode = slicer.util.loadLabelVolume(manualLabel, returnNode=True)
-          success, automaticLabelNode = slicer.util.loadLabelVolume(automaticLabel, returnNode=True)
-          caseData.append(getDice(manualLabelNode, automaticLabelNode))
-        else:
-          print "Data was not found for case %s" % case
-      data.append(caseData)
+  pairs = []
+  for case in index.cases():
+    caseData =[case]
+    for imageType in ["Preop", "Intraop"]:
+      logging.info("Processing case %s" %case)
+      if int(case) not in validForRegistrationAccuracy:
+        logging.info("Skipping case %s that is not in list of valid cases" % case)
+        continue
+
+      manualLabel = index.path(case, "{}Manual-label".format(imageType), ".nrrd")
+      automaticLabel = index.path(case, "{}Automatic-label".format(imageType), ".nrrd")
+
+      if manualLabel and automaticLabel:
+        pairs.append((caseData, manualLabel, automaticLabel))
+      else:
+        print "Data was not found for case %s" % case
+    data.append(caseData)
+
+  if args.backend == BACKEND_SLICER:
+    values = []
+    for caseData, manualLabel, automaticLabel in pairs:
+      with caseScene(caseData[0]):
+        values.append(getSlicerDice(manualLabel, automaticLabel))
+  else:
+    values = getDiceForFiles([(manualLabel, automaticLabel) for _, manualLabel, automaticLabel in pairs],
+                             args.workers)
+  for (caseData, _, _), value in zip(pairs, values):
+    caseData.append(value)
   return data
 
 
+def getSlicerDice(manualLabel, automaticLabel):
+  manualLabelNode = loadLabelVolume(manualLabel)
+  automaticLabelNode = loadLabelVolume(automaticLabel)
+  return getDice(manualLabelNode, automaticLabelNode)
+
+
+def getDiceForFiles(pairs, workers=1):
+  """ Computes the dice coefficient of all (reference, moving) label file pairs, distributed across processes
+  """
+  if workers > 1 and len(pairs) > 1:
+    pool = multiprocessing.Pool(min(workers, len(pairs)))
+    try:
+      return pool.map(_getDiceForFilePair, pairs)
+    finally:
+      pool.close()
+      pool.join()
+  return [_getDiceForFilePair(pair) for pair in pairs]
+
+
+def _getDiceForFilePair(pair):
+  return getDiceFromFiles(*pair)
+
+
+def getDiceFromFiles(referencePath, movingPath):
+  """ Resamples the moving label onto the reference label grid (nearest neighbor, identity transform, uchar as
+  BRAINSResample did) in memory and returns the dice coefficient
+  """
+  image_reference = sitk.ReadImage(referencePath)
+  image_input = sitk.Resample(sitk.ReadImage(movingPath), image_reference, sitk.Transform(),
+                              sitk.sitkNearestNeighbor, 0, sitk.sitkUInt8)
+  return getLabelOverlapDice(image_reference, image_input)
+
+
 def runBRAINSResample(inputVolume, referenceVolume):
-  params = {'inputVolume': inputVolume, 'referenceVolume': referenceVolume, 'outputVolume': inputVolume,
+  """ Resamples inputVolume onto referenceVolume into a new label node; inputVolume may be shared (LoaderCache)
+  and stays unchanged
+  """
+  outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", inputVolume.GetName() + "-resampled")
+  params = {'inputVolume': inputVolume, 'referenceVolume': referenceVolume, 'outputVolume': outputVolume,
             'interpolationMode': 'NearestNeighbor', 'pixelType':'uchar'}
 
   logging.debug('About to run BRAINSResample CLI with those params: %s' % params)
   slicer.cli.run(slicer.modules.brainsresample, None, params, wait_for_completion=True)
-  return inputVolume
+  return outputVolume
 
 def getDice(reference, moving):
   moving = runBRAINSResample(moving, reference)
+  try:
+    referenceAddress = sitkUtils.GetSlicerITKReadWriteAddress(reference.GetName())
+    image_reference = sitk.ReadImage(referenceAddress)
+
+    movingAddress = sitkUtils.GetSlicerITKReadWriteAddress(moving.GetName())
+    image_input = sitk.ReadImage(movingAddress)
 
-  referenceAddress = sitkUtils.GetSlicerITKReadWriteAddress(reference.GetName())
-  image_reference = sitk.ReadImage(referenceAddress)
+    return getLabelOverlapDice(image_reference, image_input)
+  finally:
+    slicer.mrmlScene.RemoveNode(moving)
 
-  movingAddress = sitkUtils.GetSlicerITKReadWriteAddress(moving.GetName())
-  image_input = sitk.ReadImage(movingAddress)
 
+def getLabelOverlapDice(image_reference, image_input):
   # make sure both labels have the same value
   threshold = sitk.BinaryThresholdImageFilter()
   threshold.SetUpperThreshold(100)
@@ -103,36 +175,6 @@ def getDice(reference, moving):
   return value
 
 
-def calculateLRE(case, landmark, transformed):
-  success, landmarksNode = slicer.util.loadMarkupsFiducialList(landmark, returnNode=True)
-  success, transformedNode = slicer.util.loadMarkupsFiducialList(transformed, returnNode=True)
-
-  caseData = []
-  for i in range(landmarksNode.GetNumberOfFiducials()):
-    landmarkData = [case]
-
-    landmarkPos = ModuleLogicMixin.getTargetPosition(landmarksNode, i)
-    transformedPos = ModuleLogicMixin.getTargetPosition(transformedNode, i)
-    landmarkTRE = ModuleLogicMixin.get3DEuclideanDistance(landmarkPos, transformedPos)
-
-    landmarkData.append(landmarksNode.GetNthFiducialLabel(i))
-    landmarkData.append(str(landmarkPos))
-    landmarkData.append(transformedNode.GetNthFiducialLabel(i))
-    landmarkData.append(str(transformedPos))
-    landmarkData.append(landmarkTRE)
-
-    caseData.append(landmarkData)
-
-  return caseData
-
-
-def getFiducialIndexByLabel(node, labelEnd):
-  for index in range(node.GetNumberOfFiducials()):
-    if node.GetNthFiducialLabel(index).endswith(labelEnd):
-      return index
-  return -1
-
-
 def csv_writer(data, path):
   """
   Write data to a CSV file path
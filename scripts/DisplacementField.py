@@ -0,0 +1,151 @@
+import os
+import json
+import logging
+import numpy as np
+
+from HashUtils import fileDigest, digestOf
+from TransformIO import BSplineTransform, CompositeTransform
+
+# Dense displacement field cache for BSpline transforms. The deformation of a BSpline transform is rasterized once
+# on a regular grid aligned with its coefficient grid and stored as memory mapped .npy file with a json sidecar. The
+# cache gets invalidated when the digest of the source .h5 file changes. Points are then transformed by trilinear
+# interpolation of the field; points outside of the field are evaluated exactly.
+
+FIELD_VERSION = 1
+DEFAULT_RESOLUTION = 1.0
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "SliceTracker_Evaluation", "displacementFields")
+FIELD_DTYPE = np.float32
+
+
+class DisplacementField(object):
+  """ Displacements sampled at BSpline continuous indices c = first + n * step (n = 0..shape-1 per axis), stored with
+  shape (z, y, x, 3)
+  """
+
+  def __init__(self, data, first, step):
+    self.data = data
+    self.first = np.asarray(first, dtype=np.float64)
+    self.step = np.asarray(step, dtype=np.float64)
+    self.shape = np.array(data.shape[2::-1])
+
+  def interpolate(self, cindex):
+    """ Returns (displacements, inside): trilinear interpolation at BSpline continuous indices. Displacements of
+    points outside of the field are zero and flagged in inside.
+    """
+    position = (np.asarray(cindex, dtype=np.float64) - self.first) / self.step
+    inside = np.all((position >= 0) & (position <= self.shape - 1), axis=1)
+    result = np.zeros((len(position), 3))
+    if not np.any(inside):
+      return result, inside
+
+    position = position[inside]
+    lower = np.minimum(np.floor(position).astype(np.int64), np.maximum(self.shape - 2, 0))
+    fraction = position - lower
+    upper = np.minimum(lower + 1, self.shape - 1)
+    values = np.zeros((len(position), 3))
+    for corner in range(8):
+      bits = [(corner >> axis) & 1 for axis in range(3)]
+      index = [np.where(bits[axis], upper[:, axis], lower[:, axis]) for axis in range(3)]
+      weight = np.ones(len(position))
+      for axis in range(3):
+        weight *= fraction[:, axis] if bits[axis] else 1.0 - fraction[:, axis]
+      values += weight[:, None] * self.data[index[2], index[1], index[0]]
+    result[inside] = values
+    return result, inside
+
+
+class FieldBSplineTransform(BSplineTransform):
+  """ BSplineTransform evaluating its deformation from a precomputed displacement field where available
+  """
+
+  def __init__(self, transform, field):
+    self.__dict__.update(transform.__dict__)
+    self.field = field
+
+  def displacements(self, points):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    result, inside = self.field.interpolate(self.continuousIndices(points))
+    if not np.all(inside):
+      result[~inside] = BSplineTransform.displacements(self, points[~inside])
+    return result
+
+
+def fieldGeometry(transform, resolution):
+  """ First sample and step (both in BSpline continuous indices) and number of samples per axis covering the region in
+  which the BSpline deformation is defined (1 <= c < gridSize - 2)
+  """
+  halfOrder = 0.5 * (BSplineTransform.ORDER - 1)
+  first = np.full(3, halfOrder)
+  extent = transform.gridSize - 2 * halfOrder - 1.0
+  step = np.minimum(resolution / transform.gridSpacing, extent)
+  shape = np.maximum(np.ceil(extent / step).astype(np.int64), 1)
+  return first, step, shape
+
+
+def rasterize(transform, path, resolution=DEFAULT_RESOLUTION):
+  """ Evaluates the deformation of transform on the field grid slice by slice and writes it to path (.npy)
+  """
+  first, step, shape = fieldGeometry(transform, resolution)
+  temp = "{}.{}.tmp".format(path, os.getpid())
+  data = np.lib.format.open_memmap(temp, mode="w+", dtype=FIELD_DTYPE, shape=(shape[2], shape[1], shape[0], 3))
+  y, x = np.meshgrid(first[1] + np.arange(shape[1]) * step[1], first[0] + np.arange(shape[0]) * step[0],
+                     indexing="ij")
+  for k in range(shape[2]):
+    cindex = np.column_stack([x.ravel(), y.ravel(), np.full(x.size, first[2] + k * step[2])])
+    data[k] = transform.displacementsAtIndices(cindex).reshape(shape[1], shape[0], 3)
+  data.flush()
+  del data
+  if os.name == "nt" and os.path.exists(path):
+    os.remove(path)
+  os.rename(temp, path)
+  return first, step
+
+
+def cachedDisplacementField(transform, sourceFile, resolution=DEFAULT_RESOLUTION, cacheDir=DEFAULT_CACHE_DIR,
+                            name="0"):
+  """ Returns the DisplacementField of a BSpline transform read from sourceFile, rasterizing it only if there is no
+  cached field for the current content of sourceFile and resolution
+  """
+  if not os.path.exists(cacheDir):
+    os.makedirs(cacheDir)
+  key = digestOf(os.path.abspath(sourceFile), name, resolution)[:16]
+  base = os.path.join(cacheDir, "{}-{}".format(os.path.splitext(os.path.basename(sourceFile))[0], key))
+  fieldFile, sidecarFile = base + ".npy", base + ".json"
+  sourceDigest = fileDigest(sourceFile)
+
+  metadata = None
+  if os.path.exists(fieldFile) and os.path.exists(sidecarFile):
+    try:
+      with open(sidecarFile) as f:
+        metadata = json.load(f)
+    except ValueError:
+      metadata = None
+  if not metadata or metadata.get("version") != FIELD_VERSION or metadata.get("sourceDigest") != sourceDigest:
+    logging.info("Rasterizing displacement field of %s" % sourceFile)
+    first, step = rasterize(transform, fieldFile, resolution)
+    metadata = {"version": FIELD_VERSION, "source": os.path.abspath(sourceFile), "sourceDigest": sourceDigest,
+                "resolution": resolution, "first": first.tolist(), "step": step.tolist()}
+    with open(sidecarFile, "w") as f:
+      json.dump(metadata, f, indent=2, sort_keys=True)
+
+  return DisplacementField(np.load(fieldFile, mmap_mode="r"), metadata["first"], metadata["step"])
+
+
+def withDisplacementFields(transform, sourceFile, resolution=DEFAULT_RESOLUTION, cacheDir=DEFAULT_CACHE_DIR):
+  """ Returns transform with every BSpline transform evaluated from its cached displacement field
+  """
+  if isinstance(transform, CompositeTransform):
+    transforms = []
+    for i, t in enumerate(transform.transforms):
+      if isinstance(t, BSplineTransform):
+        t = FieldBSplineTransform(t, cachedDisplacementField(t, sourceFile, resolution, cacheDir, name=str(i)))
+      transforms.append(t)
+    return CompositeTransform(transforms)
+  if isinstance(transform, BSplineTransform):
+    return FieldBSplineTransform(transform, cachedDisplacementField(transform, sourceFile, resolution, cacheDir))
+  return transform
+
+
+def readTransformWithDisplacementFields(path, resolution=DEFAULT_RESOLUTION, cacheDir=DEFAULT_CACHE_DIR):
+  from LoaderCache import readTransform
+  return withDisplacementFields(readTransform(path), path, resolution, cacheDir)
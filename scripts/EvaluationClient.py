@@ -0,0 +1,107 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+
+from EvaluationDaemon import DEFAULT_PORT, HOST, SCRIPTS_DIR, readToken
+from SlicerScheduler import getSlicerExecutable
+
+# Thin client of EvaluationDaemon.py: sends a job to the running daemon, prints its output while it runs and exits
+# with the exit code of the job. Everything after -- is passed to the script. Requests are authenticated with the
+# token the daemon wrote for its port, so only the user running the daemon can submit jobs.
+
+# usage: python EvaluationClient.py -p 8765 -s {Script} -- {script arguments}
+
+# python EvaluationClient.py -s CalculateTargetingSensitivity.py -- -ld {LandmarksDirectory} -o Targeting_Sensitivity_Manual_Automatic.csv
+
+# start the daemon if it is not running yet: python EvaluationClient.py -a -s ...
+# stop the daemon: python EvaluationClient.py --shutdown
+
+STARTUP_TIMEOUT = 300
+
+
+def main(argv):
+
+  scriptArgs = []
+  if "--" in argv:
+    scriptArgs = argv[argv.index("--") + 1:]
+    argv = argv[:argv.index("--")]
+
+  parser = argparse.ArgumentParser(description="Slicetracker evaluation daemon client")
+  parser.add_argument("-p", "--port", dest="port", metavar="PORT", type=int, default=DEFAULT_PORT,
+                      help="Port of the evaluation daemon (default: %(default)s)")
+  parser.add_argument("-s", "--script", dest="script", metavar="PATH", default=None,
+                      help="Script to run, relative to the scripts directory or an absolute path inside of it")
+  parser.add_argument("-a", "--autostart", action='store_true',
+                      help="Start the daemon in a headless Slicer if it is not running")
+  parser.add_argument("-se", "--slicer-executable", dest="slicerExecutable", metavar="PATH", default=None,
+                      help="Slicer executable used by --autostart (default: $SLICER_EXECUTABLE or Slicer)")
+  parser.add_argument("--shutdown", action='store_true', help="Stop the daemon")
+  args = parser.parse_args(argv)
+
+  if args.shutdown:
+    request = {"command": "shutdown"}
+  elif args.script:
+    request = {"script": scriptPath(args.script), "argv": scriptArgs, "cwd": os.getcwd()}
+  else:
+    parser.error("Either --script or --shutdown is required")
+
+  if args.autostart and not args.shutdown and not isRunning(args.port):
+    startDaemon(args.slicerExecutable or getSlicerExecutable(), args.port)
+
+  sys.exit(submit(request, args.port))
+
+
+def scriptPath(script):
+  """ Path of script relative to the scripts directory, as the daemon only runs scripts inside of it
+  """
+  if os.path.isabs(script):
+    return os.path.relpath(os.path.realpath(script), os.path.realpath(SCRIPTS_DIR))
+  return script
+
+
+def connect(port):
+  return socket.create_connection((HOST, port))
+
+
+def isRunning(port):
+  try:
+    return submit({"command": "ping"}, port) == 0
+  except socket.error:
+    return False
+
+
+def startDaemon(executable, port, timeout=STARTUP_TIMEOUT):
+  daemon = os.path.join(os.path.dirname(os.path.abspath(__file__)), "EvaluationDaemon.py")
+  subprocess.Popen([executable, "--no-main-window", "--python-script", daemon, "-p", str(port)])
+  start = time.time()
+  while not isRunning(port):
+    if time.time() - start > timeout:
+      raise RuntimeError("Evaluation daemon did not start within %d seconds" % timeout)
+    time.sleep(1)
+
+
+def submit(request, port, output=sys.stdout):
+  """ Sends request to the daemon, writes streamed output and returns the exit code of the job
+  """
+  connection = connect(port)
+  try:
+    connection.sendall(json.dumps(dict(request, token=readToken(port))) + "\n")
+    stream = connection.makefile("r")
+    for line in stream:
+      message = json.loads(line)
+      if "output" in message:
+        output.write(message["output"])
+        output.flush()
+      if "exitCode" in message:
+        return message["exitCode"]
+    raise RuntimeError("Connection to evaluation daemon closed before the job finished")
+  finally:
+    connection.close()
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,225 @@
+import os
+import sys
+import imp
+import hmac
+import json
+import argparse
+import logging
+import traceback
+import SocketServer
+
+from CaseIndex import toNativeStrings
+from LoaderCache import releaseRemovedNodes
+
+try:
+  import slicer
+except ImportError:
+  slicer = None
+
+# Long running (headless) Slicer process executing evaluation scripts on request, so that Slicer and its modules are
+# only started once. A job names a script of this directory and its arguments. The script's main(argv) runs in a clean
+# scene, its output is streamed back to the client and the exit code passed to sys.exit is reported at the end.
+#
+# Protocol (one json object per line):
+#   request:   {"script": "ApplyTransformations.py", "argv": [...], "cwd": "...", "token": "..."} or
+#              {"command": "ping"|"shutdown", "token": "..."}
+#   responses: {"output": "..."} while the job runs, followed by {"exitCode": N}
+#
+# Only scripts inside of this directory can be run (relative paths without ".."). Every request has to carry the
+# token the daemon writes on startup to a file only readable by its owner (see tokenFile), so that other users of the
+# machine cannot run jobs as the owner of the daemon.
+
+# usage: Slicer --no-main-window --python-script EvaluationDaemon.py -p 8765
+
+# jobs are sent with EvaluationClient.py, e.g.: python EvaluationClient.py -p 8765 -s ApplyTransformations.py -- -ld {LandmarksDirectory} -st Manual -tt bSpline -ft Targets
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PORT = 8765
+HOST = "127.0.0.1"
+JOB_MODULE_PREFIX = "evaluationjob_"
+TOKEN_DIR = os.path.join(os.path.expanduser("~"), ".cache", "SliceTracker_Evaluation")
+
+
+def tokenFile(port):
+  return os.path.join(TOKEN_DIR, "daemon-{}.token".format(port))
+
+
+def readToken(port):
+  """ Token of the daemon listening on port, None if it cannot be read
+  """
+  try:
+    with open(tokenFile(port)) as f:
+      return f.read().strip()
+  except IOError:
+    return None
+
+
+def writeToken(port):
+  """ Creates a new random token, readable by the current user only
+  """
+  if not os.path.exists(TOKEN_DIR):
+    os.makedirs(TOKEN_DIR)
+  path = tokenFile(port)
+  if os.path.exists(path):
+    os.remove(path)
+  token = os.urandom(16).encode("hex")
+  descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+  with os.fdopen(descriptor, "w") as f:
+    f.write(token)
+  return token
+
+
+def isValidToken(expected, token):
+  if not isinstance(token, str):
+    return False
+  compare = getattr(hmac, "compare_digest", lambda a, b: a == b)
+  return compare(expected, token)
+
+
+def resolveScript(script):
+  """ Absolute path of a script given relative to SCRIPTS_DIR. Raises ValueError for paths outside of it.
+  """
+  if not script or os.path.isabs(script) or ".." in script.replace("\\", "/").split("/"):
+    raise ValueError("Only scripts inside of {} can be run: {}".format(SCRIPTS_DIR, script))
+  path = os.path.realpath(os.path.join(SCRIPTS_DIR, script))
+  if not path.startswith(os.path.realpath(SCRIPTS_DIR) + os.sep) or not path.endswith(".py") or \
+     not os.path.isfile(path):
+    raise ValueError("Not a script of {}: {}".format(SCRIPTS_DIR, script))
+  return path
+
+
+def main(argv):
+
+  parser = argparse.ArgumentParser(description="Slicetracker evaluation daemon")
+  parser.add_argument("-p", "--port", dest="port", metavar="PORT", type=int, default=DEFAULT_PORT,
+                      help="Local port to listen on (default: %(default)s)")
+  args = parser.parse_args(argv)
+
+  server = EvaluationServer((HOST, args.port), JobHandler)
+  server.token = writeToken(args.port)
+  print "Evaluation daemon listening on {}:{}".format(HOST, args.port)
+  try:
+    while not server.stopped:
+      server.handle_request()
+  finally:
+    server.server_close()
+    if readToken(args.port) == server.token:
+      os.remove(tokenFile(args.port))
+  sys.exit(0)
+
+
+class EvaluationServer(SocketServer.TCPServer):
+  """ Handles one job at a time in the main thread, as Slicer is not thread safe
+  """
+
+  allow_reuse_address = True
+
+  def __init__(self, address, handlerClass):
+    SocketServer.TCPServer.__init__(self, address, handlerClass)
+    self.moduleTimes = {}
+    self.stopped = False
+    self.token = None
+
+
+class StreamWriter(object):
+  """ File like object sending everything written to it to the client
+  """
+
+  def __init__(self, connection):
+    self.connection = connection
+
+  def write(self, text):
+    if text:
+      send(self.connection, {"output": text})
+
+  def flush(self):
+    pass
+
+
+def send(connection, message):
+  connection.sendall(json.dumps(message) + "\n")
+
+
+class JobHandler(SocketServer.StreamRequestHandler):
+
+  def handle(self):
+    line = self.rfile.readline()
+    if not line:
+      return
+    try:
+      request = toNativeStrings(json.loads(line))
+    except ValueError:
+      send(self.connection, {"output": "Invalid request\n", "exitCode": 2})
+      return
+    if not isinstance(request, dict) or not isValidToken(self.server.token, request.get("token")):
+      send(self.connection, {"output": "Invalid token\n", "exitCode": 2})
+      return
+
+    command = request.get("command")
+    if command == "ping":
+      send(self.connection, {"exitCode": 0})
+    elif command == "shutdown":
+      send(self.connection, {"exitCode": 0})
+      self.server.stopped = True
+    else:
+      try:
+        path = resolveScript(request.get("script"))
+      except ValueError, e:
+        send(self.connection, {"output": "{}\n".format(e), "exitCode": 2})
+        return
+      exitCode = runJob(self.server, path, request.get("argv", []), request.get("cwd"), StreamWriter(self.connection))
+      send(self.connection, {"exitCode": exitCode})
+
+
+def runJob(server, path, argv, cwd, writer):
+  """ Runs main(argv) of the script at path with stdout, stderr and logging redirected to writer. Returns the exit
+  code.
+  """
+  stdout, stderr, oldArgv, oldCwd = sys.stdout, sys.stderr, sys.argv, os.getcwd()
+  handler = logging.StreamHandler(writer)
+  logging.getLogger().addHandler(handler)
+  sys.stdout = sys.stderr = writer
+  sys.argv = [path] + argv
+  exitCode = 0
+  if slicer:
+    slicer.mrmlScene.Clear(0)
+  try:
+    if cwd:
+      os.chdir(cwd)
+    reloadChangedModules(server.moduleTimes)
+    module = imp.load_source(JOB_MODULE_PREFIX + os.path.splitext(os.path.basename(path))[0], path)
+    module.main(argv)
+  except SystemExit, e:
+    exitCode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+  except Exception:
+    traceback.print_exc(file=writer)
+    exitCode = 1
+  finally:
+    sys.stdout, sys.stderr, sys.argv = stdout, stderr, oldArgv
+    logging.getLogger().removeHandler(handler)
+    os.chdir(oldCwd)
+    if slicer:
+      slicer.mrmlScene.Clear(0)
+      releaseRemovedNodes()
+  return exitCode
+
+
+def reloadChangedModules(moduleTimes):
+  """ Reloads helper modules of this directory (e.g. FiducialIO) that were modified since the previous job
+  """
+  for name, module in sys.modules.items():
+    sourceFile = getattr(module, "__file__", None)
+    if not sourceFile or not os.path.abspath(sourceFile).startswith(SCRIPTS_DIR):
+      continue
+    sourceFile = os.path.splitext(sourceFile)[0] + ".py"
+    if not os.path.exists(sourceFile) or name == "__main__" or name.startswith(JOB_MODULE_PREFIX):
+      continue
+    mtime = os.path.getmtime(sourceFile)
+    if name in moduleTimes and moduleTimes[name] != mtime:
+      logging.info("Reloading modified module %s" % name)
+      reload(module)
+    moduleTimes[name] = mtime
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,104 @@
+import csv
+import logging
+import numpy as np
+
+# Slicer independent reading/writing of markups fiducial files (.fcsv) and vectorized distance computation
+
+FCSV_VERSION = "4.6"
+DEFAULT_COLUMNS = ["id", "x", "y", "z", "ow", "ox", "oy", "oz", "vis", "sel", "lock", "label", "desc",
+                   "associatedNodeID"]
+
+
+def readFCSV(path):
+  """ Reads a fcsv file and returns an (N,3) array of RAS positions and the list of fiducial labels
+  """
+  columns = DEFAULT_COLUMNS
+  lps = False
+  positions = []
+  labels = []
+  with open(path, "rb") as fcsv:
+    for line in fcsv:
+      if line.startswith("#"):
+        key, _, value = line[1:].partition("=")
+        key, value = key.strip().lower(), value.strip()
+        if key == "columns":
+          columns = [c.strip() for c in value.split(",")]
+        elif key == "coordinatesystem":
+          lps = value in ["1", "LPS"]
+        continue
+      if not line.strip():
+        continue
+      row = next(csv.reader([line]))
+      entry = dict(zip(columns, row))
+      positions.append([float(entry["x"]), float(entry["y"]), float(entry["z"])])
+      labels.append(entry.get("label", ""))
+
+  points = np.array(positions, dtype=np.float64).reshape(-1, 3)
+  if lps:
+    points[:, :2] *= -1
+  return points, labels
+
+
+def writeFCSV(path, points, labels=None, descriptions=None, locked=False):
+  """ Writes RAS positions as Slicer markups fiducial file. Labels default to F-1, F-2, ...
+  """
+  points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+  if labels is None:
+    labels = ["F-{}".format(i + 1) for i in range(len(points))]
+  if descriptions is None:
+    descriptions = [""] * len(points)
+
+  with open(path, "wb") as fcsv:
+    fcsv.write("# Markups fiducial file version = {}\n".format(FCSV_VERSION))
+    fcsv.write("# CoordinateSystem = 0\n")
+    fcsv.write("# columns = {}\n".format(",".join(DEFAULT_COLUMNS)))
+    writer = csv.writer(fcsv, delimiter=",", lineterminator="\n")
+    for index, (point, label, description) in enumerate(zip(points, labels, descriptions)):
+      writer.writerow(["vtkMRMLMarkupsFiducialNode_{}".format(index)] + [repr(float(v)) for v in point] +
+                      [0, 0, 0, 1, 1, 1, 1 if locked else 0, label, description, ""])
+
+
+def pairedDistances(fixed, moving):
+  """ Euclidean distances between corresponding rows of two (N,3) arrays
+  """
+  return np.sqrt(np.sum((np.asarray(fixed) - np.asarray(moving)) ** 2, axis=1))
+
+
+def cohortDistances(pairs):
+  """ Computes the distances of all fiducial pairs of a cohort in one array operation.
+
+  pairs is a list of (fixedPoints, movingPoints) tuples, e.g. one per case. Both arrays of a pair are truncated to the
+  shorter one. Returns a list holding the distance array of each pair.
+  """
+  counts = [min(len(fixed), len(moving)) for fixed, moving in pairs]
+  if not sum(counts):
+    return [np.zeros(0) for _ in pairs]
+  fixed = np.concatenate([np.asarray(f)[:n].reshape(-1, 3) for (f, _), n in zip(pairs, counts)])
+  moving = np.concatenate([np.asarray(m)[:n].reshape(-1, 3) for (_, m), n in zip(pairs, counts)])
+  return np.split(pairedDistances(fixed, moving), np.cumsum(counts)[:-1])
+
+
+def calculateCohortLREs(cases):
+  """ Reads all fiducial file pairs and returns csv rows [case, fixed label, fixed position, moving label,
+  moving position, distance] for every fiducial of the cohort.
+
+  cases is a list of (case, fixedFile, movingFile) tuples
+  """
+  from LoaderCache import readFCSV as readCachedFCSV
+
+  loaded = []
+  for case, fixedFile, movingFile in cases:
+    fixed, fixedLabels = readCachedFCSV(fixedFile)
+    moving, movingLabels = readCachedFCSV(movingFile)
+    if len(fixed) != len(moving):
+      logging.warn("Case %s: number of fiducials differs (%d vs %d)" % (case, len(fixed), len(moving)))
+    loaded.append((case, fixed, fixedLabels, moving, movingLabels))
+
+  distances = cohortDistances([(fixed, moving) for _, fixed, _, moving, _ in loaded])
+
+  data = []
+  for (case, fixed, fixedLabels, moving, movingLabels), caseDistances in zip(loaded, distances):
+    for i, distance in enumerate(caseDistances):
+      data.append([case, fixedLabels[i], str([float(v) for v in fixed[i]]), movingLabels[i],
+                   str([float(v) for v in moving[i]]), float(distance)])
+  return data
@@ -0,0 +1,48 @@
+import os
+import json
+import hashlib
+
+# Content hashing helpers shared by the caching/incremental parts of the evaluation scripts
+
+BLOCK_SIZE = 1 << 20
+
+
+def fileDigest(path, algorithm="sha1", blockSize=BLOCK_SIZE):
+  """ Streams a file through the hash function and returns the hex digest
+  """
+  digest = hashlib.new(algorithm)
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(blockSize), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def digestOf(*parts):
+  """ Hex digest of json serializable values, e.g. parameters together with file digests
+  """
+  return hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class DigestCache(object):
+  """ Remembers file digests by path, size and mtime so unchanged files are not read again.
+
+  entries is a plain dict which can be stored as json by the owner of the cache.
+  """
+
+  def __init__(self, entries=None):
+    self.entries = entries if entries is not None else {}
+
+  def digest(self, path):
+    """ Returns the digest of path or None if it does not exist
+    """
+    try:
+      stat = os.stat(path)
+    except OSError:
+      self.entries.pop(path, None)
+      return None
+    entry = self.entries.get(path)
+    if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+      return entry["digest"]
+    digest = fileDigest(path)
+    self.entries[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "digest": digest}
+    return digest
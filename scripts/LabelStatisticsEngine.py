@@ -0,0 +1,192 @@
+import logging
+import numpy as np
+
+from NrrdIO import NrrdFile, CHUNK_VOXELS
+
+# Statistics for every label value of one or more label volumes, computed in a single streamed pass over the label
+# files and the (shared) intensity volume. Results are columnar: {column name: array with one entry per label}.
+#
+# Voxels of a chunk are binned by label value: counts, index and intensity sums come from np.bincount, bounding boxes
+# from (index, label) presence tables, so a chunk is processed in linear time without sorting.
+
+COLUMNS = ["Label", "Count", "Volume mm^3", "Volume cc",
+           "BBox_Min_I", "BBox_Min_J", "BBox_Min_K", "BBox_Max_I", "BBox_Max_J", "BBox_Max_K",
+           "Centroid_R", "Centroid_A", "Centroid_S",
+           "Mean", "StdDev", "Min", "Max"]
+INTEGER_COLUMNS = ["Count", "BBox_Min_I", "BBox_Min_J", "BBox_Min_K", "BBox_Max_I", "BBox_Max_J", "BBox_Max_K"]
+# label value ranges up to this size are binned directly by value
+MAX_LABEL_RANGE = 1 << 20
+# chunks with up to this many different labels get their extents by masking instead of np.minimum.at
+MASKED_LABELS = 16
+# largest (axis size x label range) table for the bounding box extents
+MAX_PRESENCE_TABLE = 1 << 24
+
+
+def labelBins(labels):
+  """ Returns (label value of every bin, bin of every voxel, number of bins). Integer labels are binned by their offset
+  from the smallest label, so no sorting is needed; other labels (or huge label ranges) fall back to np.unique.
+  """
+  if labels.dtype.kind in "iub":
+    low, high = int(labels.min()), int(labels.max())
+    if high - low < MAX_LABEL_RANGE:
+      bins = labels.astype(np.intp)
+      if low:
+        bins -= low
+      return np.arange(low, high + 1), bins, high - low + 1
+  values, bins = np.unique(labels, return_inverse=True)
+  return values, bins, len(values)
+
+
+def groupMinMax(values, bins, present, binCount):
+  """ (minimum, maximum) of values per present bin. With few labels per chunk (the usual case) one mask per label is
+  cheaper than np.minimum.at/np.maximum.at.
+  """
+  if len(present) <= MASKED_LABELS:
+    selections = [values[bins == b] for b in present]
+    return np.array([v.min() for v in selections]), np.array([v.max() for v in selections])
+  minimum = np.full(binCount, np.inf)
+  maximum = np.full(binCount, -np.inf)
+  np.minimum.at(minimum, bins, values)
+  np.maximum.at(maximum, bins, values)
+  return minimum[present], maximum[present]
+
+
+def indexExtents(indices, size, bins, present, binCount):
+  """ (first, last) voxel index along one axis per present bin, from a (index, bin) presence table counted with
+  np.bincount
+  """
+  if size * binCount > MAX_PRESENCE_TABLE:
+    return groupMinMax(indices, bins, present, binCount)
+  table = np.bincount(indices * binCount + bins, minlength=size * binCount).reshape(size, binCount)[:, present] > 0
+  first = np.argmax(table, axis=0)
+  last = size - 1 - np.argmax(table[::-1], axis=0)
+  return first, last
+
+
+class LabelStatisticsAccumulator(object):
+  """ Accumulates per label statistics over chunks of a label volume given in file order (i running fastest)
+  """
+
+  def __init__(self, sizes, voxelVolume=1.0, ijkToRAS=None):
+    self.sizes = [int(s) for s in sizes[:3]]
+    self.voxelVolume = voxelVolume
+    self.ijkToRAS = np.identity(4) if ijkToRAS is None else np.asarray(ijkToRAS)
+    self.offset = 0
+    self._labels = {}
+
+  def update(self, labels, intensities=None):
+    labels = np.asarray(labels).reshape(-1)
+    n = len(labels)
+    if not n:
+      return
+    if intensities is not None:
+      intensities = np.asarray(intensities, dtype=np.float64).reshape(-1)
+
+    # bin every voxel of the chunk by label value: counts and sums with np.bincount, extents grouped by bin
+    values, bins, binCount = labelBins(labels)
+    counts = np.bincount(bins, minlength=binCount)
+    present = np.flatnonzero(counts)
+
+    flat = self.offset + np.arange(n)
+    sx, sy = self.sizes[0], self.sizes[1]
+    indices = [flat % sx, (flat // sx) % sy, flat // (sx * sy)]
+    extents = [indexExtents(idx, size, bins, present, binCount) for idx, size in zip(indices, self.sizes)]
+
+    stats = {
+      "count": counts[present],
+      "sum": [np.bincount(bins, weights=idx, minlength=binCount)[present] for idx in indices],
+      "min": [extent[0] for extent in extents],
+      "max": [extent[1] for extent in extents]
+    }
+    if intensities is not None:
+      stats["iSum"] = np.bincount(bins, weights=intensities, minlength=binCount)[present]
+      stats["iSumSq"] = np.bincount(bins, weights=intensities * intensities, minlength=binCount)[present]
+      stats["iMin"], stats["iMax"] = groupMinMax(intensities, bins, present, binCount)
+
+    for position, label in enumerate(values[present].tolist()):
+      self._merge(label, stats, position, intensities is not None)
+    self.offset += n
+
+  def _merge(self, label, stats, p, withIntensities):
+    entry = self._labels.get(label)
+    current = {
+      "count": int(stats["count"][p]),
+      "sum": np.array([s[p] for s in stats["sum"]]),
+      "min": np.array([m[p] for m in stats["min"]]),
+      "max": np.array([m[p] for m in stats["max"]])
+    }
+    if withIntensities:
+      current.update({k: float(stats[k][p]) for k in ["iSum", "iSumSq", "iMin", "iMax"]})
+    if entry is None:
+      self._labels[label] = current
+      return
+    entry["count"] += current["count"]
+    entry["sum"] += current["sum"]
+    entry["min"] = np.minimum(entry["min"], current["min"])
+    entry["max"] = np.maximum(entry["max"], current["max"])
+    if withIntensities and "iSum" in entry:
+      entry["iSum"] += current["iSum"]
+      entry["iSumSq"] += current["iSumSq"]
+      entry["iMin"] = min(entry["iMin"], current["iMin"])
+      entry["iMax"] = max(entry["iMax"], current["iMax"])
+
+  def result(self):
+    """ Columnar statistics sorted by label value
+    """
+    labels = sorted(self._labels)
+    table = {column: np.full(len(labels), np.nan) for column in COLUMNS}
+    table["Label"] = np.array(labels)
+    for column in INTEGER_COLUMNS:
+      table[column] = np.zeros(len(labels), dtype=np.int64)
+    for row, label in enumerate(labels):
+      entry = self._labels[label]
+      count = entry["count"]
+      centroid = self.ijkToRAS.dot(np.append(entry["sum"] / count, 1.0))[:3]
+      values = [label, count, count * self.voxelVolume, count * self.voxelVolume / 1000.0] + \
+               list(entry["min"]) + list(entry["max"]) + list(centroid)
+      if "iSum" in entry:
+        mean = entry["iSum"] / count
+        values += [mean, np.sqrt(max(0.0, entry["iSumSq"] / count - mean * mean)), entry["iMin"], entry["iMax"]]
+      for column, value in zip(COLUMNS, values):
+        table[column][row] = value
+    return table
+
+
+def sameGrid(a, b, tolerance=1e-4):
+  """ True if two nrrd files have the same sizes, spacing, origin and directions
+  """
+  return list(a.sizes[:3]) == list(b.sizes[:3]) and np.allclose(a.ijkToRAS(), b.ijkToRAS(), atol=tolerance)
+
+
+def computeLabelStatistics(labelFiles, intensityFile=None, chunkVoxels=CHUNK_VOXELS):
+  """ Returns one columnar statistics table per label file. All label files and the intensity volume are read once,
+  in lockstep. Intensity statistics are skipped (NaN) for labels whose grid (sizes, spacing, origin or directions)
+  differs from the intensity volume.
+  """
+  labels = [NrrdFile(f) for f in labelFiles]
+  accumulators = [LabelStatisticsAccumulator(l.sizes, l.voxelVolume, l.ijkToRAS()) for l in labels]
+
+  intensity = NrrdFile(intensityFile) if intensityFile else None
+  if intensity:
+    matching = [sameGrid(l, intensity) for l in labels]
+    for labelFile, match in zip(labelFiles, matching):
+      if not match:
+        logging.warn("Label %s does not match the intensity volume grid, skipping intensity statistics" % labelFile)
+    if not any(matching):
+      intensity = None
+
+  if intensity:
+    intensityChunks = intensity.iterChunks(chunkVoxels)
+    matchingIterators = [(l.iterChunks(chunkVoxels), a) for l, a, m in zip(labels, accumulators, matching) if m]
+    for intensityChunk in intensityChunks:
+      for iterator, accumulator in matchingIterators:
+        accumulator.update(next(iterator), intensityChunk)
+    others = [(l, a) for l, a, m in zip(labels, accumulators, matching) if not m]
+  else:
+    others = list(zip(labels, accumulators))
+
+  for label, accumulator in others:
+    for chunk in label.iterChunks(chunkVoxels):
+      accumulator.update(chunk)
+
+  return [accumulator.result() for accumulator in accumulators]
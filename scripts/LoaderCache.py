@@ -0,0 +1,158 @@
+import os
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+  import slicer
+except ImportError:
+  slicer = None
+
+# Process wide LRU cache of loaded files, keyed by path, size and modification time, so that no file gets decoded
+# twice in a run (or in subsequent jobs of EvaluationDaemon.py). Entries are evicted least recently used first once
+# the estimated memory of all entries exceeds the budget.
+#
+# Cached objects are shared: callers must not modify them. Slicer nodes are only returned while they are still part
+# of the scene, otherwise they get loaded again. Nodes removed from the scene (e.g. by SceneUtils.caseScene) have to
+# be released with releaseRemovedNodes, so that the cache does not keep their image data alive. Markups fiducial
+# nodes are not cached since transforms get hardened into them.
+
+BUDGET_ENVIRONMENT_VARIABLE = "SLICETRACKER_LOADER_CACHE_MB"
+DEFAULT_BUDGET = int(os.environ.get(BUDGET_ENVIRONMENT_VARIABLE, 2048)) * 1024 * 1024
+NODE_KINDS = ["slicer-volume", "slicer-label", "slicer-transform"]
+
+
+def fileKey(kind, path):
+  stat = os.stat(path)
+  return kind, os.path.abspath(path), stat.st_size, stat.st_mtime
+
+
+def estimateSize(value, depth=0):
+  """ Rough memory footprint in bytes (numpy arrays, containers and objects holding them)
+  """
+  if isinstance(value, np.ndarray):
+    return value.nbytes
+  if depth > 4:
+    return 0
+  if isinstance(value, dict):
+    return sum(estimateSize(v, depth + 1) for v in value.values())
+  if isinstance(value, (list, tuple)):
+    return sum(estimateSize(v, depth + 1) for v in value)
+  if isinstance(value, basestring):
+    return len(value)
+  if hasattr(value, "__dict__"):
+    return estimateSize(vars(value), depth + 1)
+  return 64
+
+
+class LoaderCache(object):
+
+  def __init__(self, budget=DEFAULT_BUDGET):
+    self.budget = budget
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+
+  def get(self, kind, path, loader, sizeOf=estimateSize, isValid=None):
+    """ Returns the cached result of loader(path) or calls the loader if path changed/was not loaded yet
+    """
+    key = fileKey(kind, path)
+    if key in self._entries:
+      value, size = self._entries.pop(key)
+      if isValid is None or isValid(value):
+        self._entries[key] = (value, size)
+        self.hits += 1
+        return value
+      self.size -= size
+    self.misses += 1
+    value = loader(path)
+    size = sizeOf(value)
+    self._removeOutdated(kind, key[1])
+    if size <= self.budget:
+      self._entries[key] = (value, size)
+      self.size += size
+      self._evict()
+    return value
+
+  def _removeOutdated(self, kind, path):
+    for key in [k for k in self._entries if k[:2] == (kind, path)]:
+      self.size -= self._entries.pop(key)[1]
+
+  def _evict(self):
+    while self.size > self.budget and self._entries:
+      key, (_, size) = self._entries.popitem(last=False)
+      self.size -= size
+      logging.debug("Evicting %s from loader cache" % key[1])
+
+  def setBudget(self, budget):
+    self.budget = budget
+    self._evict()
+
+  def discard(self, predicate):
+    """ Drops all entries whose (kind, value) matches predicate and returns their number
+    """
+    keys = [key for key, (value, _) in self._entries.items() if predicate(key[0], value)]
+    for key in keys:
+      self.size -= self._entries.pop(key)[1]
+    return len(keys)
+
+  def clear(self):
+    self._entries.clear()
+    self.size = 0
+
+
+CACHE = LoaderCache()
+
+
+def readFCSV(path):
+  """ Cached FiducialIO.readFCSV
+  """
+  from FiducialIO import readFCSV as read
+  return CACHE.get("fcsv", path, read)
+
+
+def readTransform(path):
+  """ Cached TransformIO.readTransform
+  """
+  from TransformIO import readTransform as read
+  return CACHE.get("transform", path, read)
+
+
+def isInScene(node):
+  return node is not None and slicer.mrmlScene.IsNodePresent(node)
+
+
+def releaseRemovedNodes():
+  """ Drops the cached Slicer nodes that are no longer part of the scene
+  """
+  if slicer is None:
+    return 0
+  return CACHE.discard(lambda kind, value: kind in NODE_KINDS and not isInScene(value))
+
+
+def nodeSize(node):
+  imageData = node.GetImageData() if hasattr(node, "GetImageData") else None
+  return imageData.GetActualMemorySize() * 1024 if imageData else 1024
+
+
+def loadVolume(path):
+  """ Cached slicer.util.loadVolume. Returns the node (None if loading failed)
+  """
+  return CACHE.get("slicer-volume", path, lambda p: slicer.util.loadVolume(p, returnNode=True)[1],
+                   sizeOf=nodeSize, isValid=isInScene)
+
+
+def loadLabelVolume(path):
+  """ Cached slicer.util.loadLabelVolume. Returns the node (None if loading failed)
+  """
+  return CACHE.get("slicer-label", path, lambda p: slicer.util.loadLabelVolume(p, returnNode=True)[1],
+                   sizeOf=nodeSize, isValid=isInScene)
+
+
+def loadTransform(path):
+  """ Cached slicer.util.loadTransform. Returns the node (None if loading failed)
+  """
+  return CACHE.get("slicer-transform", path, lambda p: slicer.util.loadTransform(p, returnNode=True)[1],
+                   sizeOf=lambda node: 1024 * 1024, isValid=isInScene)
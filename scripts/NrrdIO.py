@@ -0,0 +1,197 @@
+import os
+import re
+import gzip
+import numpy as np
+
+# Slicer independent access to nrrd files: the header gets parsed for geometry and data type, raw data is memory
+# mapped and compressed data is streamed in chunks, so voxels can be processed without loading whole volumes.
+
+NRRD_TYPES = {
+  "i1": ["signed char", "int8", "int8_t"],
+  "u1": ["uchar", "unsigned char", "uint8", "uint8_t"],
+  "i2": ["short", "short int", "signed short", "signed short int", "int16", "int16_t"],
+  "u2": ["ushort", "unsigned short", "unsigned short int", "uint16", "uint16_t"],
+  "i4": ["int", "signed int", "int32", "int32_t"],
+  "u4": ["uint", "unsigned int", "uint32", "uint32_t"],
+  "i8": ["longlong", "long long", "long long int", "signed long long", "signed long long int", "int64", "int64_t"],
+  "u8": ["ulonglong", "unsigned long long", "unsigned long long int", "uint64", "uint64_t"],
+  "f4": ["float"],
+  "f8": ["double"]
+}
+TYPE_LOOKUP = {name: code for code, names in NRRD_TYPES.items() for name in names}
+
+CHUNK_VOXELS = 1 << 22
+
+
+def parseVector(value):
+  return [float(v) for v in value.strip().strip("()").split(",")]
+
+
+class NrrdFile(object):
+  """ Header of a nrrd/nhdr file plus lazy access to its voxel data (x running fastest)
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.fields = {}
+    self.keyValues = {}
+    self._readHeader()
+
+  def _readHeader(self):
+    with open(self.path, "rb") as f:
+      magic = f.readline()
+      if not magic.startswith(b"NRRD"):
+        raise ValueError("%s is not a nrrd file" % self.path)
+      while True:
+        line = f.readline()
+        if not line or not line.strip():
+          break
+        line = line.decode("latin-1").rstrip("\r\n")
+        if line.startswith("#"):
+          continue
+        if ":=" in line:
+          key, value = line.split(":=", 1)
+          self.keyValues[key] = value
+        else:
+          key, value = line.split(":", 1)
+          self.fields[key.strip().lower()] = value.strip()
+      self.headerSize = f.tell()
+
+    self.sizes = [int(s) for s in self.fields["sizes"].split()]
+    typeName = self.fields["type"].lower()
+    if typeName not in TYPE_LOOKUP:
+      raise ValueError("Unsupported nrrd type %s" % typeName)
+    byteOrder = ">" if self.fields.get("endian", "little") == "big" else "<"
+    self.dtype = np.dtype(byteOrder + TYPE_LOOKUP[typeName])
+    self.encoding = self.fields.get("encoding", "raw").lower()
+
+  @property
+  def spaceDirections(self):
+    """ 3x3 matrix, column j is the direction (including spacing) of axis j. Non spatial axes are skipped.
+    """
+    if "space directions" in self.fields:
+      vectors = [parseVector(v) for v in re.findall(r"\([^)]*\)", self.fields["space directions"])]
+      return np.array(vectors, dtype=np.float64).T
+    spacings = [float(s) for s in self.fields.get("spacings", "1 1 1").split() if s.lower() != "nan"]
+    return np.diag(spacings[:3])
+
+  @property
+  def spaceOrigin(self):
+    if "space origin" in self.fields:
+      return np.array(parseVector(self.fields["space origin"]))
+    return np.zeros(3)
+
+  @property
+  def space(self):
+    return self.fields.get("space", "left-posterior-superior").lower()
+
+  @property
+  def spacing(self):
+    return np.sqrt(np.sum(self.spaceDirections ** 2, axis=0))
+
+  @property
+  def voxelVolume(self):
+    """ Volume of one voxel in mm^3 (product of spacings, as Slicer computes it)
+    """
+    return float(np.prod(self.spacing))
+
+  @property
+  def numberOfVoxels(self):
+    return int(np.prod(self.sizes))
+
+  def ijkToRAS(self):
+    """ 4x4 matrix mapping voxel indices (i, j, k) to RAS
+    """
+    matrix = np.identity(4)
+    matrix[:3, :3] = self.spaceDirections
+    matrix[:3, 3] = self.spaceOrigin
+    if self.space in ["left-posterior-superior", "lps"]:
+      matrix[:2, :] *= -1
+    return matrix
+
+  def _dataFile(self):
+    dataFile = self.fields.get("data file", self.fields.get("datafile"))
+    if not dataFile:
+      return self.path, self.headerSize
+    if dataFile.upper().startswith("LIST") or "%" in dataFile:
+      raise ValueError("Multi file nrrd data is not supported: %s" % self.path)
+    return os.path.join(os.path.dirname(self.path), dataFile), 0
+
+  def _openStream(self):
+    path, offset = self._dataFile()
+    f = open(path, "rb")
+    f.seek(offset)
+    lineSkip = int(self.fields.get("line skip", 0))
+    for _ in range(lineSkip):
+      f.readline()
+    if self.encoding in ["gzip", "gz"]:
+      return f, gzip.GzipFile(fileobj=f, mode="rb")
+    elif self.encoding == "raw":
+      return f, f
+    f.close()
+    raise ValueError("Unsupported nrrd encoding %s" % self.encoding)
+
+  def _byteSkip(self):
+    byteSkip = int(self.fields.get("byte skip", 0))
+    if byteSkip == -1:
+      path, offset = self._dataFile()
+      return os.path.getsize(path) - offset - self.numberOfVoxels * self.dtype.itemsize
+    return byteSkip
+
+  def memmap(self):
+    """ Memory maps raw encoded data, shape is (k, j, i)
+    """
+    if self.encoding != "raw":
+      raise ValueError("Only raw encoded nrrd data can be memory mapped")
+    path, offset = self._dataFile()
+    return np.memmap(path, dtype=self.dtype, mode="r", offset=offset + self._byteSkip(),
+                     shape=tuple(reversed(self.sizes)))
+
+  def iterChunks(self, chunkVoxels=CHUNK_VOXELS):
+    """ Yields the voxel data as flat arrays in file order (i running fastest) with a bounded memory footprint
+    """
+    if self.encoding == "raw":
+      flat = self.memmap().reshape(-1)
+      for start in range(0, len(flat), chunkVoxels):
+        yield np.asarray(flat[start:start + chunkVoxels])
+      return
+
+    f, stream = self._openStream()
+    try:
+      skip = self._byteSkip()
+      while skip > 0:
+        skip -= len(stream.read(min(skip, CHUNK_VOXELS)))
+      remaining = self.numberOfVoxels * self.dtype.itemsize
+      chunkBytes = chunkVoxels * self.dtype.itemsize
+      while remaining > 0:
+        data = stream.read(min(chunkBytes, remaining))
+        if not data:
+          raise IOError("Unexpected end of nrrd data in %s" % self.path)
+        remaining -= len(data)
+        yield np.frombuffer(data, dtype=self.dtype)
+    finally:
+      f.close()
+
+  def array(self):
+    """ Whole voxel array with shape (k, j, i)
+    """
+    if self.encoding == "raw":
+      return self.memmap()
+    return np.concatenate(list(self.iterChunks())).reshape(tuple(reversed(self.sizes)))
+
+
+def countLabelVoxels(path):
+  """ Returns {label value: voxel count} of a label volume in one sequential pass
+  """
+  nrrd = NrrdFile(path)
+  counts = {}
+  for chunk in nrrd.iterChunks():
+    if chunk.dtype.kind in "ui" and (chunk.size == 0 or chunk.min() >= 0):
+      for value, count in enumerate(np.bincount(chunk.astype(np.int64))):
+        if count:
+          counts[value] = counts.get(value, 0) + int(count)
+    else:
+      values, valueCounts = np.unique(chunk, return_counts=True)
+      for value, count in zip(values.tolist(), valueCounts):
+        counts[value] = counts.get(value, 0) + int(count)
+  return counts
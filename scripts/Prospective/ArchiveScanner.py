@@ -0,0 +1,142 @@
+import os
+import re
+import sys
+import json
+import hashlib
+import logging
+from multiprocessing.pool import ThreadPool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from CaseIndex import listDirectory, toNativeStrings
+
+# Discovery of the metafiles (results.json) of a case archive. The archive gets scanned level by level with the
+# directories of a level listed concurrently (the archive usually is a network share, so listing is latency bound).
+# Directories that never hold metafiles (DICOM, preprocessed data, hidden directories) are not descended into.
+#
+# Listings are cached per directory together with its modification time. Since the modification time of a directory
+# changes whenever entries are added, removed or renamed, a directory is only listed again if it changed; unchanged
+# directories are taken from the cache, so a rescan only stats the directories along the tree.
+
+META_FILENAME = 'results.json'
+SCAN_VERSION = 1
+DEFAULT_WORKERS = 16
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "SliceTracker_Evaluation")
+PRUNED_DIRECTORIES = ["DICOM", "mpReviewPreprocessed"]
+
+
+def getCaseNumber(metafile):
+  match = re.search(re.escape(os.path.sep) + r'Case(.+?)-', metafile)
+  return match.group(1) if match else None
+
+
+def isPruned(name, pruned):
+  return name.startswith(".") or name in pruned
+
+
+class ArchiveScanner(object):
+
+  def __init__(self, cacheFile=None, workers=DEFAULT_WORKERS, pruned=PRUNED_DIRECTORIES):
+    self.cacheFile = cacheFile
+    self.workers = max(1, workers)
+    self.pruned = set(pruned)
+    self.listings = {}
+    self.listed = 0
+
+  @staticmethod
+  def defaultCacheFile(caseRootDir):
+    key = hashlib.sha1(os.path.abspath(caseRootDir)).hexdigest()[:16]
+    return os.path.join(DEFAULT_CACHE_DIR, "archive-{}.json".format(key))
+
+  def _load(self):
+    self.listings = {}
+    if not self.cacheFile or not os.path.exists(self.cacheFile):
+      return
+    try:
+      with open(self.cacheFile) as f:
+        stored = json.load(f)
+      if stored.get("version") == SCAN_VERSION and stored.get("pruned") == sorted(self.pruned):
+        self.listings = toNativeStrings(stored.get("listings", {}))
+    except (ValueError, IOError):
+      logging.warn("Ignoring unreadable archive scan cache %s" % self.cacheFile)
+
+  def _save(self):
+    if not self.cacheFile:
+      return
+    directory = os.path.dirname(self.cacheFile)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    temp = "{}.{}.tmp".format(self.cacheFile, os.getpid())
+    with open(temp, "w") as f:
+      json.dump({"version": SCAN_VERSION, "pruned": sorted(self.pruned), "listings": self.listings}, f)
+    if os.name == "nt" and os.path.exists(self.cacheFile):
+      os.remove(self.cacheFile)
+    os.rename(temp, self.cacheFile)
+
+  def _list(self, path):
+    """ Returns (path, listing) with listing {"mtime", "dirs": [names], "metafiles": [names]}
+    """
+    try:
+      mtime = os.stat(path).st_mtime
+      cached = self.listings.get(path)
+      if cached and cached["mtime"] == mtime:
+        return path, cached
+      entries = listDirectory(path)
+    except OSError, e:
+      logging.warn("Cannot list %s: %s" % (path, e))
+      return path, None
+    return path, {
+      "mtime": mtime,
+      "dirs": sorted(name for name, isDir, _, _ in entries if isDir and not isPruned(name, self.pruned)),
+      "metafiles": sorted(name for name, isDir, _, _ in entries if not isDir and META_FILENAME in name),
+      "listed": True
+    }
+
+  def scan(self, caseRootDir):
+    """ Returns [(case number, metafile path)] sorted by path. Metafiles outside of Case{number}-... directories
+    are skipped.
+    """
+    root = os.path.abspath(caseRootDir)
+    self._load()
+    self.listed = 0
+    listings = {}
+    frontier = [root]
+    pool = ThreadPool(self.workers) if self.workers > 1 else None
+    try:
+      while frontier:
+        results = pool.map(self._list, frontier) if pool and len(frontier) > 1 else map(self._list, frontier)
+        frontier = []
+        for path, listing in results:
+          if listing is None:
+            continue
+          if listing.pop("listed", False):
+            self.listed += 1
+          listings[path] = listing
+          frontier += [os.path.join(path, name) for name in listing["dirs"]]
+    finally:
+      if pool:
+        pool.close()
+        pool.join()
+
+    # listings outside of root belong to other archives sharing the cache file
+    self.listings = {path: listing for path, listing in self.listings.items()
+                     if not (path == root or path.startswith(root + os.path.sep))}
+    self.listings.update(listings)
+    self._save()
+    logging.debug("Scanned %d directories of %s, listed %d" % (len(listings), root, self.listed))
+
+    records = []
+    for path in sorted(listings):
+      for name in listings[path]["metafiles"]:
+        metafile = os.path.join(path, name)
+        caseNumber = getCaseNumber(metafile)
+        if caseNumber is None:
+          logging.debug("Skipping metafile %s outside of a case directory" % metafile)
+          continue
+        records.append((caseNumber, metafile))
+    return records
+
+
+def scanArchive(caseRootDir, cacheFile=None, workers=DEFAULT_WORKERS):
+  """ [(case number, metafile path)] of caseRootDir, cached in ~/.cache unless cacheFile is given
+  """
+  return ArchiveScanner(cacheFile or ArchiveScanner.defaultCacheFile(caseRootDir), workers).scan(caseRootDir)
@@ -1,15 +1,17 @@
 import os
 import sys
 import argparse
-import slicer
-import json
-import re
 import csv
 from datetime import datetime
-from SliceTrackerUtils.sessionData import *
 
+try:
+  import slicer
+except ImportError:
+  slicer = None
+
+from MetafileStore import MetafileStore
+from WorkflowLatency import writeLatencyReports
 
-META_FILENAME = 'results.json'
 
 # Slicer --python-script CollectProspectiveData.py -cr {case root} -o {output directory}
 
@@ -22,18 +24,22 @@ def main(argv):
                         help="Root directory that holds cases")
     parser.add_argument("-o", "--output-dir", dest="outputDir", metavar="PATH", default="-", required=True,
                         help="Output csv file directory")
+    parser.add_argument("-s", "--store", dest="storeFile", metavar="PATH", default=None,
+                        help="SQLite file caching the parsed metafiles (default: in ~/.cache)")
+    parser.add_argument("-w", "--workers", dest="workers", metavar="N", type=int, default=None,
+                        help="Number of processes parsing new or modified metafiles (default: number of cpus)")
+    parser.add_argument("-l", "--latencies", action='store_true',
+                        help="Additionally write workflow latencies with their percentiles and histograms")
     parser.add_argument("-d", "--debug", action='store_true')
 
     args = parser.parse_args(argv)
 
-    if args.debug:
+    if args.debug and slicer:
       slicer.app.layoutManager().selectModule("PyDevRemoteDebug")
       w = slicer.modules.PyDevRemoteDebugWidget
       w.connectButton.click()
 
-    metafiles = []
-    for root, dirs, files in os.walk(args.caseRootDir):
-      metafiles += [os.path.join(root, f) for f in files if META_FILENAME in f]
+    store = MetafileStore.open(args.caseRootDir, args.storeFile, workers=args.workers)
 
     # data = {}
     """
@@ -44,8 +50,10 @@ def main(argv):
     * Number of needle images per case
     """
 
-    csv_writer(collect_results(metafiles), os.path.join(args.outputDir, "results.csv"))
-    csv_writer(collect_general_case_information(metafiles), os.path.join(args.outputDir, "general_case_nfo.csv"))
+    csv_writer(collect_results(store), os.path.join(args.outputDir, "results.csv"))
+    csv_writer(collect_general_case_information(store), os.path.join(args.outputDir, "general_case_nfo.csv"))
+    if args.latencies:
+      writeLatencyReports(store, args.outputDir)
 
 
   except Exception, e:
@@ -54,61 +62,60 @@ def main(argv):
   sys.exit(0)
 
 
-def collect_general_case_information(metafiles):
+def collect_general_case_information(store):
   csvData = [
     ['Case', 'Start_Time', 'Completed_Time', 'Preop_used', 'ERC', 'Segmentation_Algorithm', 'Segmentation_Started_Time',
      'Segmentation_Completed_Time', 'User_modified', 'Modification_Started_Time', 'Modification_Completed_Time']]
 
-  for metafile in metafiles:
-    caseNumber = re.search(os.path.sep + r'Case(.+?)-', metafile).group(1)
-    print caseNumber
-    with open(metafile) as data_file:
-      data = json.load(data_file)
-      events = data['procedureEvents']
-      caseData = list([caseNumber, formatTime(events['caseStarted']), formatTime(events['caseCompleted']['time'])])
-      caseData.append(data.has_key("preop"))
-      if not data.has_key("preop"):
-        caseData += ['']*4
-      else:
-        preop = data["preop"]
-        caseData.append(preop["usedERC"])
-
-        caseData += get_segmentation_information(preop['segmentation'])
-
-      csvData.append(caseData)
+  rows = store.query("""
+    SELECT m.case_number, e.case_started, e.case_completed, p.path IS NOT NULL, p.used_erc, p.algorithm, p.start_time,
+           p.end_time, p.user_modified, p.modification_start_time, p.modification_end_time
+    FROM metafiles m
+    JOIN procedure_events e ON e.path = m.path
+    LEFT JOIN preop_segmentation p ON p.path = m.path
+    WHERE m.case_number IS NOT NULL
+    ORDER BY m.path""")
+
+  for row in rows:
+    caseNumber, started, completed, preopUsed = row[:4]
+    caseData = [caseNumber, formatTime(started), formatTime(completed), bool(preopUsed)]
+    if not preopUsed:
+      caseData += ['']*4
+    else:
+      caseData.append(bool(row[4]))
+      caseData += get_segmentation_information(row[5:])
+    csvData.append(caseData)
 
   return csvData
 
 
-def collect_results(metafiles):
+def collect_results(store):
   csvData = [
     ['Case', 'Series_Number', 'Series_Description', 'Series_Type', 'Time(Received)', 'Status', 'Time', 'Consent_given',
      'Registration_Type', 'Segmentation_Algorithm', 'Segmentation_Started_Time', 'Segmentation_Completed_Time',
      'User_modified', 'Modification_Started_Time', 'Modification_Completed_Time']]
 
-  for metafile in metafiles:
-    caseNumber = re.search(os.path.sep + r'Case(.+?)-', metafile).group(1)
-    with open(metafile) as data_file:
-      data = json.load(data_file)
-      for result in data["results"]:
-        caseData = [caseNumber]
-        name, description = result["name"].split(": ")
-        caseData.append(name)
-        caseData.append(description)
-        caseData.append(result['series']['type'])
-        caseData.append(formatTime(result['series']['receivedTime']))
-        status = result["status"]
-        caseData.append(status["state"])
-        caseData.append(formatTime(status["time"]))
-        caseData.append(status["consentGivenBy"] if status.has_key("consentGivenBy") else None)
-        caseData.append(status["registrationType"] if status.has_key("registrationType") else None)
-
-        if result.has_key('segmentation'):
-          caseData += get_segmentation_information(result['segmentation'])
-        else:
-          caseData += [''] * 4
-
-        csvData.append(caseData)
+  rows = store.query("""
+    SELECT case_number, series_number, series_description, series_type, received_time, state, status_time,
+           consent_given_by, registration_type, has_segmentation, segmentation_algorithm, segmentation_start_time,
+           segmentation_end_time, user_modified, modification_start_time, modification_end_time
+    FROM results
+    WHERE case_number IS NOT NULL
+    ORDER BY path, position""")
+
+  for row in rows:
+    caseData = list(row[:4])
+    caseData.append(formatTime(row[4]))
+    caseData.append(row[5])
+    caseData.append(formatTime(row[6]))
+    caseData += [row[7], row[8]]
+
+    if row[9]:
+      caseData += get_segmentation_information(row[10:])
+    else:
+      caseData += [''] * 4
+
+    csvData.append(caseData)
 
   return csvData
 
@@ -121,17 +128,21 @@ def formatTime(t):
     return t
 
 
-def get_segmentation_information(root):
+def get_segmentation_information(columns):
+  """ columns: algorithm, start time, end time, user modified, modification start and end time as stored by
+  MetafileStore
+  """
+  algorithm, startTime, endTime, modified, modificationStartTime, modificationEndTime = columns
   data = list()
-  data.append(root["algorithm"])
-  data.append(formatTime(root["startTime"]))
-  data.append(formatTime(root["endTime"]))
+  data.append(algorithm)
+  data.append(formatTime(startTime))
+  data.append(formatTime(endTime))
 
-  modified = root.has_key('userModified')
+  modified = bool(modified)
   data.append(modified)
   if modified:
-    data.append(formatTime(root['userModified']['startTime']))
-    data.append(formatTime(root['userModified']['endTime']))
+    data.append(formatTime(modificationStartTime))
+    data.append(formatTime(modificationEndTime))
   return data
 
 
@@ -3,28 +3,31 @@ import os
 import json
 import csv
 import re
-import vtk
 import argparse
 import logging
 import slicer
 from collections import OrderedDict
-import shutil
-import numpy as np
-import SimpleITK as sitk
 
 from SliceTrackerUtils.sessionData import *
-from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
-from SlicerDevelopmentToolboxUtils.constants import FileExtension
 
 import DeepInfer
-import CurveMaker
+
+from MetafileStore import MetafileStore
+from NeedleCenterline import CenterLinePoints
+from NeedleDistance import distancesToCurves
+from NeedleSegmentation import DockerNeedleRunner, StubNeedleRunner, needleJob
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DataStaging import FAILED, STAGED, addStagingArguments, createStager
+from FiducialIO import readFCSV, writeFCSV
 
 # usage: Slicer --python-script CopyNeedleImagesAndData.py -cr {ProstateCasesArchive} -od {outputCaseDirectory}
 
 # Slicer --python-script CopyNeedleImagesAndData.py  -cr "/Users/christian/Dropbox (Partners HealthCare)/SliceTracker_Evaluation/Prospective/ClinicalCases" -od "/Users/christian/Dropbox (Partners HealthCare)/SliceTracker_Evaluation/Prospective/TRE" -o "/Users/christian/Dropbox (Partners HealthCare)/SliceTracker_Evaluation/Prospective/TRE.csv"
 
-META_FILENAME = 'results.json'
+# parallel: python SlicerScheduler.py -s Prospective/CopyNeedleImagesAndData.py -ca {ProstateCasesArchive} -w 4 -o {OutputFile} -- -cr {ProstateCasesArchive} -od {outputCaseDirectory} -o {OutputFile}
 
+# needle segmentation in 2 docker sessions: ... -ns 2, without docker (local stub model for testing): ... -nr stub
 
 def main(argv):
 
@@ -37,6 +40,15 @@ def main(argv):
                       help="Root directory of output holding sub directories named with case numbers")
   parser.add_argument("-o", "--output-file", dest="outputFile", metavar="PATH", default="-", required=True,
                       help="Output csv file")
+  parser.add_argument("-c", "--cases", dest="cases", metavar="CASE", nargs="+", default=None,
+                      help="Only process the listed case numbers")
+  parser.add_argument("-s", "--store", dest="storeFile", metavar="PATH", default=None,
+                      help="SQLite file caching the parsed metafiles (default: in ~/.cache)")
+  parser.add_argument("-nr", "--needle-runner", dest="needleRunner", choices=["docker", "stub"], default="docker",
+                      help="Needle segmentation by the DeepInfer docker model or a local stub (default: %(default)s)")
+  parser.add_argument("-ns", "--needle-sessions", dest="needleSessions", metavar="N", type=int, default=1,
+                      help="Number of concurrent needle segmentation sessions (default: %(default)s)")
+  addStagingArguments(parser)
   parser.add_argument("-d", "--debug", action='store_true')
 
   args = parser.parse_args(argv)
@@ -46,18 +58,15 @@ def main(argv):
     w = slicer.modules.PyDevRemoteDebugWidget
     w.connectButton.click()
 
-  metafiles = []
-  for root, dirs, files in os.walk(args.caseRootDir):
-    metafiles = metafiles + [os.path.join(root, f) for f in files if META_FILENAME in f]
+  store = MetafileStore.open(args.caseRootDir, args.storeFile)
 
   data = {}
 
-  for metafile in metafiles:
-    caseNumber = re.search('/Case(.+?)-', metafile).group(1)
-    if not os.path.exists(metafile):
-      raise ValueError("Meta file %s does not exist" % metafile)
+  for caseNumber, metafile in store.metafiles():
+    if args.cases and caseNumber not in args.cases:
+      continue
     try:
-      data[caseNumber] = getData(metafile)
+      data[caseNumber] = getData(store, metafile)
     except Exception:
       logging.warn("Errors while reading metafile %s" % metafile)
       continue
@@ -65,7 +74,8 @@ def main(argv):
   # import pprint
   # pprint.pprint(data)
 
-  csvData = copyData(data, args.outputCaseDirectory)
+  csvData = copyData(data, args.outputCaseDirectory, createNeedleRunner(args.needleRunner, args.needleSessions),
+                     createStager(args, args.outputCaseDirectory))
 
   csv_writer(csvData, os.path.join(args.outputCaseDirectory, args.outputFile))
 
@@ -82,29 +92,28 @@ def csv_writer(data, path):
       writer.writerow(line)
 
 
-def getData(metafile):
+def getData(store, metafile):
   needle_data = []
-
-  with open(metafile) as data_file:
-    data = json.load(data_file)
-    logging.debug("Reading metafile %s" % metafile)
-    path = os.path.dirname(metafile)
-
-    for result in data["results"]:
-      if result["status"]["state"] == RegistrationStatus.APPROVED_STATUS and result["series"]["type"] == "GUIDANCE":
-        needle_data.append({
-          "seriesNumber": RegistrationResult.getSeriesNumberFromString(result["name"]),
-          "path": path,
-          "label": result["labels"]["fixed"],
-          "volume": result["volumes"]["fixed"],
-          "targets": result["targets"]["approved"]["fileName"] # TODO: what about user modified?
-        })
+  logging.debug("Reading metafile %s" % metafile)
+  path = os.path.dirname(metafile)
+
+  rows = store.query("SELECT name, label_fixed, volume_fixed, targets_approved FROM results "
+                     "WHERE path = ? AND state = ? AND series_type = 'GUIDANCE' ORDER BY position",
+                     (metafile, RegistrationStatus.APPROVED_STATUS))
+  for name, label, volume, targets in rows:
+    needle_data.append({
+      "seriesNumber": RegistrationResult.getSeriesNumberFromString(name),
+      "path": path,
+      "label": label,
+      "volume": volume,
+      "targets": targets # TODO: what about user modified?
+    })
   return needle_data
 
 
-def copyData(data, outputDir):
-
-  logic = DeepInfer.DeepInferLogic()
+def createNeedleRunner(kind, sessions=1):
+  if kind == "stub":
+    return StubNeedleRunner(sessions)
   parameters = DeepInfer.ModelParameters()
   segmenter_json_file = os.path.join(DeepInfer.JSON_LOCAL_DIR, "ProstateNeedleFinder.json")
   with open(segmenter_json_file, "r") as fp:
@@ -112,6 +121,50 @@ def copyData(data, outputDir):
 
   iodict = parameters.create_iodict(j)
   dockerName, modelName, dataPath = parameters.create_model_info(j)
+  return DockerNeedleRunner(dockerName, dataPath, iodict, params={'InferenceType': 'Ensemble'}, sessions=sessions)
+
+
+def stageData(data, outputDir, stager):
+  """ Stages label, volume and targets of all guidance series and returns the needle segmentation jobs of the series
+  without needle label
+  """
+  files = []
+  for case, caseData in data.iteritems():
+    for series in caseData or []:
+      for key, name in [("label", "label.nrrd"), ("volume", "volume.nrrd"), ("targets", "targets.fcsv")]:
+        files.append((os.path.join(series["path"], series[key]),
+                      os.path.join(outputDir, case, "{}-{}".format(series["seriesNumber"], name))))
+  results = stager.stageAll(files)
+
+  jobs = []
+  for case, caseData in data.iteritems():
+    outputCaseDir = os.path.join(outputDir, case)
+    for series in caseData or []:
+      seriesNumber = series["seriesNumber"]
+      staged = [results[os.path.join(outputCaseDir, "{}-{}".format(seriesNumber, name))]
+                for name in ["label.nrrd", "volume.nrrd"]]
+      if FAILED in staged:
+        continue
+      if STAGED in staged:
+        # inputs changed: the needle segmentation is outdated
+        for name in ["needle-label.nrrd", "needle-tip.fcsv", "needle-centerline.fcsv"]:
+          temp = os.path.join(outputCaseDir, "{}-{}".format(seriesNumber, name))
+          if os.path.exists(temp):
+            os.remove(temp)
+      if not os.path.exists(os.path.join(outputCaseDir, "{}-needle-label.nrrd".format(seriesNumber))):
+        jobs.append(needleJob(os.path.join(outputCaseDir, "{}-volume.nrrd".format(seriesNumber)),
+                              os.path.join(outputCaseDir, "{}-label.nrrd".format(seriesNumber)),
+                              outputCaseDir, seriesNumber))
+  return jobs
+
+
+def copyData(data, outputDir, runner, stager):
+
+  jobs = stageData(data, outputDir, stager)
+  if jobs:
+    print "segmenting needles of %d series" % len(jobs)
+    for job in runner.run(jobs):
+      logging.warn("Needle segmentation of %s failed" % job["inputs"]["InputVolume"])
 
   csvData = [['Case','SeriesNumber', 'TargetName','Pos','NeedleDistance', 'ErrorVector', 'Comment']]
 
@@ -119,137 +172,50 @@ def copyData(data, outputDir):
     if not caseData:
       continue
     outputCaseDir = os.path.join(outputDir, case)
-    if not os.path.exists(outputCaseDir):
-      ModuleLogicMixin.createDirectory(outputCaseDir)
 
     print "processing data of case %s" %case
 
+    curves, targetPositions, curveIndices, series = [], [], [], []
     for data in caseData:
       seriesNumber = data["seriesNumber"]
 
-      inputs = dict()
+      if not os.path.exists(os.path.join(outputCaseDir, "{}-targets.fcsv".format(seriesNumber))):
+        series.append((seriesNumber, [], "Targets could not be staged"))
+        continue
 
-      temp = os.path.join(outputCaseDir, "{}-label.nrrd".format(seriesNumber))
-      if not os.path.exists(temp):
-        copy(os.path.join(data["path"], data["label"]), temp)
-      # success, inputs['InputProstateMask'] = slicer.util.loadLabelVolume(temp, returnNode=True)
-
-      temp = os.path.join(outputCaseDir, "{}-volume.nrrd".format(seriesNumber))
-      if not os.path.exists(temp):
-        copy(os.path.join(data["path"], data["volume"]), temp)
-      # success, inputs['InputVolume'] = slicer.util.loadVolume(temp, returnNode=True)
-
-      temp = os.path.join(outputCaseDir, "{}-targets.fcsv".format(seriesNumber))
-      if not os.path.exists(temp):
-        copy(os.path.join(data["path"], data["targets"]), temp)
-      success, targetNode = slicer.util.loadMarkupsFiducialList(temp, returnNode=True)
-
-      temp = os.path.join(outputCaseDir, "{}-needle-label.nrrd".format(seriesNumber))
-      if not os.path.exists(temp):
-        outputs = dict()
-        outputs['OutputLabel'] = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-        outputs['OutputFiducialList'] = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
-
-        params = dict()
-        params['InferenceType'] = 'Ensemble'
-
-        logic.executeDocker(dockerName, modelName, dataPath, iodict, inputs, params)
-        logic.updateOutput(iodict, outputs)
-
-        ModuleLogicMixin.saveNodeData(outputs['OutputLabel'], outputCaseDir, FileExtension.NRRD,
-                                      name="{}-needle-label".format(seriesNumber))
-        ModuleLogicMixin.saveNodeData(outputs['OutputFiducialList'], outputCaseDir, FileExtension.FCSV,
-                                      name="{}-needle-tip".format(seriesNumber))
+      if not os.path.exists(os.path.join(outputCaseDir, "{}-needle-label.nrrd".format(seriesNumber))):
+        series.append((seriesNumber, [], "Needle segmentation failed"))
+        continue
 
       temp = os.path.join(outputCaseDir, "{}-needle-centerline.fcsv".format(seriesNumber))
       if not os.path.exists(temp):
         centerLine = CenterLinePoints(os.path.join(outputCaseDir, "{}-needle-label.nrrd".format(seriesNumber)))
         points_ijk = centerLine.get_needle_points_ijk()
-        points_ras = centerLine.convert_points_ijk_to_ras(points_ijk)
-        centerLineNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
-        for point in points_ras:
-          centerLineNode.AddFiducialFromArray(point)
-        centerLineNode.SetLocked(True)
-        ModuleLogicMixin.saveNodeData(centerLineNode, outputCaseDir, FileExtension.FCSV,
-                                      name="{}-needle-centerline".format(seriesNumber))
-
-      success, centerLineNode = slicer.util.loadMarkupsFiducialList(temp, returnNode=True)
-      if not centerLineNode.GetNumberOfFiducials():
-        csvData.append([case, seriesNumber, "", "", "", "", "No centerline was found"])
-      else:
-        cmLogic = CurveMaker.CurveMakerLogic()
-        cmLogic.DestinationNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
-        cmLogic.SourceNode = centerLineNode
-        cmLogic.updateCurve()
-
-        cmLogic.CurvePoly = vtk.vtkPolyData()
-        cmLogic.enableAutomaticUpdate(1)
-
-        for idx in range(targetNode.GetNumberOfFiducials()):
-          targetName = targetNode.GetNthFiducialLabel(idx)
-          if targetName.lower() in ["right", "left"]:
-            continue
-          pos = ModuleLogicMixin.getTargetPosition(targetNode, idx)
-          (distance, minErrorVec) = cmLogic.distanceToPoint(pos, True)
-          # print "{}: {} ({})".format(targetName, distance, minErrorVec)
-
-          csvData.append([case, seriesNumber, targetName, pos, distance, minErrorVec, ""])
-
-
-        def cleanup():
-          slicer.mrmlScene.RemoveNode(cmLogic.DestinationNode)
-
-        cleanup()
+        writeFCSV(temp, centerLine.convert_points_ijk_to_ras(points_ijk), locked=True)
+
+      centerLine, _ = readFCSV(temp)
+      if not len(centerLine):
+        series.append((seriesNumber, [], "No centerline was found"))
+        continue
+
+      positions, names = readFCSV(os.path.join(outputCaseDir, "{}-targets.fcsv".format(seriesNumber)))
+      targets = [(name, len(targetPositions) + idx) for idx, name in enumerate(names)
+                 if name.lower() not in ["right", "left"]]
+      targetPositions += list(positions)
+      curveIndices += [len(curves)] * len(positions)
+      curves.append(centerLine)
+      series.append((seriesNumber, targets, None))
+
+    distances, errorVectors, _ = distancesToCurves(curves, targetPositions, curveIndices)
+    for seriesNumber, targets, comment in series:
+      if comment:
+        csvData.append([case, seriesNumber, "", "", "", "", comment])
+      for targetName, idx in targets:
+        csvData.append([case, seriesNumber, targetName, list(targetPositions[idx]), distances[idx],
+                        list(errorVectors[idx]), ""])
 
   return csvData
 
 
-def copy(source, destination):
-  # print "Copying from %s to %s" % (source, destination)
-  shutil.copy(source, destination)
-
-
-class CenterLinePoints:
-
-  def __init__(self, path):
-    self.label = sitk.ReadImage(path)
-    self.nda = sitk.GetArrayFromImage(self.label)
-
-  def bounding_box(self, arr, padding=0, square=False):
-    a = np.where(arr != 0)
-    if a[0].size and a[1].size:
-      min_ax0 = np.min(a[0])
-      max_ax0 = np.max(a[0])
-      min_ax1 = np.min(a[1])
-      max_ax1 = np.max(a[1])
-      if square:
-        min_ax = min(min_ax0, min_ax1)
-        max_ax = max(max_ax0, max_ax1)
-        return min_ax - padding, max_ax + padding, min_ax - padding, max_ax + padding
-      return min_ax0 - padding, max_ax0 + padding, min_ax1 - padding, max_ax1 + padding
-
-  def get_needle_points_ijk(self):
-    needle_slices = np.nonzero(np.sum(np.sum(self.nda, axis=1), axis=1))[0]
-    n_points = len(needle_slices)
-    points_array = np.zeros((n_points, 3), dtype=np.int)
-    for index, slice_no in enumerate(needle_slices):
-      slice_nda = self.nda[slice_no]
-      y1, y2, x1, x2 = self.bounding_box(slice_nda)
-      points_array[index, 0] = x1 + int((x2 - x1) / 2)
-      points_array[index, 1] = y1 + int((y2 - y1) / 2)
-      points_array[index, 2] = slice_no
-    return points_array
-
-  def convert_points_ijk_to_ras(self, points):
-    reconstructed_needle_tube_nda = np.zeros_like(self.nda)
-    points_ras = np.zeros((len(points), 3))
-    for index, point in enumerate(points):
-      points_ras[index] = np.asarray(self.label.TransformIndexToPhysicalPoint(point))
-    # lps to ras conversion
-    points_ras[:, 0] *= -1
-    points_ras[:, 1] *= -1
-    return points_ras
-
-
 if __name__ == "__main__":
   main(sys.argv[1:])
\ No newline at end of file
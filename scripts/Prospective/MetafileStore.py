@@ -0,0 +1,216 @@
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+import multiprocessing
+
+from ArchiveScanner import getCaseNumber, scanArchive
+
+# SQLite store of the SliceTracker metafiles (results.json) of a case archive. Metafiles are parsed in parallel and
+# normalized into the tables results, procedure_events and preop_segmentation; the raw json of every metafile and
+# result is kept as well. Only metafiles whose size or modification time changed get parsed again on refresh, so the
+# reports built on top of the store are plain queries. Metafiles are discovered by ArchiveScanner.py.
+#
+# A store can be shared by concurrent processes: metafiles are parsed before anything is written, so the write
+# transaction replacing their rows is short, and writers wait up to LOCK_TIMEOUT seconds for each other.
+
+STORE_VERSION = 1
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "SliceTracker_Evaluation")
+# seconds to wait for other processes (e.g. SlicerScheduler workers) writing to a shared store
+LOCK_TIMEOUT = 120
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS metafiles (
+  path TEXT PRIMARY KEY, case_number TEXT, directory TEXT, size INTEGER, mtime REAL, raw TEXT);
+CREATE TABLE IF NOT EXISTS results (
+  path TEXT, case_number TEXT, position INTEGER, name TEXT, series_number TEXT, series_description TEXT,
+  series_type TEXT, received_time TEXT, state TEXT, status_time TEXT, consent_given_by TEXT, registration_type TEXT,
+  label_fixed TEXT, volume_fixed TEXT, targets_approved TEXT, has_segmentation INTEGER, segmentation_algorithm TEXT,
+  segmentation_start_time TEXT, segmentation_end_time TEXT, user_modified INTEGER, modification_start_time TEXT,
+  modification_end_time TEXT, raw TEXT);
+CREATE TABLE IF NOT EXISTS procedure_events (
+  path TEXT PRIMARY KEY, case_number TEXT, case_started TEXT, case_completed TEXT, raw TEXT);
+CREATE TABLE IF NOT EXISTS preop_segmentation (
+  path TEXT PRIMARY KEY, case_number TEXT, used_erc INTEGER, algorithm TEXT, start_time TEXT, end_time TEXT,
+  user_modified INTEGER, modification_start_time TEXT, modification_end_time TEXT, raw TEXT);
+CREATE INDEX IF NOT EXISTS results_case ON results (case_number);
+CREATE INDEX IF NOT EXISTS results_path ON results (path);
+"""
+
+TABLES = ["metafiles", "results", "procedure_events", "preop_segmentation"]
+
+
+def segmentationColumns(segmentation):
+  """ [algorithm, start time, end time, user modified, modification start time, modification end time]
+  """
+  if not segmentation:
+    return [None] * 6
+  modified = segmentation.get("userModified")
+  return [segmentation.get("algorithm"), segmentation.get("startTime"), segmentation.get("endTime"), bool(modified),
+          modified.get("startTime") if modified else None, modified.get("endTime") if modified else None]
+
+
+def resultRows(path, caseNumber, results):
+  """ Normalizes the results of a metafile. SliceTracker 1.0 stored them as dict (name -> result, status as string),
+  later versions as list.
+  """
+  if isinstance(results, dict):
+    results = [dict(result, name=name) for name, result in results.items()]
+  rows = []
+  for position, result in enumerate(results):
+    name = result.get("name", "")
+    seriesNumber, _, description = name.partition(": ")
+    status = result.get("status")
+    status = status if isinstance(status, dict) else {"state": status}
+    series = result.get("series") or {}
+    targets = result.get("targets") or {}
+    approvedTargets = targets.get("approved")
+    rows.append([path, caseNumber, position, name, seriesNumber, description, series.get("type"),
+                 series.get("receivedTime"), status.get("state"), status.get("time"), status.get("consentGivenBy"),
+                 status.get("registrationType"), (result.get("labels") or {}).get("fixed"),
+                 (result.get("volumes") or {}).get("fixed"),
+                 approvedTargets.get("fileName") if isinstance(approvedTargets, dict) else None,
+                 "segmentation" in result] + segmentationColumns(result.get("segmentation")) + [json.dumps(result)])
+  return rows
+
+
+def parseMetafile(metafile):
+  """ Parses one metafile into rows of all tables. Runs in worker processes.
+  """
+  try:
+    stat = os.stat(metafile)
+    with open(metafile) as f:
+      raw = f.read()
+    data = json.loads(raw)
+  except (IOError, OSError, ValueError), e:
+    return metafile, None, str(e)
+
+  caseNumber = getCaseNumber(metafile)
+  rows = {table: [] for table in TABLES}
+  rows["metafiles"].append([metafile, caseNumber, os.path.dirname(metafile), stat.st_size, stat.st_mtime, raw])
+  try:
+    rows["results"] = resultRows(metafile, caseNumber, data.get("results", []))
+    events = data.get("procedureEvents")
+    if events is not None:
+      completed = events.get("caseCompleted")
+      rows["procedure_events"].append([metafile, caseNumber, events.get("caseStarted"),
+                                       completed.get("time") if isinstance(completed, dict) else completed,
+                                       json.dumps(events)])
+    preop = data.get("preop")
+    if preop is not None:
+      rows["preop_segmentation"].append([metafile, caseNumber, preop.get("usedERC")] +
+                                        segmentationColumns(preop.get("segmentation")) + [json.dumps(preop)])
+  except (AttributeError, TypeError), e:
+    return metafile, None, "unexpected structure: %s" % e
+  return metafile, rows, None
+
+
+class MetafileStore(object):
+
+  def __init__(self, storeFile):
+    self.storeFile = storeFile
+    directory = os.path.dirname(storeFile)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    self.connection = sqlite3.connect(storeFile, timeout=LOCK_TIMEOUT)
+    # byte strings on python 2, so that paths can be passed on to e.g. SimpleITK
+    self.connection.text_factory = str
+    self._createSchema()
+
+  @classmethod
+  def open(cls, caseRootDir, storeFile=None, refresh=True, workers=None):
+    """ Opens the store of a case archive (by default in ~/.cache) and brings it up to date
+    """
+    if storeFile is None:
+      key = hashlib.sha1(os.path.abspath(caseRootDir)).hexdigest()[:16]
+      storeFile = os.path.join(DEFAULT_STORE_DIR, "metafiles-{}.sqlite".format(key))
+    store = cls(storeFile)
+    if refresh:
+      store.refresh(caseRootDir, workers)
+    return store
+
+  def _createSchema(self):
+    version = None
+    try:
+      version = self.connection.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+    except sqlite3.OperationalError:
+      pass
+    if version and int(version[0]) != STORE_VERSION:
+      for table in TABLES + ["info"]:
+        self.connection.execute("DROP TABLE IF EXISTS {}".format(table))
+    self.connection.executescript(SCHEMA)
+    self.connection.execute("INSERT OR REPLACE INTO info VALUES ('version', ?)", (str(STORE_VERSION),))
+    self.connection.commit()
+
+  def refresh(self, caseRootDir, workers=None, scanCacheFile=None):
+    """ Parses new and modified metafiles of caseRootDir in parallel and removes metafiles that disappeared
+    """
+    known = {path: (size, mtime) for path, size, mtime in
+             self.connection.execute("SELECT path, size, mtime FROM metafiles")}
+    root = os.path.abspath(caseRootDir)
+    metafiles = [path for _, path in scanArchive(root, scanCacheFile)]
+    current = set(metafiles)
+
+    outdated = []
+    for metafile in metafiles:
+      stat = os.stat(metafile)
+      if known.get(metafile) != (stat.st_size, stat.st_mtime):
+        outdated.append(metafile)
+    removed = [path for path in known if path.startswith(root + os.sep) and path not in current]
+    if not removed and not outdated:
+      return
+
+    parsed = []
+    if outdated:
+      logging.info("Parsing %d of %d metafiles" % (len(outdated), len(metafiles)))
+      parsed = self._parse(outdated, workers)
+
+    # single write transaction, only opened once all metafiles are parsed
+    try:
+      for path in removed + outdated:
+        self._delete(path)
+      for metafile, rows, error in parsed:
+        if error:
+          logging.warn("Errors while reading metafile %s: %s" % (metafile, error))
+          continue
+        for table in TABLES:
+          for row in rows[table]:
+            self.connection.execute("INSERT INTO {} VALUES ({})".format(table, ",".join("?" * len(row))), row)
+      self.connection.commit()
+    except:
+      self.connection.rollback()
+      raise
+
+  def _parse(self, metafiles, workers=None):
+    workers = min(workers or multiprocessing.cpu_count(), len(metafiles))
+    if workers <= 1:
+      return map(parseMetafile, metafiles)
+    pool = multiprocessing.Pool(workers)
+    try:
+      return pool.map(parseMetafile, metafiles)
+    finally:
+      pool.close()
+      pool.join()
+
+  def _delete(self, path):
+    for table in TABLES:
+      self.connection.execute("DELETE FROM {} WHERE path = ?".format(table), (path,))
+
+  def query(self, sql, parameters=()):
+    return self.connection.execute(sql, parameters).fetchall()
+
+  def metafiles(self):
+    """ [(case number, metafile path)] sorted by path
+    """
+    return self.query("SELECT case_number, path FROM metafiles ORDER BY path")
+
+  def load(self, path):
+    """ The parsed json of a metafile, without reading the file again
+    """
+    row = self.connection.execute("SELECT raw FROM metafiles WHERE path = ?", (path,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+  def close(self):
+    self.connection.close()
@@ -0,0 +1,86 @@
+import numpy as np
+import SimpleITK as sitk
+
+# Needle centerline of a needle label: one point per label slice in the center of the bounding box of the needle
+# voxels of that slice. The label is cropped to the bounding region of the needle and the extents of all slices are
+# found at once by axis reductions; IJK points are mapped to RAS with a single affine product.
+
+
+def boundingRegion(mask):
+  """ [(first, last)] per numpy axis of the nonzero voxels of mask, None if mask is empty
+  """
+  region = []
+  for axis in range(mask.ndim):
+    present = np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != axis)))
+    if not len(present):
+      return None
+    region.append((present[0], present[-1]))
+  return region
+
+
+def firstAndLast(present):
+  """ Index of the first and last True along the last axis of every row of present
+  """
+  first = np.argmax(present, axis=-1)
+  last = present.shape[-1] - 1 - np.argmax(present[..., ::-1], axis=-1)
+  return first, last
+
+
+def needlePointsIJK(nda):
+  """ (N,3) integer IJK points of the centerline of label array nda (numpy order k, j, i)
+  """
+  mask = np.asarray(nda) != 0
+  region = boundingRegion(mask)
+  if region is None:
+    return np.zeros((0, 3), dtype=np.int64)
+  (k0, k1), (j0, j1), (i0, i1) = region
+  mask = mask[k0:k1 + 1, j0:j1 + 1, i0:i1 + 1]
+
+  rows = mask.any(axis=2)
+  slices = np.flatnonzero(rows.any(axis=1))
+  rows = rows[slices]
+  columns = mask[slices].any(axis=1)
+  y1, y2 = firstAndLast(rows)
+  x1, x2 = firstAndLast(columns)
+
+  points = np.empty((len(slices), 3), dtype=np.int64)
+  points[:, 0] = i0 + x1 + (x2 - x1) // 2
+  points[:, 1] = j0 + y1 + (y2 - y1) // 2
+  points[:, 2] = k0 + slices
+  return points
+
+
+def indexToPhysicalMatrix(image):
+  """ 4x4 matrix mapping homogeneous IJK indices to LPS physical points of a SimpleITK image
+  """
+  dimension = image.GetDimension()
+  direction = np.array(image.GetDirection(), dtype=np.float64).reshape(dimension, dimension)
+  matrix = np.identity(4)
+  matrix[:3, :3] = direction.dot(np.diag(image.GetSpacing()))
+  matrix[:3, 3] = image.GetOrigin()
+  return matrix
+
+
+def ijkToRAS(image, points):
+  """ RAS positions of (N,3) IJK points of a SimpleITK image
+  """
+  points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+  matrix = indexToPhysicalMatrix(image)
+  ras = points.dot(matrix[:3, :3].T) + matrix[:3, 3]
+  # lps to ras conversion
+  ras[:, :2] *= -1
+  return ras
+
+
+class CenterLinePoints(object):
+
+  def __init__(self, path):
+    self.label = sitk.ReadImage(path)
+    self.nda = sitk.GetArrayViewFromImage(self.label) if hasattr(sitk, "GetArrayViewFromImage") \
+      else sitk.GetArrayFromImage(self.label)
+
+  def get_needle_points_ijk(self):
+    return needlePointsIJK(self.nda)
+
+  def convert_points_ijk_to_ras(self, points):
+    return ijkToRAS(self.label, points)
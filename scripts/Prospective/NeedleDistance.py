@@ -0,0 +1,87 @@
+import numpy as np
+
+# Distances between targets and needle centerlines without MRML nodes or VTK. A centerline is turned into a polyline
+# (optionally sampled from a Catmull-Rom spline through the centerline points, as CurveMaker does with its cardinal
+# spline) and all targets are projected onto all segments at once. Like CurveMaker.distanceToPoint with
+# extrapolation, the first and last segments are treated as infinite lines, so targets beyond the needle tip are
+# measured to the extension of the needle.
+#
+# Error vectors point from the target to its closest point on the needle.
+
+DEFAULT_RESOLUTION = 25
+
+
+def splinePoints(points, resolution=DEFAULT_RESOLUTION):
+  """ Samples a Catmull-Rom spline through points with resolution samples per segment
+  """
+  points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+  if len(points) < 3 or resolution < 2:
+    return points
+  # tangents by central differences, one sided at both ends
+  tangents = np.empty_like(points)
+  tangents[1:-1] = 0.5 * (points[2:] - points[:-2])
+  tangents[0] = points[1] - points[0]
+  tangents[-1] = points[-1] - points[-2]
+
+  t = np.arange(resolution, dtype=np.float64) / resolution
+  t2, t3 = t * t, t * t * t
+  basis = np.column_stack([2 * t3 - 3 * t2 + 1, t3 - 2 * t2 + t, -2 * t3 + 3 * t2, t3 - t2])
+  samples = (basis[None, :, 0, None] * points[:-1, None] + basis[None, :, 1, None] * tangents[:-1, None] +
+             basis[None, :, 2, None] * points[1:, None] + basis[None, :, 3, None] * tangents[1:, None])
+  return np.vstack([samples.reshape(-1, 3), points[-1:]])
+
+
+def curveSegments(curves, spline=True, resolution=DEFAULT_RESOLUTION):
+  """ Returns (starts, ends, curve index, lower, upper) of the segments of all curves. lower/upper bound the
+  projection parameter of every segment (-inf/inf for the extrapolated first/last segment of a curve).
+  """
+  starts, ends, indices, lower, upper = [], [], [], [], []
+  for index, points in enumerate(curves):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    if spline:
+      points = splinePoints(points, resolution)
+    if len(points) == 1:
+      points = np.vstack([points, points])
+    n = len(points) - 1
+    if n < 1:
+      continue
+    starts.append(points[:-1])
+    ends.append(points[1:])
+    indices.append(np.full(n, index, dtype=np.int64))
+    low, high = np.zeros(n), np.ones(n)
+    low[0], high[-1] = -np.inf, np.inf
+    lower.append(low)
+    upper.append(high)
+  if not starts:
+    return np.zeros((0, 3)), np.zeros((0, 3)), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+  return np.vstack(starts), np.vstack(ends), np.concatenate(indices), np.concatenate(lower), np.concatenate(upper)
+
+
+def distancesToCurves(curves, targets, curveIndices=None, spline=True, resolution=DEFAULT_RESOLUTION):
+  """ Returns (distances, error vectors, closest points) of every target to its curve.
+
+  curves: list of (N,3) centerline points, targets: (K,3), curveIndices: curve of every target (default: all
+  targets belong to the first curve). Targets of empty curves get a distance of NaN.
+  """
+  targets = np.asarray(targets, dtype=np.float64).reshape(-1, 3)
+  curveIndices = np.zeros(len(targets), dtype=np.int64) if curveIndices is None else np.asarray(curveIndices)
+  starts, ends, segmentCurves, lower, upper = curveSegments(curves, spline, resolution)
+
+  closest = np.full((len(targets), 3), np.nan)
+  if len(targets) and len(starts):
+    direction = ends - starts
+    length2 = np.einsum("ij,ij->i", direction, direction)
+    offsets = targets[:, None, :] - starts[None, :, :]
+    t = np.einsum("kmj,mj->km", offsets, direction) / np.where(length2 > 0, length2, 1.0)
+    t = np.clip(t, lower, upper)
+    t[:, length2 == 0] = 0
+    projections = starts[None] + t[..., None] * direction[None]
+    distance2 = np.sum((projections - targets[:, None, :]) ** 2, axis=2)
+    distance2[segmentCurves[None, :] != curveIndices[:, None]] = np.inf
+
+    best = np.argmin(distance2, axis=1)
+    found = np.isfinite(distance2[np.arange(len(targets)), best])
+    closest[found] = projections[np.flatnonzero(found), best[found]]
+
+  errors = closest - targets
+  return np.sqrt(np.sum(errors ** 2, axis=1)), errors, closest
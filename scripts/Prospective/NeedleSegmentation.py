@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import pipes
+import shutil
+import logging
+import tempfile
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from FiducialIO import writeFCSV
+from SlicerScheduler import splitShards
+
+# Batched needle segmentation of guidance series. Instead of one DeepInfer docker run per series (each paying the
+# container start and model load), all pending series are staged into a batch directory and processed in a small
+# number of container sessions: every session is a single docker run that calls the model entrypoint for each series
+# of its shard. The outputs are afterwards moved back next to the series as {series}-needle-label.nrrd and
+# {series}-needle-tip.fcsv.
+#
+# A job is a dict with the model inputs ({"InputVolume": path, ...}) and the destinations of the outputs
+# ({"OutputLabel": path, "OutputFiducialList": path}). StubNeedleRunner stands in for the model without docker.
+
+LABEL_OUTPUT = "OutputLabel"
+TIPS_OUTPUT = "OutputFiducialList"
+OUTPUT_EXTENSIONS = {"volume": ".nrrd", "point_vec": ".fcsv"}
+
+def needleJob(volume, label, outputDir, seriesNumber):
+  return {
+    "inputs": {"InputVolume": volume, "InputProstateMask": label},
+    "outputs": {LABEL_OUTPUT: os.path.join(outputDir, "{}-needle-label.nrrd".format(seriesNumber)),
+                TIPS_OUTPUT: os.path.join(outputDir, "{}-needle-tip.fcsv".format(seriesNumber))}
+  }
+
+
+def linkOrCopy(source, destination):
+  try:
+    os.link(source, destination)
+  except (OSError, AttributeError):
+    shutil.copy(source, destination)
+
+
+class NeedleRunner(object):
+  """ Runs jobs in batches of `sessions` concurrent sessions. Subclasses implement runSession.
+  """
+
+  def __init__(self, sessions=1):
+    self.sessions = max(1, sessions)
+
+  def run(self, jobs):
+    """ Returns the jobs that did not produce all of their outputs
+    """
+    if not jobs:
+      return []
+    shards = splitShards(jobs, self.sessions)
+    pool = ThreadPool(len(shards))
+    try:
+      failed = pool.map(self._runShard, shards)
+    finally:
+      pool.close()
+      pool.join()
+    return [job for shard in failed for job in shard]
+
+  def _runShard(self, jobs):
+    batchDir = tempfile.mkdtemp(prefix="needle-batch-")
+    try:
+      for index, job in enumerate(jobs):
+        jobDir = os.path.join(batchDir, str(index))
+        os.mkdir(jobDir)
+        for name, path in job["inputs"].items():
+          linkOrCopy(path, os.path.join(jobDir, name + os.path.splitext(path)[1]))
+      try:
+        self.runSession(batchDir, jobs)
+      except Exception, e:
+        logging.warn("Needle segmentation session failed: %s" % e)
+      return [job for index, job in enumerate(jobs) if not self._collect(os.path.join(batchDir, str(index)), job)]
+    finally:
+      shutil.rmtree(batchDir, ignore_errors=True)
+
+  def _collect(self, jobDir, job):
+    produced = {name: os.path.join(jobDir, name + os.path.splitext(path)[1]) for name, path in job["outputs"].items()}
+    if not all(os.path.exists(path) for path in produced.values()):
+      return False
+    for name, path in produced.items():
+      shutil.move(path, job["outputs"][name])
+    return True
+
+  def runSession(self, batchDir, jobs):
+    """ Processes batchDir/{index}/{input name}.{ext} into batchDir/{index}/{output name}.{ext}
+    """
+    raise NotImplementedError
+
+
+class DockerNeedleRunner(NeedleRunner):
+  """ Runs a DeepInfer model: one docker run per session, calling the image entrypoint once per job
+  """
+
+  def __init__(self, dockerName, dataPath, iodict, params=None, sessions=1, dockerPath="docker"):
+    NeedleRunner.__init__(self, sessions)
+    self.dockerName = dockerName
+    self.dataPath = dataPath
+    self.iodict = iodict
+    self.params = params or {}
+    self.dockerPath = dockerPath
+    self._entrypoint = None
+
+  def entrypoint(self):
+    if self._entrypoint is None:
+      output = subprocess.check_output([self.dockerPath, "inspect", "--format", "{{json .Config.Entrypoint}}",
+                                        self.dockerName])
+      self._entrypoint = json.loads(output) or []
+      if not self._entrypoint:
+        raise ValueError("Docker image %s has no entrypoint" % self.dockerName)
+    return [str(part) for part in self._entrypoint]
+
+  def arguments(self, index, job):
+    """ Model arguments of a job the way DeepInfer passes them
+    """
+    jobPath = "{}/{}".format(self.dataPath, index)
+    args = []
+    for name, item in self.iodict.items():
+      if item["iotype"] == "input":
+        if name not in job["inputs"]:
+          raise ValueError("No file for model input %s" % name)
+        args += ["--" + name, "{}/{}{}".format(jobPath, name, os.path.splitext(job["inputs"][name])[1])]
+      elif item["iotype"] == "output":
+        args += ["--" + name, "{}/{}{}".format(jobPath, name, OUTPUT_EXTENSIONS.get(item["type"], ".nrrd"))]
+      elif item["iotype"] == "parameter" and name in self.params:
+        if item.get("type") == "bool":
+          args += ["--" + name] if self.params[name] else []
+        else:
+          args += ["--" + name, str(self.params[name])]
+    return args
+
+  def command(self, batchDir, jobs):
+    entrypoint = " ".join(pipes.quote(part) for part in self.entrypoint())
+    script = "; ".join("{} {} || echo 'needle segmentation of job {} failed'".format(
+      entrypoint, " ".join(pipes.quote(arg) for arg in self.arguments(index, job)), index)
+      for index, job in enumerate(jobs))
+    return [self.dockerPath, "run", "--rm", "-v", "{}:{}".format(batchDir, self.dataPath), "--entrypoint", "sh",
+            self.dockerName, "-c", script]
+
+  def runSession(self, batchDir, jobs):
+    logging.info("Segmenting needles of %d series in one %s session" % (len(jobs), self.dockerName))
+    subprocess.check_call(self.command(batchDir, jobs))
+
+
+class StubNeedleRunner(NeedleRunner):
+  """ Stand-in for the model: a straight needle along the slice axis through the center of the prostate mask (or
+  volume), inserted from the first slice to the center slice. Outputs have the geometry of the input volume.
+  """
+
+  def runSession(self, batchDir, jobs):
+    for index in range(len(jobs)):
+      jobDir = os.path.join(batchDir, str(index))
+      volume = sitk.ReadImage(os.path.join(jobDir, "InputVolume.nrrd"))
+      size = np.array(volume.GetSize())
+      center = size // 2
+      maskFile = os.path.join(jobDir, "InputProstateMask.nrrd")
+      if os.path.exists(maskFile):
+        mask = sitk.GetArrayFromImage(sitk.ReadImage(maskFile))
+        if mask.any():
+          center = np.round(np.argwhere(mask).mean(axis=0)[::-1]).astype(int)
+
+      data = np.zeros(size[::-1], dtype=np.uint8)
+      data[:center[2] + 1, center[1], center[0]] = 1
+      label = sitk.GetImageFromArray(data)
+      label.CopyInformation(volume)
+      sitk.WriteImage(label, os.path.join(jobDir, LABEL_OUTPUT + ".nrrd"), True)
+
+      tip = volume.TransformIndexToPhysicalPoint([int(c) for c in center])
+      writeFCSV(os.path.join(jobDir, TIPS_OUTPUT + ".fcsv"), [[-tip[0], -tip[1], tip[2]]], labels=["tip"])
@@ -0,0 +1,206 @@
+import os
+import re
+import sys
+import csv
+import argparse
+import numpy as np
+
+from MetafileStore import MetafileStore
+
+# Workflow latency analytics of the prospective cases. All timestamps of the metafiles (procedureEvents, series,
+# status and segmentation times) are parsed into numpy datetime64 arrays, so that the latencies of the whole cohort are
+# computed at once:
+#
+# cases:  case duration, preop segmentation and its user modification
+# series: receive to approval, segmentation, user modification and time since the previous needle guidance series
+#
+# Percentiles and histograms of every latency are written next to the per case and per series tables. All latencies
+# are in minutes.
+
+# usage: python WorkflowLatency.py -cr {case root} -o {output directory}
+
+# python WorkflowLatency.py -cr ~/Dropbox\ \(Partners\ HealthCare\)/SliceTracker_Evaluation/Prospective/ClinicalCases -o ~/latency -p 50 90
+
+DEFAULT_PERCENTILES = [5, 25, 50, 75, 95]
+DEFAULT_BINS = 20
+TIME_UNIT = "ms"
+TIMESTAMP = re.compile(r"^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}")
+GUIDANCE = "GUIDANCE"
+# RegistrationStatus.APPROVED_STATUS of SliceTrackerUtils, which is only available within Slicer
+APPROVED_STATUS = "approved"
+
+
+def main(argv):
+
+  try:
+    parser = argparse.ArgumentParser(description="Slicetracker Prospective Workflow Latencies")
+    parser.add_argument("-cr", "--case-root-directory", dest="caseRootDir", metavar="PATH", default="-", required=True,
+                        help="Root directory that holds cases")
+    parser.add_argument("-o", "--output-dir", dest="outputDir", metavar="PATH", default="-", required=True,
+                        help="Output csv file directory")
+    parser.add_argument("-s", "--store", dest="storeFile", metavar="PATH", default=None,
+                        help="SQLite file caching the parsed metafiles (default: in ~/.cache)")
+    parser.add_argument("-p", "--percentiles", dest="percentiles", metavar="P", type=float, nargs="+",
+                        default=DEFAULT_PERCENTILES, help="Reported percentiles (default: %(default)s)")
+    parser.add_argument("-b", "--bins", dest="bins", metavar="N", type=int, default=DEFAULT_BINS,
+                        help="Number of histogram bins (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    store = MetafileStore.open(args.caseRootDir, args.storeFile)
+    writeLatencyReports(store, args.outputDir, args.percentiles, args.bins)
+    success = True
+
+  except Exception, e:
+    print e
+    success = False
+  sys.exit(0 if success else 1)
+
+
+def parseTimes(values):
+  """ datetime64 array of ISO 8601 timestamps as written by SliceTracker (e.g. 2017-01-31T10:05:42.123Z). Missing
+  and unparseable timestamps are NaT.
+  """
+  strings = np.array([v.rstrip("Z") if isinstance(v, basestring) and TIMESTAMP.match(v) else "NaT" for v in values],
+                     dtype=object)
+  try:
+    return strings.astype("datetime64[{}]".format(TIME_UNIT))
+  except ValueError:
+    result = np.empty(len(strings), dtype="datetime64[{}]".format(TIME_UNIT))
+    for i, value in enumerate(strings):
+      try:
+        result[i] = np.datetime64(value, TIME_UNIT)
+      except ValueError:
+        result[i] = np.datetime64("NaT")
+    return result
+
+
+def minutesBetween(start, end):
+  """ Elementwise end - start in minutes, NaN where one of both is NaT
+  """
+  return np.asarray((end - start) / np.timedelta64(1, "m"), dtype=np.float64)
+
+
+def columns(rows, count):
+  return [[row[i] for row in rows] for i in range(count)] if rows else [[] for _ in range(count)]
+
+
+def caseLatencies(store):
+  """ (case numbers, {latency name: minutes per case})
+  """
+  rows = store.query("""
+    SELECT e.case_number, e.case_started, e.case_completed, p.start_time, p.end_time, p.user_modified,
+           p.modification_start_time, p.modification_end_time
+    FROM procedure_events e
+    LEFT JOIN preop_segmentation p ON p.path = e.path
+    WHERE e.case_number IS NOT NULL
+    ORDER BY e.path""")
+  cases, started, completed, segStart, segEnd, modified, modStart, modEnd = columns(rows, 8)
+  return cases, {
+    "case_duration": minutesBetween(parseTimes(started), parseTimes(completed)),
+    "preop_segmentation": minutesBetween(parseTimes(segStart), parseTimes(segEnd)),
+    "preop_user_modification": minutesBetween(parseTimes(modStart), parseTimes(modEnd))
+  }
+
+
+def seriesLatencies(store):
+  """ ([(case number, series number, series type, state)], {latency name: minutes per series})
+  """
+  rows = store.query("""
+    SELECT case_number, series_number, series_type, state, received_time, status_time, segmentation_start_time,
+           segmentation_end_time, modification_start_time, modification_end_time
+    FROM results
+    WHERE case_number IS NOT NULL
+    ORDER BY path, position""")
+  cases, seriesNumbers, seriesTypes, states, received, status, segStart, segEnd, modStart, modEnd = columns(rows, 10)
+  received = parseTimes(received)
+  approved = np.array([state == APPROVED_STATUS for state in states], dtype=bool)
+
+  receiveToApproval = minutesBetween(received, parseTimes(status))
+  receiveToApproval[~approved] = np.nan
+
+  return zip(cases, seriesNumbers, seriesTypes, states), {
+    "receive_to_approval": receiveToApproval,
+    "segmentation": minutesBetween(parseTimes(segStart), parseTimes(segEnd)),
+    "user_modification": minutesBetween(parseTimes(modStart), parseTimes(modEnd)),
+    "guidance_interval": guidanceIntervals(np.array(cases, dtype=object), np.array(seriesTypes, dtype=object),
+                                           received)
+  }
+
+
+def guidanceIntervals(cases, seriesTypes, received):
+  """ Minutes since the previous needle guidance series of the same case for every guidance series (NaN otherwise)
+  """
+  result = np.full(len(cases), np.nan)
+  guidance = np.flatnonzero((seriesTypes == GUIDANCE) & ~np.isnat(received))
+  if len(guidance) < 2:
+    return result
+  order = guidance[np.lexsort((received[guidance], cases[guidance]))]
+  intervals = minutesBetween(received[order[:-1]], received[order[1:]])
+  sameCase = cases[order[:-1]] == cases[order[1:]]
+  result[order[1:][sameCase]] = intervals[sameCase]
+  return result
+
+
+def summarize(latencies, percentiles=DEFAULT_PERCENTILES):
+  """ [[name, count, mean, min, percentiles..., max]] ignoring missing values
+  """
+  data = [["Latency", "Count", "Mean", "Min"] + ["P{:g}".format(p) for p in percentiles] + ["Max"]]
+  for name in sorted(latencies):
+    values = latencies[name][np.isfinite(latencies[name])]
+    if not len(values):
+      data.append([name, 0] + [""] * (len(percentiles) + 3))
+      continue
+    data.append([name, len(values), values.mean(), values.min()] + list(np.percentile(values, percentiles)) +
+                [values.max()])
+  return data
+
+
+def histograms(latencies, bins=DEFAULT_BINS):
+  """ [[name, bin start, bin end, count]] per latency
+  """
+  data = [["Latency", "From", "To", "Count"]]
+  for name in sorted(latencies):
+    values = latencies[name][np.isfinite(latencies[name])]
+    if not len(values):
+      continue
+    counts, edges = np.histogram(values, bins=bins)
+    data += [[name, edges[i], edges[i + 1], counts[i]] for i in range(len(counts))]
+  return data
+
+
+def latencyTable(keys, header, latencies):
+  names = sorted(latencies)
+  data = [header + names]
+  for i, key in enumerate(keys):
+    data.append(list(key) + ["" if np.isnan(latencies[name][i]) else latencies[name][i] for name in names])
+  return data
+
+
+def writeLatencyReports(store, outputDir, percentiles=DEFAULT_PERCENTILES, bins=DEFAULT_BINS):
+  if not os.path.exists(outputDir):
+    os.makedirs(outputDir)
+  cases, perCase = caseLatencies(store)
+  series, perSeries = seriesLatencies(store)
+  latencies = dict(perCase)
+  latencies.update(perSeries)
+
+  csv_writer(latencyTable([[case] for case in cases], ["Case"], perCase),
+             os.path.join(outputDir, "case_latencies.csv"))
+  csv_writer(latencyTable(series, ["Case", "Series_Number", "Series_Type", "Status"], perSeries),
+             os.path.join(outputDir, "series_latencies.csv"))
+  csv_writer(summarize(latencies, percentiles), os.path.join(outputDir, "latency_percentiles.csv"))
+  csv_writer(histograms(latencies, bins), os.path.join(outputDir, "latency_histograms.csv"))
+
+
+def csv_writer(data, path):
+  """
+  Write data to a CSV file path
+  """
+  with open(path, "wb") as csv_file:
+    writer = csv.writer(csv_file, delimiter=',')
+    for line in data:
+      writer.writerow(line)
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
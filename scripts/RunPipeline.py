@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import argparse
+import logging
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+from CaseIndex import CaseIndex
+from HashUtils import DigestCache, digestOf
+
+# Incremental replacement of GenerateAll.sh: every step knows its input and output files. A step only runs if the
+# content of its inputs or its command changed since its last successful run, or if its outputs got modified/deleted.
+# Independent steps run concurrently.
+
+# usage: python RunPipeline.py -ld {LandmarksDirectory} -j 8
+
+# python RunPipeline.py -ld ~/Dropbox\ \(Partners\ HealthCare\)/SliceTracker_Evaluation/Landmarks/ -tt bSpline
+
+# steps run one at a time in an already running Slicer: python RunPipeline.py -ld {LandmarksDirectory} -dp 8765
+
+STATE_FILENAME = ".pipeline_state.json"
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main(argv):
+
+  try:
+    parser = argparse.ArgumentParser(description="Slicetracker Evaluation Pipeline")
+    parser.add_argument("-ld", "--landmark-root-directory", dest="landmarkRootDir", metavar="PATH", default="-",
+                        required=True, help="Root directory that lists all cases holding information for landmarks")
+    parser.add_argument("-tt", "--transform-type", dest="transformType", metavar="NAME", default="bSpline",
+                        choices=['rigid', 'affine', 'bSpline'], help="%(choices)s (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", dest="jobs", metavar="N", type=int, default=4,
+                        help="Number of steps running concurrently (default: %(default)s). Has no effect with -dp, "
+                             "since the daemon runs one step at a time")
+    parser.add_argument("-p", "--python", dest="python", metavar="PATH", default=sys.executable,
+                        help="Python interpreter running the steps (default: %(default)s)")
+    parser.add_argument("-df", "--displacement-field", dest="fieldResolution", metavar="MM", type=float, default=None,
+                        help="Apply bSpline transforms using cached displacement fields with this sample distance")
+    parser.add_argument("-dp", "--daemon-port", dest="daemonPort", metavar="PORT", type=int, default=None,
+                        help="Run the steps one at a time in the evaluation daemon listening on this port (see "
+                             "EvaluationDaemon.py) instead of starting a new process per step")
+    parser.add_argument("-f", "--force", action='store_true', help="Run all steps regardless of their state")
+    parser.add_argument("-n", "--dry-run", dest="dryRun", action='store_true',
+                        help="Only print the steps that would run")
+    args = parser.parse_args(argv)
+    # steps run in SCRIPTS_DIR, so they have to get the same directory the pipeline checks
+    args.landmarkRootDir = os.path.abspath(args.landmarkRootDir)
+
+    if args.daemonPort is not None and args.jobs > 1:
+      logging.warn("The evaluation daemon runs one step at a time, running the steps one after another (-j %d ignored)"
+                   % args.jobs)
+      args.jobs = 1
+
+    steps = createSteps(args)
+    pipeline = Pipeline(steps, os.path.join(args.landmarkRootDir, STATE_FILENAME), launcher=createLauncher(args))
+    success = pipeline.run(jobs=args.jobs, force=args.force, dryRun=args.dryRun)
+
+  except Exception, e:
+    print e
+    success = False
+  sys.exit(0 if success else 1)
+
+
+class Step(object):
+
+  def __init__(self, name, command, inputs, outputs, conditions=None):
+    self.name = name
+    self.command = command
+    self.inputs = sorted(inputs)
+    self.outputs = sorted(outputs)
+    # additional json serializable state the result depends on
+    self.conditions = conditions or {}
+
+
+class Pipeline(object):
+
+  def __init__(self, steps, stateFile, launcher=None):
+    self.steps = steps
+    self.stateFile = stateFile
+    # maps the command of a step (script and its arguments) to the command line actually executed
+    self.launcher = launcher or (lambda command: [sys.executable] + command)
+    self.state = self._loadState()
+    self.digests = DigestCache(self.state.setdefault("digests", {}))
+
+  def _loadState(self):
+    if os.path.exists(self.stateFile):
+      try:
+        with open(self.stateFile) as f:
+          return json.load(f)
+      except ValueError:
+        logging.warn("Ignoring unreadable pipeline state %s" % self.stateFile)
+    return {}
+
+  def _saveState(self):
+    temp = "{}.tmp".format(self.stateFile)
+    with open(temp, "w") as f:
+      json.dump(self.state, f, indent=1, sort_keys=True)
+    if os.name == "nt" and os.path.exists(self.stateFile):
+      os.remove(self.stateFile)
+    os.rename(temp, self.stateFile)
+
+  def levels(self):
+    """ Groups steps into levels: every step only depends on outputs of steps of earlier levels
+    """
+    producers = {output: step for step in self.steps for output in step.outputs}
+    depth = {}
+
+    def getDepth(step, visiting=()):
+      if step.name in visiting:
+        raise ValueError("Cyclic dependency at step %s" % step.name)
+      if step.name not in depth:
+        dependencies = [producers[i] for i in step.inputs if i in producers and producers[i] is not step]
+        depth[step.name] = 1 + max([getDepth(d, visiting + (step.name,)) for d in dependencies] or [-1])
+      return depth[step.name]
+
+    levels = {}
+    for step in self.steps:
+      levels.setdefault(getDepth(step), []).append(step)
+    return [levels[level] for level in sorted(levels)]
+
+  def signature(self, step):
+    return digestOf(step.command, step.conditions, [(path, self.digests.digest(path)) for path in step.inputs])
+
+  def isUpToDate(self, step, signature):
+    recorded = self.state.setdefault("steps", {}).get(step.name)
+    if not recorded or recorded["signature"] != signature:
+      return False
+    return all(self.digests.digest(output) == recorded["outputs"].get(output) for output in step.outputs)
+
+  def run(self, jobs=4, force=False, dryRun=False):
+    failed = set()
+    producers = {output: step.name for step in self.steps for output in step.outputs}
+    counts = {"ran": 0, "skipped": 0, "failed": 0}
+    pool = ThreadPool(max(1, jobs))
+    try:
+      for level in self.levels():
+        pending = []
+        for step in level:
+          if any(producers.get(i) in failed for i in step.inputs):
+            logging.warn("Skipping %s because a step it depends on failed" % step.name)
+            failed.add(step.name)
+            continue
+          signature = self.signature(step)
+          if not force and self.isUpToDate(step, signature):
+            counts["skipped"] += 1
+            continue
+          pending.append((step, signature))
+
+        if dryRun:
+          for step, _ in pending:
+            print "would run %s: %s" % (step.name, subprocess.list2cmdline(self.launcher(step.command)))
+          counts["ran"] += len(pending)
+          continue
+
+        for step, signature, success in pool.map(self._runStep, pending):
+          if success:
+            counts["ran"] += 1
+            self.state["steps"][step.name] = {"signature": signature,
+                                              "outputs": {o: self.digests.digest(o) for o in step.outputs}}
+          else:
+            counts["failed"] += 1
+            failed.add(step.name)
+        self._saveState()
+    finally:
+      pool.close()
+      pool.join()
+
+    print "Pipeline: {ran} ran, {skipped} up to date, {failed} failed".format(**counts)
+    return not counts["failed"]
+
+  def _runStep(self, item):
+    step, signature = item
+    print "running %s" % step.name
+    returnCode = subprocess.call(self.launcher(step.command), cwd=SCRIPTS_DIR)
+    missing = [output for output in step.outputs if not os.path.exists(output)]
+    if returnCode or missing:
+      logging.error("Step %s failed (exit code %s, missing outputs: %s)" % (step.name, returnCode, ", ".join(missing)))
+    return step, signature, not (returnCode or missing)
+
+
+def script(name):
+  return os.path.join(SCRIPTS_DIR, name)
+
+
+def createLauncher(args):
+  if args.daemonPort is None:
+    return lambda command: [args.python] + command
+  client = script("EvaluationClient.py")
+  return lambda command: [args.python, client, "-p", str(args.daemonPort), "-s", command[0], "--"] + command[1:]
+
+
+def createSteps(args):
+  from CalculateLandmarkRegistrationError import validForRegistrationAccuracy, validSegmentationEvaluationCases
+  from CalculateTargetingSensitivity import validCases as validSensitivityCases
+
+  root = args.landmarkRootDir
+  transformType = args.transformType
+  index = CaseIndex.load(root)
+
+  def transformed(case, fiducialType, segmentationType):
+    return os.path.join(index.caseDirectory(case), "{}-Preop{}-transformed-{}-{}.fcsv".format(case, fiducialType,
+                                                                                             transformType,
+                                                                                             segmentationType))
+
+  fieldArguments = ["-df", str(args.fieldResolution)] if args.fieldResolution else []
+  steps = []
+  for case in index.cases():
+    # one step per case: ApplyTransformations loads each fiducial list and transform once for all combinations
+    inputs, outputs, fallbacks = [], [], {}
+    fiducialTypes, segmentationTypes = set(), set()
+    for fiducialType in ["Targets", "Landmarks"]:
+      fiducials = index.path(case, "Preop{}".format(fiducialType), ".fcsv")
+      if not fiducials:
+        continue
+      for segmentationType in ["Manual", "Automatic"]:
+        # same fallback as ApplyTransformations: without registered volume the affine transform gets used
+        fallback = not index.has(case, "VOLUME-{}-{}".format(transformType, segmentationType))
+        transform = index.path(case, "TRANSFORM-{}-{}".format("affine" if fallback else transformType,
+                                                              segmentationType), ".h5")
+        if not transform:
+          continue
+        inputs += [fiducials, transform]
+        outputs.append(transformed(case, fiducialType, segmentationType))
+        fallbacks[segmentationType] = fallback
+        fiducialTypes.add(fiducialType)
+        segmentationTypes.add(segmentationType)
+    if outputs:
+      steps.append(Step("apply-{}".format(case),
+                        [script("ApplyTransformations.py"), "-ld", root, "-st"] + sorted(segmentationTypes) +
+                        ["-tt", transformType, "-ft"] + sorted(fiducialTypes) + ["-e", "native", "-c", case] +
+                        fieldArguments,
+                        set(inputs), outputs, conditions={"fallback": fallbacks}))
+
+  def casesIn(validCases):
+    return [case for case in index.cases() if case.isdigit() and int(case) in validCases]
+
+  for name, outputFile, validCases, segmentationType, extra in [
+    ("lre-automatic", "LREOutput_automatic_reg_accuracy_{}.csv", validSegmentationEvaluationCases, "Automatic", []),
+    ("lre-absolute", "LREOutput_absolute_reg_accuracy_{}.csv", validForRegistrationAccuracy, "Manual", ["-a"])]:
+    outputFile = outputFile.format(transformType)
+    inputs = []
+    for case in casesIn(validCases):
+      inputs += [os.path.join(index.caseDirectory(case), "{}-IntraopLandmarks.fcsv".format(case)),
+                 transformed(case, "Landmarks", segmentationType)]
+    steps.append(Step(name, [script("CalculateLandmarkRegistrationError.py"), "-ld", root,
+                             "-o", outputFile, "-tt", transformType] + extra,
+                      inputs, [os.path.join(root, outputFile)]))
+
+  outputFile = "Targeting_Sensitivity_Manual_Automatic.csv"
+  inputs = []
+  for case in casesIn(validSensitivityCases):
+    inputs += [transformed(case, "Targets", "Manual"), transformed(case, "Targets", "Automatic")]
+  steps.append(Step("targeting-sensitivity", [script("CalculateTargetingSensitivity.py"), "-ld", root,
+                                              "-o", outputFile, "-tt", transformType],
+                    inputs, [os.path.join(root, outputFile)]))
+  return steps
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
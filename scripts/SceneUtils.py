@@ -0,0 +1,107 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+from LoaderCache import releaseRemovedNodes
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+try:
+  import slicer
+except ImportError:
+  slicer = None
+
+# Per case MRML scene scope: every node added to the scene while processing a case gets removed when the case is
+# finished, so memory stays flat in long batch runs. Peak memory of each case is sampled and reported.
+
+SAMPLING_INTERVAL = 0.1
+
+
+def currentMemory():
+  """ Resident set size of this process in bytes (None if it can not be determined)
+  """
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (IOError, OSError, ValueError, AttributeError):
+    pass
+  try:
+    import psutil
+    return psutil.Process(os.getpid()).memory_info().rss
+  except ImportError:
+    pass
+  if resource:
+    # peak instead of current usage, kilobytes on linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname()[0] == "Darwin" else peak * 1024
+  return None
+
+
+class MemorySampler(threading.Thread):
+  """ Samples the resident set size in the background and keeps the peak value
+  """
+
+  def __init__(self, interval=SAMPLING_INTERVAL):
+    super(MemorySampler, self).__init__()
+    self.daemon = True
+    self.interval = interval
+    self.startMemory = self.peak = currentMemory()
+    self._stopped = threading.Event()
+
+  def run(self):
+    while not self._stopped.is_set():
+      self._sample()
+      time.sleep(self.interval)
+
+  def _sample(self):
+    memory = currentMemory()
+    if memory is not None and (self.peak is None or memory > self.peak):
+      self.peak = memory
+
+  def stop(self):
+    self._stopped.set()
+    self.join()
+    self._sample()
+
+
+def getSceneNodes():
+  nodes = slicer.mrmlScene.GetNodes()
+  return [nodes.GetItemAsObject(i) for i in range(nodes.GetNumberOfItems())]
+
+
+def formatMemory(value):
+  return "n/a" if value is None else "{:.1f} MB".format(value / (1024.0 * 1024.0))
+
+
+@contextmanager
+def caseScene(case, report=None):
+  """ Removes all nodes that get added to the scene within the block and reports the peak memory of the case.
+
+  If report is a list, a dict with case, peak/start/end memory (bytes) and number of removed nodes is appended.
+  """
+  existingIDs = set(node.GetID() for node in getSceneNodes()) if slicer else set()
+  sampler = MemorySampler()
+  sampler.start()
+  try:
+    yield
+  finally:
+    removed = 0
+    if slicer:
+      for node in getSceneNodes():
+        if node.GetID() in existingIDs or node.GetSingletonTag():
+          continue
+        if slicer.mrmlScene.IsNodePresent(node):
+          slicer.mrmlScene.RemoveNode(node)
+          removed += 1
+      releaseRemovedNodes()
+    sampler.stop()
+    endMemory = currentMemory()
+    print "Case {}: peak memory {} (start {}, end {}), removed {} nodes".format(
+      case, formatMemory(sampler.peak), formatMemory(sampler.startMemory), formatMemory(endMemory), removed)
+    if report is not None:
+      report.append({"case": case, "peakMemory": sampler.peak, "startMemory": sampler.startMemory,
+                     "endMemory": endMemory, "removedNodes": removed})
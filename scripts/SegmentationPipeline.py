@@ -0,0 +1,183 @@
+import os
+import sys
+import argparse
+import logging
+import subprocess
+import threading
+import Queue
+
+from CaseIndex import CaseIndex
+from SlicerScheduler import getSlicerExecutable, caseSortKey
+
+# Staged producer/consumer driver of CreateDeepLearningSegmentations.py: every case runs through the stages
+# "segment" (deep learning segmentation) and "register" (N4 and registrations). Each stage has its own number of
+# Slicer workers and the stages are connected by bounded queues, so the segmentation of the next cases runs while
+# earlier cases register. The queue size limits how far segmentation can get ahead of registration.
+#
+# Every stage run of a case is a headless Slicer process (or a job of an EvaluationDaemon.py per worker if
+# --daemon-port is given, so that Slicer is started only once per worker).
+
+# usage: python SegmentationPipeline.py -ld {LandmarksDirectory} -sw {SegmentationWorkers} -rw {RegistrationWorkers}
+
+# python SegmentationPipeline.py -ld ~/Dropbox\ \(Partners\ HealthCare\)/Landmarks/ -sw 1 -rw 3 -q 2
+
+# arguments after -- are passed to CreateDeepLearningSegmentations.py, e.g. -- -n4s 2
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = "CreateDeepLearningSegmentations.py"
+AUTOMATIC_LABEL_FILENAME = "{case}-{imageType}Automatic-label.nrrd"
+_DONE = None
+
+
+def main(argv):
+
+  try:
+    scriptArgs = []
+    if "--" in argv:
+      scriptArgs = argv[argv.index("--") + 1:]
+      argv = argv[:argv.index("--")]
+
+    parser = argparse.ArgumentParser(description="Slicetracker pipelined segmentation and registration")
+    parser.add_argument("-ld", "--landmark-root-directory", dest="landmarkRootDir", metavar="PATH", default="-",
+                        required=True, help="Root directory that lists all cases holding information for landmarks")
+    parser.add_argument("-c", "--cases", dest="cases", metavar="CASE", nargs="+", default=None,
+                        help="Only process the listed case numbers")
+    parser.add_argument("-sw", "--segmentation-workers", dest="segmentationWorkers", metavar="N", type=int, default=1,
+                        help="Number of concurrent segmentation workers (default: %(default)s)")
+    parser.add_argument("-rw", "--registration-workers", dest="registrationWorkers", metavar="N", type=int, default=2,
+                        help="Number of concurrent registration workers (default: %(default)s)")
+    parser.add_argument("-q", "--queue-size", dest="queueSize", metavar="N", type=int, default=2,
+                        help="Maximum number of segmented cases waiting for registration (default: %(default)s)")
+    parser.add_argument("-se", "--slicer-executable", dest="slicerExecutable", metavar="PATH", default=None,
+                        help="Slicer executable (default: $SLICER_EXECUTABLE, the running Slicer or Slicer)")
+    parser.add_argument("-dp", "--daemon-port", dest="daemonPort", metavar="PORT", type=int, default=None,
+                        help="Run the stages in evaluation daemons listening on consecutive ports starting at PORT "
+                             "(one per worker, started if not running)")
+    args = parser.parse_args(argv)
+
+    index = CaseIndex.load(args.landmarkRootDir)
+    cases = [case for case in index.cases() if not args.cases or case in args.cases]
+    launcher = StageLauncher(args.landmarkRootDir, args.slicerExecutable or getSlicerExecutable(), args.daemonPort,
+                             scriptArgs)
+    stages = [Stage("segment", args.segmentationWorkers, lambda case: automaticLabelFiles(index, case)),
+              Stage("register", args.registrationWorkers)]
+    try:
+      failed = runStages(cases, stages, launcher, args.queueSize)
+    finally:
+      launcher.shutdown()
+    if failed:
+      print "Failed cases: " + ", ".join("{} ({})".format(case, stage) for case, stage in failed)
+    success = not failed
+
+  except Exception, e:
+    print e
+    success = False
+  sys.exit(0 if success else 1)
+
+
+def automaticLabelFiles(index, case):
+  return [os.path.join(index.caseDirectory(case), AUTOMATIC_LABEL_FILENAME.format(case=case, imageType=imageType))
+          for imageType in ["Preop", "Intraop"]]
+
+
+class Stage(object):
+  """ A stage succeeded for a case if its process exited with 0 and all files listed by outputs(case) exist
+  """
+
+  def __init__(self, name, workers, outputs=None):
+    self.name = name
+    self.workers = max(1, workers)
+    self.outputs = outputs
+
+  def missingOutputs(self, case):
+    return [path for path in (self.outputs(case) if self.outputs else []) if not os.path.exists(path)]
+
+
+class StageLauncher(object):
+  """ Runs one stage of one case. With a daemon port, worker n of all stages uses its own daemon on port + n.
+  """
+
+  def __init__(self, landmarkRootDir, executable, daemonPort=None, scriptArgs=None):
+    self.landmarkRootDir = landmarkRootDir
+    self.scriptArgs = scriptArgs or []
+    self.executable = executable
+    self.daemonPort = daemonPort
+    self._ports = set()
+    self._lock = threading.Lock()
+
+  def command(self, stage, case, worker):
+    scriptArgs = ["-ld", self.landmarkRootDir, "--stage", stage.name, "-c", case] + self.scriptArgs
+    if self.daemonPort is None:
+      return [self.executable, "--no-main-window", "--python-script", os.path.join(SCRIPTS_DIR, SCRIPT)] + scriptArgs
+    port = self.daemonPort + worker
+    with self._lock:
+      self._ports.add(port)
+    return [sys.executable, os.path.join(SCRIPTS_DIR, "EvaluationClient.py"), "-a", "-p", str(port),
+            "-se", self.executable, "-s", SCRIPT, "--"] + scriptArgs
+
+  def run(self, stage, case, worker):
+    return subprocess.call(self.command(stage, case, worker)) == 0
+
+  def shutdown(self):
+    for port in sorted(self._ports):
+      subprocess.call([sys.executable, os.path.join(SCRIPTS_DIR, "EvaluationClient.py"), "-p", str(port),
+                       "--shutdown"])
+
+
+def runStages(cases, stages, launcher, queueSize=2):
+  """ Passes every case through all stages and returns [(case, stage name)] of the cases that failed.
+
+  Workers of stage i take cases from queue i and put finished cases into queue i+1. All queues but the first one are
+  bounded, so a stage blocks once the next stage is queueSize cases behind.
+  """
+  queues = [Queue.Queue()] + [Queue.Queue(maxsize=max(1, queueSize)) for _ in stages[1:]] + [Queue.Queue()]
+  failed = []
+  lock = threading.Lock()
+  # worker numbers are unique across stages, so that every worker can have its own daemon
+  firstWorker = [sum(s.workers for s in stages[:i]) for i in range(len(stages))]
+
+  def work(stageIndex, worker):
+    stage = stages[stageIndex]
+    while True:
+      case = queues[stageIndex].get()
+      if case is _DONE:
+        return
+      logging.info("Stage %s of case %s started" % (stage.name, case))
+      success = launcher.run(stage, case, worker)
+      missing = stage.missingOutputs(case) if success else []
+      if success and not missing:
+        queues[stageIndex + 1].put(case)
+      else:
+        logging.warn("Stage %s of case %s failed%s" % (stage.name, case,
+                                                      " (missing %s)" % ", ".join(missing) if missing else ""))
+        with lock:
+          failed.append((case, stage.name))
+
+  def runStage(stageIndex):
+    threads = [threading.Thread(target=work, args=(stageIndex, firstWorker[stageIndex] + n))
+               for n in range(stages[stageIndex].workers)]
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    for thread in threads:
+      thread.join()
+    # all workers of this stage finished: let the workers of the next stage finish as well
+    for _ in range(stages[stageIndex + 1].workers if stageIndex + 1 < len(stages) else 1):
+      queues[stageIndex + 1].put(_DONE)
+
+  for case in sorted(cases, key=caseSortKey):
+    queues[0].put(case)
+  for _ in range(stages[0].workers):
+    queues[0].put(_DONE)
+
+  coordinators = [threading.Thread(target=runStage, args=(i,)) for i in range(len(stages))]
+  for coordinator in coordinators:
+    coordinator.daemon = True
+    coordinator.start()
+  for coordinator in coordinators:
+    coordinator.join()
+  return sorted(failed, key=lambda entry: caseSortKey(entry[0]))
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,195 @@
+import os
+import sys
+import csv
+import argparse
+import logging
+import subprocess
+import tempfile
+import shutil
+
+from CaseIndex import listDirectory
+
+try:
+  import slicer
+except ImportError:
+  slicer = None
+
+# Runs one of the Slicer scripts of this directory with N headless Slicer workers. The cases are split round robin
+# into N shards, every worker processes its shard (passed to the script with -c) and writes its own csv file. The shard
+# csv files get merged into the final output in case order.
+#
+# Slicer scripting is single threaded and Slicer can not fork, so separate Slicer processes are the only way to use
+# more than one core for steps that depend on Slicer (registration, DeepInfer, CurveMaker).
+
+# usage: python SlicerScheduler.py -s {Script} -cd {CaseDirectory} -w {Workers} -o {OutputFile} -- {script arguments}
+
+# python SlicerScheduler.py -s CalculateLandmarkRegistrationError.py -cd {LandmarksDirectory} -w 8 -o LRE.csv -- -ld {LandmarksDirectory} -o LRE.csv
+
+# python SlicerScheduler.py -s Prospective/CopyNeedleImagesAndData.py -ca {ProstateCasesArchive} -w 4 -o TRE.csv -- -cr {ProstateCasesArchive} -od {outputCaseDirectory} -o TRE.csv
+
+# python SlicerScheduler.py -s CreateDeepLearningSegmentations.py -cd {LandmarksDirectory} -w 4 -- -ld {LandmarksDirectory}
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+META_FILENAME = 'results.json'
+
+
+def main(argv):
+
+  try:
+    scriptArgs = []
+    if "--" in argv:
+      scriptArgs = argv[argv.index("--") + 1:]
+      argv = argv[:argv.index("--")]
+
+    parser = argparse.ArgumentParser(description="Slicetracker headless Slicer job scheduler")
+    parser.add_argument("-s", "--script", dest="script", metavar="PATH", required=True,
+                        help="Script to run, relative to the scripts directory or absolute. Needs to accept -c CASE...")
+    parser.add_argument("-c", "--cases", dest="cases", metavar="CASE", nargs="+", default=None,
+                        help="Case numbers to process")
+    parser.add_argument("-cd", "--case-directory", dest="caseDirectory", metavar="PATH", default=None,
+                        help="Directory listing sub directories named with their case number")
+    parser.add_argument("-ca", "--case-archive", dest="caseArchive", metavar="PATH", default=None,
+                        help="Case archive holding Case{number}-... directories with %s files" % META_FILENAME)
+    parser.add_argument("-w", "--workers", dest="workers", metavar="N", type=int, default=4,
+                        help="Number of Slicer workers (default: %(default)s)")
+    parser.add_argument("-o", "--output-file", dest="outputFile", metavar="PATH", default=None,
+                        help="Merged csv file. Each worker writes its shard to a temporary file instead")
+    parser.add_argument("-oa", "--output-argument", dest="outputArgument", metavar="OPTION", default="-o",
+                        help="Option of the script naming its output csv file (default: %(default)s)")
+    parser.add_argument("-hr", "--header-rows", dest="headerRows", metavar="N", type=int, default=1,
+                        help="Number of header rows of the csv files (default: %(default)s)")
+    parser.add_argument("-se", "--slicer-executable", dest="slicerExecutable", metavar="PATH", default=None,
+                        help="Slicer executable (default: $SLICER_EXECUTABLE, the running Slicer or Slicer)")
+    args = parser.parse_args(argv)
+
+    cases = getCases(args)
+    if not cases:
+      raise ValueError("No cases to process")
+
+    script = args.script if os.path.isabs(args.script) else os.path.join(SCRIPTS_DIR, args.script)
+    scheduler = SlicerScheduler(script, scriptArgs, args.slicerExecutable or getSlicerExecutable(),
+                                outputArgument=args.outputArgument if args.outputFile else None)
+    failed = scheduler.run(cases, args.workers, outputFile=args.outputFile, headerRows=args.headerRows)
+    success = not failed
+
+  except Exception, e:
+    print e
+    success = False
+  sys.exit(0 if success else 1)
+
+
+def getCases(args):
+  cases = []
+  if args.caseDirectory:
+    cases += [name for name, isDir, _, _ in listDirectory(args.caseDirectory) if isDir and not name.startswith(".")]
+  if args.caseArchive:
+    cases += findArchiveCases(args.caseArchive)
+  if args.cases:
+    cases = [case for case in cases if case in args.cases] if cases else list(args.cases)
+  return sorted(set(cases), key=caseSortKey)
+
+
+def findArchiveCases(caseRootDir):
+  """ Case numbers of a case archive as found by the Prospective scripts
+  """
+  from Prospective.ArchiveScanner import scanArchive
+  return sorted(set(case for case, _ in scanArchive(caseRootDir)), key=caseSortKey)
+
+
+def caseSortKey(case):
+  return (0, int(case), case) if case.isdigit() else (1, 0, case)
+
+
+def splitShards(cases, workers):
+  """ Round robin split, so that every shard gets cases from the whole (sorted) range
+  """
+  nShards = max(1, min(workers, len(cases)))
+  return [cases[i::nShards] for i in range(nShards)]
+
+
+def getSlicerExecutable():
+  if os.environ.get("SLICER_EXECUTABLE"):
+    return os.environ["SLICER_EXECUTABLE"]
+  if slicer:
+    launcher = getattr(slicer.app, "launcherExecutableFilePath", None)
+    return launcher if launcher else slicer.app.applicationFilePath()
+  return "Slicer"
+
+
+def replaceArgument(argv, option, value):
+  """ Returns argv with the value of option replaced (or option appended if not present)
+  """
+  argv = list(argv)
+  if option in argv and argv.index(option) + 1 < len(argv):
+    argv[argv.index(option) + 1] = value
+  else:
+    argv += [option, value]
+  return argv
+
+
+class SlicerScheduler(object):
+
+  def __init__(self, script, scriptArgs, executable, outputArgument=None):
+    self.script = script
+    self.scriptArgs = list(scriptArgs)
+    self.executable = executable
+    self.outputArgument = outputArgument
+
+  def command(self, shard, shardOutput=None):
+    scriptArgs = self.scriptArgs
+    if self.outputArgument and shardOutput:
+      scriptArgs = replaceArgument(scriptArgs, self.outputArgument, shardOutput)
+    return [self.executable, "--no-main-window", "--python-script", self.script] + scriptArgs + ["-c"] + shard
+
+  def run(self, cases, workers, outputFile=None, headerRows=1):
+    """ Processes cases with the given number of Slicer workers and returns the list of cases whose worker failed
+    """
+    shards = splitShards(cases, workers)
+    tempDir = tempfile.mkdtemp(prefix="SlicerScheduler-")
+    try:
+      processes = []
+      for index, shard in enumerate(shards):
+        shardOutput = os.path.join(tempDir, "shard{}.csv".format(index)) if outputFile else None
+        logging.info("Starting worker %d for cases %s" % (index, ", ".join(shard)))
+        processes.append((shard, shardOutput, subprocess.Popen(self.command(shard, shardOutput))))
+
+      failed = []
+      shardOutputs = []
+      for shard, shardOutput, process in processes:
+        process.wait()
+        if process.returncode != 0 or (shardOutput and not os.path.exists(shardOutput)):
+          logging.warn("Worker for cases %s failed (exit code %s)" % (", ".join(shard), process.returncode))
+          failed += shard
+        elif shardOutput:
+          shardOutputs.append(shardOutput)
+
+      if outputFile:
+        mergeShards(shardOutputs, outputFile, headerRows)
+      if failed:
+        print "Failed cases: " + ", ".join(sorted(failed, key=caseSortKey))
+      return failed
+    finally:
+      shutil.rmtree(tempDir, ignore_errors=True)
+
+
+def mergeShards(shardFiles, outputFile, headerRows=1):
+  """ Concatenates csv shards ordered by case (first column). Rows of the same case keep their order.
+  """
+  header = None
+  rows = []
+  for shardFile in shardFiles:
+    with open(shardFile, "rb") as f:
+      shardRows = list(csv.reader(f, delimiter=','))
+    if header is None:
+      header = shardRows[:headerRows]
+    rows += shardRows[headerRows:]
+  rows.sort(key=lambda row: caseSortKey(row[0]) if row else (2, 0, ""))
+
+  with open(outputFile, "wb") as csv_file:
+    writer = csv.writer(csv_file, delimiter=',')
+    for line in (header or []) + rows:
+      writer.writerow(line)
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
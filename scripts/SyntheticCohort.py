@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+
+import numpy as np
+import SimpleITK as sitk
+
+from FiducialIO import writeFCSV
+from TransformIO import BSplineTransform, writeTransform, applyTransformToPoints
+
+# Generates a synthetic cohort with the directory layout and file names the evaluation scripts expect:
+#
+# landmarks/{case}/      {case}-{Preop,Intraop}{Manual,Automatic}-label.nrrd, {case}-{Preop,Intraop}Landmarks.fcsv,
+#                        {case}-TRANSFORM-bSpline-{Manual,Automatic}.h5,
+#                        {case}-PreopLandmarks-transformed-bSpline-{Manual,Automatic}.fcsv
+# segmentations/{case}/  {case}-{Preop,Intraop}Volume.nrrd, {case}-{Preop,Intraop}Label{Manual,Automatic}.nrrd
+# archive/Case{case}-{date}/SliceTrackerOutputs/results.json (with the guidance series label/volume/targets) and
+#                        DICOM/Intraop/{series}/ files the archive scan has to skip
+# tre/{case}/            {series}-needle-label.nrrd, {series}-targets.fcsv as staged by CopyNeedleImagesAndData
+#
+# Images hold an ellipsoidal "prostate"; automatic labels are shifted manual labels and intraop landmarks are the
+# preop landmarks moved by a random bSpline deformation plus noise, so the computed metrics are plausible.
+
+# usage: python SyntheticCohort.py -o {OutputDirectory} -n {NumberOfCases}
+
+FIRST_CASE = 1000
+DEFAULT_SIZE = [96, 96, 24]
+SPACING = [0.6, 0.6, 3.0]
+GRID_SIZE = 7
+TRANSFORM_TYPE = "bSpline"
+
+
+def main(argv):
+
+  try:
+    parser = argparse.ArgumentParser(description="Slicetracker synthetic cohort generator")
+    parser.add_argument("-o", "--output-directory", dest="outputDir", metavar="PATH", required=True,
+                        help="Directory to write the cohort to")
+    parser.add_argument("-n", "--cases", dest="cases", metavar="N", type=int, default=10,
+                        help="Number of cases (default: %(default)s)")
+    parser.add_argument("-sz", "--size", dest="size", metavar="N", type=int, nargs=3, default=DEFAULT_SIZE,
+                        help="Image size in voxels (default: %(default)s)")
+    parser.add_argument("-g", "--guidance-series", dest="guidanceSeries", metavar="N", type=int, default=3,
+                        help="Number of needle guidance series per case (default: %(default)s)")
+    parser.add_argument("-s", "--seed", dest="seed", metavar="N", type=int, default=0,
+                        help="Random seed (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    cohort = generateCohort(args.outputDir, args.cases, args.size, args.guidanceSeries, seed=args.seed)
+    print "Generated %d cases in %s" % (len(cohort["cases"]), args.outputDir)
+    success = True
+
+  except Exception, e:
+    print e
+    success = False
+  sys.exit(0 if success else 1)
+
+
+def ellipsoid(size, center, radii):
+  """ Binary ellipsoid in numpy order (k, j, i); center and radii in voxels (i, j, k)
+  """
+  k, j, i = np.ogrid[:size[2], :size[1], :size[0]]
+  return (((i - center[0]) / radii[0]) ** 2 + ((j - center[1]) / radii[1]) ** 2 +
+          ((k - center[2]) / radii[2]) ** 2) <= 1.0
+
+
+def writeImage(array, path, origin=(0, 0, 0), spacing=SPACING):
+  image = sitk.GetImageFromArray(array)
+  image.SetSpacing(spacing)
+  image.SetOrigin(origin)
+  sitk.WriteImage(image, path, True)
+  return image
+
+
+def syntheticVolume(rng, size, prostate):
+  volume = rng.normal(200, 30, size[::-1])
+  volume[prostate] += 150
+  return volume.astype(np.int16)
+
+
+def randomBSpline(rng, size, magnitude=2.0):
+  """ Random bSpline deformation whose grid covers an image of size (origin 0, SPACING)
+  """
+  extent = np.array(size) * SPACING
+  gridSpacing = extent / (GRID_SIZE - 3)
+  return BSplineTransform([GRID_SIZE] * 3, -gridSpacing, gridSpacing, np.identity(3),
+                          rng.normal(0, magnitude, 3 * GRID_SIZE ** 3))
+
+
+def timestamp(seconds):
+  return str(np.datetime64("2017-01-01T08:00:00") + np.timedelta64(int(seconds), "s")) + ".000Z"
+
+
+def writeLabelPair(rng, size, center, radii, manualPath, automaticPath):
+  manual = ellipsoid(size, center, radii)
+  shift = rng.normal(0, 1.5, 3)
+  automatic = ellipsoid(size, center + shift, radii * rng.uniform(0.9, 1.1, 3))
+  writeImage(manual.astype(np.uint8), manualPath)
+  writeImage(automatic.astype(np.uint8), automaticPath)
+  return manual
+
+
+def generateCase(rng, outputDir, case, size, guidanceSeries, landmarks=10, targets=3):
+  size = np.array(size)
+  center = size / 2.0
+  radii = np.array([size[0] / 5.0, size[1] / 5.0, size[2] / 4.0])
+
+  landmarkDir = os.path.join(outputDir, "landmarks", case)
+  segmentationDir = os.path.join(outputDir, "segmentations", case)
+  caseDir = os.path.join(outputDir, "archive", "Case{}-{}".format(case, "20170101"))
+  outputsDir = os.path.join(caseDir, "SliceTrackerOutputs")
+  treDir = os.path.join(outputDir, "tre", case)
+  for directory in [landmarkDir, segmentationDir, outputsDir, treDir]:
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+
+  def landmarkFile(name):
+    return os.path.join(landmarkDir, "{}-{}".format(case, name))
+
+  def segmentationFile(name):
+    return os.path.join(segmentationDir, "{}-{}".format(case, name))
+
+  for imageType in ["Preop", "Intraop"]:
+    prostate = writeLabelPair(rng, size, center, radii, landmarkFile("{}Manual-label.nrrd".format(imageType)),
+                              landmarkFile("{}Automatic-label.nrrd".format(imageType)))
+    shutil.copy(landmarkFile("{}Manual-label.nrrd".format(imageType)),
+                segmentationFile("{}LabelManual.nrrd".format(imageType)))
+    shutil.copy(landmarkFile("{}Automatic-label.nrrd".format(imageType)),
+                segmentationFile("{}LabelAutomatic.nrrd".format(imageType)))
+    writeImage(syntheticVolume(rng, size, prostate), segmentationFile("{}Volume.nrrd".format(imageType)))
+
+  # landmarks inside of the prostate (RAS, images have identity direction in LPS)
+  ijk = center + rng.uniform(-0.6, 0.6, (landmarks, 3)) * radii
+  lps = ijk * SPACING
+  preop = lps * [-1, -1, 1]
+  labels = ["F-{}".format(i + 1) for i in range(landmarks)]
+  writeFCSV(landmarkFile("PreopLandmarks.fcsv"), preop, labels)
+  for segmentationType in ["Manual", "Automatic"]:
+    transform = randomBSpline(rng, size)
+    writeTransform(landmarkFile("TRANSFORM-{}-{}.h5".format(TRANSFORM_TYPE, segmentationType)), transform)
+    transformed = applyTransformToPoints(transform, preop)
+    writeFCSV(landmarkFile("PreopLandmarks-transformed-{}-{}.fcsv".format(TRANSFORM_TYPE, segmentationType)),
+              transformed, labels)
+    if segmentationType == "Manual":
+      writeFCSV(landmarkFile("IntraopLandmarks.fcsv"), transformed + rng.normal(0, 1.0, transformed.shape), labels)
+
+  # archive case with one cover prostate and the guidance series
+  seconds = rng.uniform(0, 3600)
+  results = []
+  for index in range(guidanceSeries + 1):
+    seriesNumber = index + 5
+    seriesType = "COVER PROSTATE" if index == 0 else "GUIDANCE"
+    received = seconds + 300 + index * rng.uniform(300, 900)
+    label, volume, targetFile = ["{}-{}".format(seriesNumber, name) for name in
+                                 ["label.nrrd", "volume.nrrd", "targets.fcsv"]]
+    prostate = ellipsoid(size, center, radii)
+    writeImage(prostate.astype(np.uint8), os.path.join(outputsDir, label))
+    writeImage(syntheticVolume(rng, size, prostate), os.path.join(outputsDir, volume))
+    targetPositions = (center + rng.uniform(-0.5, 0.5, (targets, 3)) * radii) * SPACING * [-1, -1, 1]
+    writeFCSV(os.path.join(outputsDir, targetFile), targetPositions,
+              ["Target {}".format(i + 1) for i in range(targets)])
+    result = {
+      "name": "{}: {}".format(seriesNumber, "COVER PROSTATE" if index == 0 else "Needle Guidance"),
+      "series": {"type": seriesType, "receivedTime": timestamp(received)},
+      "status": {"state": "approved", "time": timestamp(received + rng.uniform(30, 240)),
+                 "registrationType": TRANSFORM_TYPE},
+      "labels": {"fixed": label},
+      "volumes": {"fixed": volume},
+      "targets": {"approved": {"fileName": targetFile}}
+    }
+    if index == 0:
+      result["segmentation"] = {"algorithm": "Automatic", "startTime": timestamp(received + 5),
+                                "endTime": timestamp(received + 25)}
+    else:
+      writeNeedle(rng, size, os.path.join(treDir, "{}-needle-label.nrrd".format(seriesNumber)))
+      shutil.copy(os.path.join(outputsDir, targetFile), os.path.join(treDir, "{}-targets.fcsv".format(seriesNumber)))
+    results.append(result)
+
+    dicomDir = os.path.join(caseDir, "DICOM", "Intraop", str(seriesNumber))
+    os.makedirs(dicomDir)
+    for i in range(size[2]):
+      with open(os.path.join(dicomDir, "IMG{:04d}.dcm".format(i)), "wb") as f:
+        f.write("\0" * 128)
+
+  metafile = {
+    "procedureEvents": {"caseStarted": timestamp(seconds), "caseCompleted": {"time": timestamp(received + 600)}},
+    "preop": {"usedERC": bool(rng.randint(2)),
+              "segmentation": {"algorithm": "Automatic", "startTime": timestamp(seconds + 10),
+                               "endTime": timestamp(seconds + 40)}},
+    "results": results
+  }
+  with open(os.path.join(outputsDir, "results.json"), "w") as f:
+    json.dump(metafile, f, indent=2)
+
+
+def writeNeedle(rng, size, path):
+  """ Needle label: a tilted cylinder of about 3 voxels diameter inserted from the first slice
+  """
+  depth = rng.randint(size[2] // 2, size[2])
+  entry = np.array(size[:2]) / 2.0 + rng.uniform(-10, 10, 2)
+  tilt = rng.uniform(-1.5, 1.5, 2)
+  k, j, i = np.ogrid[:size[2], :size[1], :size[0]]
+  centerI = entry[0] + tilt[0] * k
+  centerJ = entry[1] + tilt[1] * k
+  needle = ((i - centerI) ** 2 + (j - centerJ) ** 2 <= 2.25) & (k < depth)
+  writeImage(needle.astype(np.uint8), path)
+
+
+def generateCohort(outputDir, cases, size=DEFAULT_SIZE, guidanceSeries=3, seed=0):
+  """ Generates cases into outputDir and returns {"root", "cases"}
+  """
+  rng = np.random.RandomState(seed)
+  caseNumbers = [str(FIRST_CASE + i) for i in range(cases)]
+  for case in caseNumbers:
+    generateCase(rng, outputDir, case, size, guidanceSeries)
+  return {"root": outputDir, "cases": caseNumbers}
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
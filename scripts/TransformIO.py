@@ -0,0 +1,268 @@
+import logging
+import h5py
+import numpy as np
+
+# Slicer independent reading/writing of ITK hdf5 transform files and batch application to point sets.
+#
+# ITK transform files hold the resampling transform (fixed to moving space, LPS). Slicer shows and applies the inverse
+# of it to markups, which is what applyTransformToPoints reproduces for RAS points read from fcsv files.
+
+TRANSFORM_GROUP = "TransformGroup"
+
+
+class AffineTransform(object):
+  """ y = M * (x - c) + t + c
+  """
+
+  def __init__(self, matrix, translation, center=None):
+    self.matrix = np.asarray(matrix, dtype=np.float64).reshape(3, 3)
+    self.translation = np.asarray(translation, dtype=np.float64).reshape(3)
+    self.center = np.zeros(3) if center is None else np.asarray(center, dtype=np.float64).reshape(3)
+
+  @property
+  def offset(self):
+    return self.translation + self.center - self.matrix.dot(self.center)
+
+  def transformPoints(self, points):
+    return np.asarray(points, dtype=np.float64).dot(self.matrix.T) + self.offset
+
+  def inverseTransformPoints(self, points):
+    inverse = np.linalg.inv(self.matrix)
+    return (np.asarray(points, dtype=np.float64) - self.offset).dot(inverse.T)
+
+
+class BSplineTransform(object):
+  """ Cubic BSpline deformation defined on a coefficient grid. An optional bulk transform gets added to the
+  deformation (ITKv3 BSplineDeformableTransform convention): y = bulk(x) + d(x)
+  """
+
+  ORDER = 3
+
+  def __init__(self, gridSize, gridOrigin, gridSpacing, gridDirection, coefficients, bulkTransform=None):
+    self.gridSize = np.asarray(gridSize, dtype=np.int64).reshape(3)
+    self.gridOrigin = np.asarray(gridOrigin, dtype=np.float64).reshape(3)
+    self.gridSpacing = np.asarray(gridSpacing, dtype=np.float64).reshape(3)
+    self.gridDirection = np.asarray(gridDirection, dtype=np.float64).reshape(3, 3)
+    # one coefficient image per displacement component, flattened with x running fastest
+    self.coefficients = np.asarray(coefficients, dtype=np.float64).reshape(3, -1)
+    self.bulkTransform = bulkTransform
+    self._physicalToIndex = np.linalg.inv(self.gridDirection.dot(np.diag(self.gridSpacing)))
+
+  def continuousIndices(self, points):
+    return (np.asarray(points, dtype=np.float64) - self.gridOrigin).dot(self._physicalToIndex.T)
+
+  def displacements(self, points):
+    """ Evaluates the deformation of all points at once. Points whose support region is not completely inside of the
+    grid have zero displacement (same as ITK).
+    """
+    return self.displacementsAtIndices(self.continuousIndices(points))
+
+  def displacementsAtIndices(self, cindex):
+    """ Deformation at continuous indices of the coefficient grid
+    """
+    cindex = np.asarray(cindex, dtype=np.float64).reshape(-1, 3)
+    result = np.zeros_like(cindex)
+    halfOrder = 0.5 * (self.ORDER - 1)
+    inside = np.all((cindex >= halfOrder) & (cindex < self.gridSize - halfOrder - 1.0), axis=1)
+    if not np.any(inside):
+      return result
+
+    cindex = cindex[inside]
+    start = np.floor(cindex - halfOrder).astype(np.int64)
+    weights = [bSplineKernel(cindex[:, axis, None] - (start[:, axis, None] + np.arange(self.ORDER + 1)))
+               for axis in range(3)]
+
+    displacement = np.zeros_like(cindex)
+    sx, sy = self.gridSize[0], self.gridSize[1]
+    for k in range(self.ORDER + 1):
+      for j in range(self.ORDER + 1):
+        wjk = weights[1][:, j] * weights[2][:, k]
+        rowIndex = (start[:, 1] + j) * sx + (start[:, 2] + k) * sx * sy
+        for i in range(self.ORDER + 1):
+          flatIndex = rowIndex + start[:, 0] + i
+          displacement += (wjk * weights[0][:, i])[:, None] * self.coefficients[:, flatIndex].T
+    result[inside] = displacement
+    return result
+
+  def transformPoints(self, points):
+    points = np.asarray(points, dtype=np.float64)
+    bulk = self.bulkTransform.transformPoints(points) if self.bulkTransform else points
+    return bulk + self.displacements(points)
+
+  def inverseTransformPoints(self, points, iterations=50, tolerance=1e-4):
+    """ Damped fixed point iteration x += step * bulk^-1(y - T(x)), evaluated for all points at once. The step of a
+    point is halved whenever an update would increase its residual.
+    """
+    target = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    bulkMatrixInverse = np.linalg.inv(self.bulkTransform.matrix) if self.bulkTransform else np.identity(3)
+
+    estimate = self.bulkTransform.inverseTransformPoints(target) if self.bulkTransform else target.copy()
+    residual = target - self.transformPoints(estimate)
+    error = np.sqrt(np.sum(residual ** 2, axis=1))
+    step = np.ones(len(target))
+    for _ in range(iterations):
+      active = np.nonzero(error > tolerance)[0]
+      if not len(active):
+        break
+      candidate = estimate[active] + step[active, None] * residual[active].dot(bulkMatrixInverse.T)
+      candidateResidual = target[active] - self.transformPoints(candidate)
+      candidateError = np.sqrt(np.sum(candidateResidual ** 2, axis=1))
+      improved = candidateError < error[active]
+      accepted = active[improved]
+      estimate[accepted] = candidate[improved]
+      residual[accepted] = candidateResidual[improved]
+      error[accepted] = candidateError[improved]
+      step[active[~improved]] *= 0.5
+    if np.any(error > tolerance):
+      logging.warn("BSpline inversion did not converge for %d points (max residual %.4f mm)"
+                   % (np.sum(error > tolerance), np.max(error)))
+    return estimate
+
+
+class CompositeTransform(object):
+  """ ITK composite transform: the last transform of the queue gets applied first
+  """
+
+  def __init__(self, transforms):
+    self.transforms = list(transforms)
+
+  def transformPoints(self, points):
+    for transform in reversed(self.transforms):
+      points = transform.transformPoints(points)
+    return points
+
+  def inverseTransformPoints(self, points):
+    for transform in self.transforms:
+      points = transform.inverseTransformPoints(points)
+    return points
+
+
+def bSplineKernel(x):
+  """ Cubic BSpline kernel evaluated elementwise
+  """
+  x = np.abs(x)
+  return np.where(x < 1.0, (4.0 - 6.0 * x ** 2 + 3.0 * x ** 3) / 6.0,
+                  np.where(x < 2.0, (2.0 - x) ** 3 / 6.0, 0.0))
+
+
+def eulerMatrix(angleX, angleY, angleZ):
+  cx, sx = np.cos(angleX), np.sin(angleX)
+  cy, sy = np.cos(angleY), np.sin(angleY)
+  cz, sz = np.cos(angleZ), np.sin(angleZ)
+  rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+  ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+  rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+  return rz.dot(rx).dot(ry)
+
+
+def versorMatrix(x, y, z):
+  w = np.sqrt(max(0.0, 1.0 - (x * x + y * y + z * z)))
+  return np.array([[1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+                   [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+                   [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]])
+
+
+def createTransform(transformType, parameters, fixedParameters):
+  """ Creates the transform object for one entry of an ITK transform file
+  """
+  name = transformType.split("_")[0]
+  p, fp = np.asarray(parameters, dtype=np.float64), np.asarray(fixedParameters, dtype=np.float64)
+  if name in ["AffineTransform", "MatrixOffsetTransformBase"]:
+    return AffineTransform(p[:9], p[9:12], fp[:3] if len(fp) else None)
+  elif name == "Euler3DTransform":
+    return AffineTransform(eulerMatrix(*p[:3]), p[3:6], fp[:3] if len(fp) else None)
+  elif name == "VersorRigid3DTransform":
+    return AffineTransform(versorMatrix(*p[:3]), p[3:6], fp[:3] if len(fp) else None)
+  elif name == "Similarity3DTransform":
+    return AffineTransform(versorMatrix(*p[:3]) * p[6], p[3:6], fp[:3] if len(fp) else None)
+  elif name == "TranslationTransform":
+    return AffineTransform(np.identity(3), p[:3])
+  elif name == "IdentityTransform":
+    return AffineTransform(np.identity(3), np.zeros(3))
+  elif name in ["BSplineTransform", "BSplineDeformableTransform"]:
+    return BSplineTransform(fp[0:3], fp[3:6], fp[6:9], fp[9:18], p)
+  raise ValueError("Transform type %s is not supported" % transformType)
+
+
+def readTransform(path):
+  """ Reads an ITK hdf5 transform file (.h5) and returns an AffineTransform, BSplineTransform or CompositeTransform
+  """
+  entries = []
+  with h5py.File(path, "r") as f:
+    group = f[TRANSFORM_GROUP]
+    for key in sorted(group.keys(), key=int):
+      entry = group[key]
+      transformType = entry["TransformType"][0]
+      if not isinstance(transformType, str):
+        transformType = transformType.decode()
+      entries.append((transformType, readDataset(entry, "TransformParameters"),
+                      readDataset(entry, "TransformFixedParameters")))
+
+  if not entries:
+    raise ValueError("Transform file %s does not hold any transform" % path)
+
+  if entries[0][0].startswith("CompositeTransform"):
+    return CompositeTransform([createTransform(*entry) for entry in entries[1:]])
+
+  transform = createTransform(*entries[0])
+  if isinstance(transform, BSplineTransform) and len(entries) > 1:
+    # ITKv3 style: additional transform in the file is the bulk transform of the BSpline
+    transform.bulkTransform = createTransform(*entries[1])
+  return transform
+
+
+def readDataset(entry, name):
+  # ITK writes the misspelled "Tranform..." dataset names
+  for key in [name, name.replace("Transform", "Tranform", 1)]:
+    if key in entry:
+      return entry[key][()]
+  return []
+
+
+def transformEntries(transform):
+  """ [(transform type, parameters, fixed parameters)] of a transform as stored in ITK transform files
+  """
+  if isinstance(transform, CompositeTransform):
+    entries = [("CompositeTransform_double_3_3", [], [])]
+    for t in transform.transforms:
+      entries += transformEntries(t)
+    return entries
+  if isinstance(transform, BSplineTransform):
+    entries = [("BSplineTransform_double_3_3", transform.coefficients.ravel(),
+                np.concatenate([transform.gridSize, transform.gridOrigin, transform.gridSpacing,
+                                transform.gridDirection.ravel()]))]
+    if transform.bulkTransform is not None:
+      entries += transformEntries(transform.bulkTransform)
+    return entries
+  if isinstance(transform, AffineTransform):
+    return [("AffineTransform_double_3_3", np.concatenate([transform.matrix.ravel(), transform.translation]),
+             transform.center)]
+  raise ValueError("Transform %s is not supported" % type(transform).__name__)
+
+
+def writeTransform(path, transform):
+  """ Writes an AffineTransform, BSplineTransform or CompositeTransform as ITK hdf5 transform file (.h5)
+  """
+  with h5py.File(path, "w") as f:
+    group = f.create_group(TRANSFORM_GROUP)
+    for index, (transformType, parameters, fixedParameters) in enumerate(transformEntries(transform)):
+      entry = group.create_group(str(index))
+      # ITK reads the type as variable length string
+      entry.create_dataset("TransformType", data=[transformType], dtype=h5py.special_dtype(vlen=str))
+      entry.create_dataset("TransformParameters", data=np.asarray(parameters, dtype=np.float64))
+      entry.create_dataset("TransformFixedParameters", data=np.asarray(fixedParameters, dtype=np.float64))
+
+
+def rasToLps(points):
+  points = np.array(points, dtype=np.float64).reshape(-1, 3)
+  points[:, :2] *= -1
+  return points
+
+
+lpsToRas = rasToLps
+
+
+def applyTransformToPoints(transform, points):
+  """ Moves RAS points the same way Slicer does when a transform read from file gets hardened on markups
+  """
+  return lpsToRas(transform.inverseTransformPoints(rasToLps(points)))
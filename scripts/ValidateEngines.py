@@ -0,0 +1,320 @@
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import SimpleITK as sitk
+
+from SyntheticCohort import generateCohort, TRANSFORM_TYPE
+
+# Regression checks of the Slicer independent engines against SimpleITK or the implementations they replaced, run on
+# a synthetic cohort (see SyntheticCohort.py). Every check reports the largest deviation from its reference and fails
+# if that exceeds the tolerance of the check.
+#
+#   TransformIO            readTransform/writeTransform and point application vs sitk.ReadTransform().TransformPoint
+#   FiducialIO             fcsv round trip (RAS and LPS files) and cohort LREs vs per fiducial distances
+#   NeedleCenterline       centerline points vs the former per slice bounding box loop and TransformIndexToPhysicalPoint
+#   NeedleDistance         vectorized distances vs a per target, per segment loop
+#   LabelStatisticsEngine  label statistics vs sitk.LabelStatisticsImageFilter and LabelShapeStatisticsImageFilter
+
+# usage: python ValidateEngines.py
+
+# python ValidateEngines.py -n 5 -c {CheckName}
+
+TOLERANCE = 1e-6
+# applyTransformToPoints inverts BSplines iteratively (see BSplineTransform.inverseTransformPoints)
+INVERSE_TOLERANCE = 1e-3
+CHECK_SIZE = [48, 48, 12]
+
+
+def main(argv):
+
+  try:
+    parser = argparse.ArgumentParser(description="Slicetracker engine regression checks")
+    parser.add_argument("-n", "--cases", dest="cases", metavar="N", type=int, default=3,
+                        help="Number of synthetic cases (default: %(default)s)")
+    parser.add_argument("-c", "--checks", dest="checks", metavar="NAME", nargs="+", default=None,
+                        choices=CHECKS.keys(), help="Only run these checks (%(choices)s)")
+    parser.add_argument("-sz", "--size", dest="size", metavar="N", type=int, nargs=3, default=CHECK_SIZE,
+                        help="Image size in voxels (default: %(default)s)")
+    parser.add_argument("-s", "--seed", dest="seed", metavar="N", type=int, default=0,
+                        help="Random seed of the cohort (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix="slicetracker-checks-")
+    try:
+      cohort = generateCohort(root, args.cases, args.size, guidanceSeries=2, seed=args.seed)
+      failed = runChecks(cohort, args.checks or CHECKS.keys())
+    finally:
+      shutil.rmtree(root, ignore_errors=True)
+    if failed:
+      print "Failed checks: " + ", ".join(failed)
+    success = not failed
+
+  except Exception, e:
+    print e
+    success = False
+  sys.exit(0 if success else 1)
+
+
+def runChecks(cohort, names):
+  """ Runs the checks and prints one line per comparison. Returns the names of the failed checks.
+  """
+  failed = []
+  for name in names:
+    for comparison, deviation, tolerance in CHECKS[name](cohort):
+      passed = deviation <= tolerance
+      print "{:<8} {:<22} {:<45} max deviation {:.3g} (tolerance {:g})".format(
+        "ok" if passed else "FAILED", name, comparison, deviation, tolerance)
+      if not passed and name not in failed:
+        failed.append(name)
+  return failed
+
+
+def maxDeviation(actual, expected):
+  actual, expected = np.asarray(actual, dtype=np.float64), np.asarray(expected, dtype=np.float64)
+  if actual.shape != expected.shape:
+    return np.inf
+  return float(np.max(np.abs(actual - expected))) if actual.size else 0.0
+
+
+def landmarkFile(cohort, case, name):
+  return os.path.join(cohort["root"], "landmarks", case, "{}-{}".format(case, name))
+
+
+def transformFiles(cohort):
+  return [landmarkFile(cohort, case, "TRANSFORM-{}-{}.h5".format(TRANSFORM_TYPE, segmentationType))
+          for case in cohort["cases"] for segmentationType in ["Manual", "Automatic"]]
+
+
+def sitkTransformPoints(transform, points):
+  return np.array([transform.TransformPoint([float(v) for v in point]) for point in points])
+
+
+def checkTransformIO(cohort):
+  from FiducialIO import readFCSV
+  from TransformIO import readTransform, writeTransform, applyTransformToPoints, rasToLps, AffineTransform, \
+    CompositeTransform
+
+  rng = np.random.RandomState(0)
+  forward, inverse = [], []
+  for path in transformFiles(cohort):
+    case = os.path.basename(path).split("-")[0]
+    ras, _ = readFCSV(landmarkFile(cohort, case, "PreopLandmarks.fcsv"))
+    transform, reference = readTransform(path), sitk.ReadTransform(path)
+    lps = rasToLps(ras)
+    forward.append(maxDeviation(transform.transformPoints(lps), sitkTransformPoints(reference, lps)))
+    # Slicer moves markups by the inverse of the file transform: mapping them back has to give the input
+    moved = rasToLps(applyTransformToPoints(transform, ras))
+    inverse.append(maxDeviation(sitkTransformPoints(reference, moved), lps))
+  yield "bSpline files, forward", max(forward), TOLERANCE
+  yield "bSpline files, applyTransformToPoints", max(inverse), INVERSE_TOLERANCE
+
+  directory = tempfile.mkdtemp(prefix="slicetracker-transforms-")
+  try:
+    bSpline = readTransform(transformFiles(cohort)[0])
+    affine = AffineTransform(np.identity(3) + rng.normal(0, 0.05, (3, 3)), rng.normal(0, 5, 3), rng.normal(0, 10, 3))
+    points = rng.uniform(-20, 20, (50, 3))
+    for name, transform in [("affine", affine), ("composite", CompositeTransform([affine, bSpline]))]:
+      path = os.path.join(directory, "{}.h5".format(name))
+      writeTransform(path, transform)
+      reference = sitk.ReadTransform(path)
+      yield "written {}, sitk vs written".format(name), \
+        maxDeviation(transform.transformPoints(points), sitkTransformPoints(reference, points)), TOLERANCE
+      yield "written {}, read back".format(name), \
+        maxDeviation(readTransform(path).transformPoints(points), transform.transformPoints(points)), TOLERANCE
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def checkFiducialIO(cohort):
+  from FiducialIO import readFCSV, writeFCSV, calculateCohortLREs
+
+  rng = np.random.RandomState(0)
+  directory = tempfile.mkdtemp(prefix="slicetracker-fiducials-")
+  try:
+    points = rng.uniform(-100, 100, (20, 3))
+    path = os.path.join(directory, "points.fcsv")
+    writeFCSV(path, points)
+    read, labels = readFCSV(path)
+    yield "RAS round trip", maxDeviation(read, points) + (0 if len(labels) == len(points) else np.inf), 0.0
+
+    lpsPath = os.path.join(directory, "points-lps.fcsv")
+    with open(lpsPath, "wb") as f:
+      f.write("# Markups fiducial file version = 4.11\n# CoordinateSystem = LPS\n")
+      f.write("# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID\n")
+      for i, (x, y, z) in enumerate(points):
+        f.write("{},{!r},{!r},{!r},0,0,0,1,1,1,0,F-{},,\n".format(i, -x, -y, z, i + 1))
+    yield "LPS file", maxDeviation(readFCSV(lpsPath)[0], points), 0.0
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+  cases = [(case, landmarkFile(cohort, case, "IntraopLandmarks.fcsv"),
+            landmarkFile(cohort, case, "PreopLandmarks-transformed-{}-Manual.fcsv".format(TRANSFORM_TYPE)))
+           for case in cohort["cases"]]
+  expected = []
+  for _, fixedFile, movingFile in cases:
+    # the former calculateLRE loop: getTargetPosition and get3DEuclideanDistance per fiducial pair, one at a time
+    fixed, moving = readFCSV(fixedFile)[0], readFCSV(movingFile)[0]
+    for i in range(len(fixed)):
+      expected.append(np.sqrt(sum((a - b) ** 2 for a, b in zip(fixed[i], moving[i]))))
+  yield "cohort LREs", maxDeviation([row[-1] for row in calculateCohortLREs(cases)], expected), TOLERANCE
+
+
+def baselineNeedlePointsIJK(nda):
+  """ Per slice bounding box centers, as computed by CopyNeedleImagesAndData before NeedleCenterline.py
+  """
+  slices = np.nonzero(np.sum(np.sum(nda, axis=1), axis=1))[0]
+  points = np.zeros((len(slices), 3), dtype=np.int64)
+  for index, sliceNumber in enumerate(slices):
+    rows, columns = np.where(nda[sliceNumber] != 0)
+    y1, y2, x1, x2 = rows.min(), rows.max(), columns.min(), columns.max()
+    points[index] = [x1 + int((x2 - x1) / 2), y1 + int((y2 - y1) / 2), sliceNumber]
+  return points
+
+
+def baselineIJKToRAS(image, points):
+  ras = np.array([image.TransformIndexToPhysicalPoint([int(v) for v in point]) for point in points]).reshape(-1, 3)
+  ras[:, :2] *= -1
+  return ras
+
+
+def needleLabels(cohort):
+  labels = []
+  for case in cohort["cases"]:
+    directory = os.path.join(cohort["root"], "tre", case)
+    labels += [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.endswith("-needle-label.nrrd")]
+  return labels
+
+
+def checkNeedleCenterline(cohort):
+  from Prospective.NeedleCenterline import CenterLinePoints
+
+  labels = needleLabels(cohort)
+  # oblique copy of the first needle, so that direction and origin are part of the comparison
+  directory = tempfile.mkdtemp(prefix="slicetracker-needles-")
+  try:
+    image = sitk.ReadImage(labels[0])
+    angle = 0.3
+    image.SetDirection([np.cos(angle), -np.sin(angle), 0, np.sin(angle), np.cos(angle), 0, 0, 0, 1])
+    image.SetOrigin([12.5, -40.0, 7.25])
+    oblique = os.path.join(directory, "oblique-needle-label.nrrd")
+    sitk.WriteImage(image, oblique)
+
+    ijk, ras = [], []
+    for path in labels + [oblique]:
+      centerLine = CenterLinePoints(path)
+      points = centerLine.get_needle_points_ijk()
+      reference = baselineNeedlePointsIJK(sitk.GetArrayFromImage(centerLine.label))
+      ijk.append(maxDeviation(points, reference))
+      ras.append(maxDeviation(centerLine.convert_points_ijk_to_ras(points), baselineIJKToRAS(centerLine.label,
+                                                                                             reference)))
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+  yield "IJK points of {} needles".format(len(labels) + 1), max(ijk), 0.0
+  yield "RAS points of {} needles".format(len(labels) + 1), max(ras), TOLERANCE
+
+
+def baselineDistance(curve, target):
+  """ Distance of target to the polyline curve, first and last segment extended to lines
+  """
+  best = np.inf
+  segments = len(curve) - 1
+  for s in range(segments):
+    start, end = curve[s], curve[s + 1]
+    direction = end - start
+    t = np.dot(target - start, direction) / np.dot(direction, direction)
+    lower = -np.inf if s == 0 else 0.0
+    upper = np.inf if s == segments - 1 else 1.0
+    t = min(max(t, lower), upper)
+    best = min(best, np.linalg.norm(start + t * direction - target))
+  return best
+
+
+def checkNeedleDistance(cohort):
+  from FiducialIO import readFCSV
+  from Prospective.NeedleCenterline import CenterLinePoints
+  from Prospective.NeedleDistance import distancesToCurves
+
+  curves, targets, indices = [], [], []
+  for path in needleLabels(cohort):
+    centerLine = CenterLinePoints(path)
+    curve = centerLine.convert_points_ijk_to_ras(centerLine.get_needle_points_ijk())
+    positions = readFCSV(path.replace("-needle-label.nrrd", "-targets.fcsv"))[0]
+    # targets beyond both needle ends exercise the extrapolated segments
+    beyond = [curve[0] - 5 * (curve[1] - curve[0]), curve[-1] + 5 * (curve[-1] - curve[-2])]
+    for target in list(positions) + beyond:
+      targets.append(target)
+      indices.append(len(curves))
+    curves.append(curve)
+
+  expected = [baselineDistance(curves[index], target) for target, index in zip(targets, indices)]
+  distances, errors, closest = distancesToCurves(curves, targets, indices, spline=False)
+  yield "polyline distances of {} targets".format(len(targets)), maxDeviation(distances, expected), TOLERANCE
+  yield "error vectors", maxDeviation(np.sqrt(np.sum(errors ** 2, axis=1)), expected), TOLERANCE
+
+  # the spline passes through the centerline points
+  points = np.concatenate(curves)
+  pointIndices = np.concatenate([[i] * len(curve) for i, curve in enumerate(curves)])
+  yield "spline through centerline points", float(np.max(distancesToCurves(curves, points, pointIndices)[0])), \
+    TOLERANCE
+
+
+def checkLabelStatisticsEngine(cohort):
+  from LabelStatisticsEngine import computeLabelStatistics
+
+  deviations = OrderedDict((name, []) for name in ["Count", "Volume mm^3", "BBox", "Centroid", "Mean", "StdDev",
+                                                    "Min", "Max"])
+  for case in cohort["cases"]:
+    directory = os.path.join(cohort["root"], "segmentations", case)
+    for imageType in ["Preop", "Intraop"]:
+      volumeFile = os.path.join(directory, "{}-{}Volume.nrrd".format(case, imageType))
+      labelFiles = [os.path.join(directory, "{}-{}Label{}.nrrd".format(case, imageType, segmentationType))
+                    for segmentationType in ["Manual", "Automatic"]]
+      volume = sitk.ReadImage(volumeFile)
+      for labelFile, table in zip(labelFiles, computeLabelStatistics(labelFiles, volumeFile)):
+        label = sitk.ReadImage(labelFile)
+        intensities = sitk.LabelStatisticsImageFilter()
+        intensities.Execute(volume, label)
+        shape = sitk.LabelShapeStatisticsImageFilter()
+        shape.Execute(label)
+        for row, value in enumerate(table["Label"]):
+          value = int(value)
+          count = intensities.GetCount(value)
+          deviations["Count"].append(abs(table["Count"][row] - count))
+          deviations["Mean"].append(abs(table["Mean"][row] - intensities.GetMean(value)))
+          # sitk reports the sample standard deviation, LabelStatistics the population one
+          sigma = intensities.GetSigma(value) * np.sqrt((count - 1.0) / count) if count > 1 else 0.0
+          deviations["StdDev"].append(abs(table["StdDev"][row] - sigma))
+          deviations["Min"].append(abs(table["Min"][row] - intensities.GetMinimum(value)))
+          deviations["Max"].append(abs(table["Max"][row] - intensities.GetMaximum(value)))
+          if value == 0:
+            continue
+          deviations["Volume mm^3"].append(abs(table["Volume mm^3"][row] - shape.GetPhysicalSize(value)))
+          box = shape.GetBoundingBox(value)
+          expectedBox = list(box[:3]) + [box[i] + box[i + 3] - 1 for i in range(3)]
+          deviations["BBox"].append(maxDeviation([table[column][row] for column in
+                                                  ["BBox_Min_I", "BBox_Min_J", "BBox_Min_K",
+                                                   "BBox_Max_I", "BBox_Max_J", "BBox_Max_K"]], expectedBox))
+          centroid = np.array(shape.GetCentroid(value)) * [-1, -1, 1]
+          deviations["Centroid"].append(maxDeviation([table[column][row] for column in
+                                                      ["Centroid_R", "Centroid_A", "Centroid_S"]], centroid))
+  for name, values in deviations.items():
+    yield name, float(np.max(values)), 0.0 if name in ["Count", "BBox"] else TOLERANCE
+
+
+# name: check yielding (comparison, max deviation, tolerance) tuples
+CHECKS = OrderedDict([
+  ("TransformIO", checkTransformIO),
+  ("FiducialIO", checkFiducialIO),
+  ("NeedleCenterline", checkNeedleCenterline),
+  ("NeedleDistance", checkNeedleDistance),
+  ("LabelStatisticsEngine", checkLabelStatisticsEngine),
+])
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])